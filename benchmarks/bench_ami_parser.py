@@ -0,0 +1,74 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""AMI parser micro-benchmark (events/sec).
+
+1. parse_message only
+2. StreamReader framing (readuntil) + parse_message
+3. AmiClient end-to-end over TCP against the fake AMI server
+
+    python -m benchmarks.bench_ami_parser --count 200000
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks.fake_ami import FakeAmiServer, call_events
+from services.ami_client import AMI_EOM, AmiClient, build_action, parse_message
+
+
+def frames(count: int) -> list[bytes]:
+    events = []
+    while len(events) < count:
+        events.extend(build_action(event) for event in call_events(f"1715432693.{len(events)}"))
+    return events[:count]
+
+
+def bench_parse(count: int) -> float:
+    data = frames(count)
+    started = time.perf_counter()
+    for frame in data:
+        parse_message(frame)
+    return count / (time.perf_counter() - started)
+
+
+async def bench_stream(count: int) -> float:
+    reader = asyncio.StreamReader(limit=1024 * 1024)
+    reader.feed_data(b"".join(frames(count)))
+    reader.feed_eof()
+    started = time.perf_counter()
+    for _ in range(count):
+        parse_message(await reader.readuntil(AMI_EOM))
+    return count / (time.perf_counter() - started)
+
+
+async def bench_client(count: int) -> float:
+    server = FakeAmiServer(rate=-1, count=count)
+    await server.start()
+    client = AmiClient("127.0.0.1", server.port, server.username, server.secret, queue_size=0)
+    await client.connect()
+    started = time.perf_counter()
+    received = 0
+    async for _ in client.events():
+        received += 1
+        if received >= count:
+            break
+    result = count / (time.perf_counter() - started)
+    await client.close()
+    await server.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=200000)
+    args = parser.parse_args()
+
+    print(f"parse_message:            {bench_parse(args.count):12.0f} events/sec")
+    print(f"StreamReader + parse:     {asyncio.run(bench_stream(args.count)):12.0f} events/sec")
+    print(f"AmiClient over TCP:       {asyncio.run(bench_client(args.count)):12.0f} events/sec")
+
+
+if __name__ == "__main__":
+    main()
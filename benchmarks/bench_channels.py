@@ -0,0 +1,115 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Memory of tracked channels: last parsed ARI event dict per channel (before)
+vs ChannelStore slotted records with shared strings (after).
+
+Events are parsed from JSON text like the websocket client does, so equal
+strings of different events are different objects.
+
+    python -m benchmarks.bench_channels --channels 10000
+"""
+
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from services.channels import ChannelStore
+
+CONTEXTS = ("from-trunk", "from-internal", "macro-dial", "ext-queues", "ivr-3")
+STATES = ("Ring", "Ringing", "Up")
+
+
+def events(count: int, seed: int = 1) -> list[str]:
+    """ChannelCreated and ChannelStateChange of count channels, bridge of every
+    two channels, as ARI websocket text"""
+    rnd = random.Random(seed)
+    texts = []
+    for i in range(count):
+        channel = {
+            "id": f"1715515942.{i}",
+            "name": f"PJSIP/{100 + i % 200}-{i:08x}",
+            "state": "Down",
+            "caller": {"name": "<unknown>", "number": f"79{rnd.randrange(10**9):09d}"},
+            "connected": {"name": "", "number": f"{100 + i % 200}"},
+            "accountcode": "",
+            "dialplan": {
+                "context": rnd.choice(CONTEXTS),
+                "exten": f"{100 + i % 200}",
+                "priority": 1,
+                "app_name": "Dial",
+                "app_data": f"PJSIP/{100 + i % 200},,tT",
+            },
+            "creationtime": "2024-05-12T15:12:22.274+0300",
+            "language": "ru",
+        }
+        common = {
+            "timestamp": "2024-05-12T15:12:22.274+0300",
+            "asterisk_id": "52:54:00:02:46:7d",
+            "application": "AsteriskAgentPython",
+        }
+        texts.append(json.dumps({"type": "ChannelCreated", **common, "channel": channel}))
+        channel["state"] = rnd.choice(STATES)
+        texts.append(json.dumps({"type": "ChannelStateChange", **common, "channel": channel}))
+        bridge = {
+            "id": f"bridge-{i // 2}",
+            "technology": "simple_bridge",
+            "bridge_type": "mixing",
+            "bridge_class": "basic",
+            "channels": [channel["id"]],
+        }
+        texts.append(
+            json.dumps(
+                {"type": "ChannelEnteredBridge", **common, "channel": channel, "bridge": bridge}
+            )
+        )
+    return texts
+
+
+def measure(build) -> tuple[int, float]:
+    """Bytes allocated by kept result of build() and its seconds (without tracing)"""
+    started = time.perf_counter()
+    build()
+    seconds = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=10000)
+    args = parser.parse_args()
+    texts = events(args.channels)
+
+    def before() -> dict:
+        last = {}
+        for text in texts:
+            event = json.loads(text)
+            last[event["channel"]["id"]] = event
+        return last
+
+    def after() -> ChannelStore:
+        store = ChannelStore(max_size=args.channels)
+        for text in texts:
+            store.on_ari_event(json.loads(text))
+        return store
+
+    for name, build in (("event dicts", before), ("ChannelStore", after)):
+        size, seconds = measure(build)
+        print(
+            f"{name:<14} {size / args.channels:8.0f} bytes/channel "
+            f"{size / 2**20:8.2f} MiB   {len(texts) / seconds:10.0f} events/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
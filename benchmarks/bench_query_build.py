@@ -0,0 +1,106 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Database query per-request overhead, before and after compiled queries.
+
+1. SQL text: f-string built on every call vs compiled Query.args()
+2. sqlite lookup by uniqueid: connect + f-string per call (before) vs
+   SqliteStrategy with one connection and prepared statement (after)
+
+    python -m benchmarks.bench_query_build --count 20000
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+import aiosqlite
+
+from schemas.config_schema import Config
+from services.database import SqliteStrategy
+from services.queries import compile_queries
+
+
+def seed(path: str, rows: int):
+    database = sqlite3.connect(path)
+    database.execute(
+        "CREATE TABLE cdr (calldate datetime, src text, dst text, duration int, billsec int, "
+        "disposition text, uniqueid text, linkedid text)"
+    )
+    database.execute("CREATE INDEX cdr_uniqueid ON cdr (uniqueid)")
+    database.executemany(
+        "INSERT INTO cdr VALUES (datetime('now'), '79111111111', '101', 10, 5, 'ANSWERED', ?, ?)",
+        [(f"1715432693.{i}", f"1715432693.{i}") for i in range(rows)],
+    )
+    database.commit()
+    database.close()
+
+
+def bench_build(count: int) -> tuple[float, float]:
+    table, start_field = "cdr", "calldate"
+    # built values are used, so both loops do the same work besides the build
+    sink = [0, 0]
+    started = time.perf_counter()
+    for i in range(count):
+        sql = (
+            f"SELECT * FROM {table} where {start_field} >= %s and {start_field} <= %s limit 100000;"
+        )
+        args = (i, i)
+        sink[0] += len(sql) + len(args)
+    before = (time.perf_counter() - started) / count
+    query = compile_queries("mysql", table, start_field)["get_cdr"]
+    started = time.perf_counter()
+    for i in range(count):
+        sql, args = query.sql, query.args({"start_date": i, "end_date": i})
+        sink[1] += len(sql) + len(args)
+    after = (time.perf_counter() - started) / count
+    assert all(sink), "queries are not built"
+    return before, after
+
+
+async def bench_sqlite(path: str, count: int, rows: int) -> tuple[float, float]:
+    table = "cdr"
+    started = time.perf_counter()
+    for i in range(count):
+        async with aiosqlite.connect(path) as database:
+            database.row_factory = aiosqlite.Row
+            async with database.execute(
+                f"SELECT * FROM {table} where uniqueid= ?;", [f"1715432693.{i % rows}"]
+            ) as cursor:
+                [row async for row in cursor]
+    before = (time.perf_counter() - started) / count
+
+    # defaults of other settings, without .env
+    config = Config.model_construct(
+        db_dialect="sqlite", db_host=path, db_table_cdr_name=table, pbx_name="default"
+    )
+    strategy = SqliteStrategy(config)
+    await strategy.check_cdr_old()
+    started = time.perf_counter()
+    for i in range(count):
+        await strategy.get_cdr_uniqueid(f"1715432693.{i % rows}")
+    after = (time.perf_counter() - started) / count
+    await strategy.close()
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    before, after = bench_build(args.count * 10)
+    print(f"SQL text build:      before {before * 1e6:8.2f} us   after {after * 1e6:8.2f} us")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cdr.db")
+        seed(path, args.rows)
+        before, after = asyncio.run(bench_sqlite(path, args.count, args.rows))
+    print(f"sqlite uniqueid:     before {before * 1e6:8.2f} us   after {after * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
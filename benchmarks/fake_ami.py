@@ -0,0 +1,213 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Fake Asterisk AMI server for local tests and benchmarks.
+
+Answers Login, Ping, Filter, Originate, Hangup, Redirect, CoreShowChannels,
+QueueStatus and Logoff, and streams call events (Newchannel, DialBegin,
+DialEnd, Hangup) to every logged in client at the configured rate.
+
+    python -m benchmarks.fake_ami --port 5038 --rate 1000
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import time
+
+from services.ami_client import AMI_EOM, build_action, parse_message
+
+log = logging.getLogger("asterisk_agent")
+
+BANNER = b"Asterisk Call Manager/7.0.3\r\n"
+
+
+def call_events(uniqueid: str) -> list[dict]:
+    """Events of one short inbound call, like real Asterisk 16 sends"""
+    channel = f"SIP/9222222222_out-{uniqueid.replace('.', '')[-8:]}"
+    common = {
+        "Privilege": "call,all",
+        "Channel": channel,
+        "ChannelState": "0",
+        "ChannelStateDesc": "Down",
+        "CallerIDNum": "+79111111111",
+        "CallerIDName": "<unknown>",
+        "ConnectedLineNum": "<unknown>",
+        "ConnectedLineName": "<unknown>",
+        "Language": "ru",
+        "AccountCode": "",
+        "Context": "from-trunk-sip-9222222222_out",
+        "Exten": "9222222222",
+        "Priority": "1",
+        "Uniqueid": uniqueid,
+        "Linkedid": uniqueid,
+    }
+    return [
+        {"Event": "Newchannel", **common},
+        {"Event": "DialBegin", **common, "DestChannel": "SIP/101-0001", "DialString": "101"},
+        {"Event": "DialEnd", **common, "DestChannel": "SIP/101-0001", "DialStatus": "ANSWER"},
+        {"Event": "Hangup", **common, "Cause": "16", "Cause-txt": "Normal Clearing"},
+    ]
+
+
+class FakeAmiServer:
+    """Fake AMI TCP server
+
+    Arguments:
+        rate -- events per second sent to each client, 0 - no events, -1 - max speed
+        count -- stop sending events after count events (None - infinite)
+        stamp -- add "BenchSent" (time.time()) to every event for end-to-end latency
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        username: str = "admin",
+        secret: str = "secret",
+        rate: float = 0,
+        count: int | None = None,
+        channels: int = 10,
+        stamp: bool = False,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.username = username
+        self.secret = secret
+        self.rate = rate
+        self.count = count
+        self.channels = channels
+        self.stamp = stamp
+        self.actions_received = 0
+        self.events_sent = 0
+        self.server: asyncio.AbstractServer | None = None
+        self._uniqueids = itertools.count(1)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info("Fake AMI server listen %s:%s", self.host, self.port)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(BANNER)
+        events_task = None
+        try:
+            while True:
+                action = parse_message(await reader.readuntil(AMI_EOM))
+                self.actions_received += 1
+                name = action.get("Action", "").lower()
+                for response in self._responses(name, action):
+                    writer.write(build_action(response))
+                if name == "login" and events_task is None and self.rate:
+                    events_task = asyncio.create_task(self._send_events(writer))
+                if name == "logoff":
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if events_task:
+                events_task.cancel()
+            writer.close()
+
+    def _responses(self, name: str, action: dict) -> list[dict]:
+        action_id = {"ActionID": action["ActionID"]} if "ActionID" in action else {}
+        if name == "login":
+            if action.get("Username") == self.username and action.get("Secret") == self.secret:
+                return [{"Response": "Success", **action_id, "Message": "Authentication accepted"}]
+            return [{"Response": "Error", **action_id, "Message": "Authentication failed"}]
+        if name == "ping":
+            return [{"Response": "Success", **action_id, "Ping": "Pong", "Timestamp": time.time()}]
+        if name == "logoff":
+            return [{"Response": "Goodbye", **action_id, "Message": "Thanks for all the fish."}]
+        if name in ("filter", "hangup", "redirect"):
+            return [{"Response": "Success", **action_id}]
+        if name == "originate":
+            return [
+                {"Response": "Success", **action_id, "Message": "Originate successfully queued"}
+            ]
+        if name == "coreshowchannels":
+            items = [
+                {
+                    "Event": "CoreShowChannel",
+                    **action_id,
+                    "Channel": f"SIP/101-{i:08x}",
+                    "Uniqueid": f"1715432693.{i}",
+                    "ChannelStateDesc": "Up",
+                    "CallerIDNum": "101",
+                    "Duration": "00:00:10",
+                }
+                for i in range(self.channels)
+            ]
+            return self._event_list(action_id, items, "CoreShowChannelsComplete")
+        if name == "queuestatus":
+            items = [
+                {"Event": "QueueParams", **action_id, "Queue": "400", "Calls": "0"},
+                {"Event": "QueueMember", **action_id, "Queue": "400", "Name": "SIP/101"},
+            ]
+            return self._event_list(action_id, items, "QueueStatusComplete")
+        return [{"Response": "Error", **action_id, "Message": "Invalid/unknown command"}]
+
+    @staticmethod
+    def _event_list(action_id: dict, items: list[dict], complete: str) -> list[dict]:
+        return [
+            {"Response": "Success", **action_id, "EventList": "start", "Message": "List follows"},
+            *items,
+            {"Event": complete, **action_id, "EventList": "Complete", "ListItems": len(items)},
+        ]
+
+    async def _send_events(self, writer: asyncio.StreamWriter):
+        # send events by batches every 10 ms to keep rate without sleep per event
+        tick = 0.01
+        batch = max(1, int(self.rate * tick)) if self.rate > 0 else 1000
+        buffer: list[dict] = []
+        sent = 0
+        while self.count is None or sent < self.count:
+            started = time.monotonic()
+            data = []
+            for _ in range(batch):
+                if not buffer:
+                    buffer = call_events(f"1715432693.{next(self._uniqueids)}")
+                event = buffer.pop(0)
+                if self.stamp:
+                    event["BenchSent"] = time.time()
+                data.append(build_action(event))
+                sent += 1
+                if self.count is not None and sent >= self.count:
+                    break
+            writer.write(b"".join(data))
+            self.events_sent += len(data)
+            await writer.drain()
+            if self.rate > 0:
+                await asyncio.sleep(max(0, tick - (time.monotonic() - started)))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5038)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--rate", type=float, default=10, help="events/sec, -1 max speed")
+    args = parser.parse_args()
+
+    server = FakeAmiServer(
+        host=args.host,
+        port=args.port,
+        username=args.username,
+        secret=args.secret,
+        rate=args.rate,
+    )
+    await server.start()
+    await server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    asyncio.run(main())
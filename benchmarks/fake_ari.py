@@ -0,0 +1,160 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Fake Asterisk ARI server for local tests and benchmarks.
+
+Websocket /ari/events replays events of data/*_sample.json (channel ids are
+made unique) at the configured rate to every connected client. REST routes used
+by the agent (subscription, eventFilter, channels, bridges, asterisk/info,
+endpoints) answer with empty success.
+
+    python -m benchmarks.fake_ari --port 8088 --rate 1000
+"""
+
+import argparse
+import asyncio
+import copy
+import datetime
+import glob
+import itertools
+import json
+import logging
+import os
+import time
+
+import uvicorn
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+log = logging.getLogger("asterisk_agent")
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def load_samples(pattern: str = os.path.join(DATA_DIR, "*_sample.json")) -> list[dict]:
+    """ARI events from sample files, a file has one or several concatenated events"""
+    decoder = json.JSONDecoder()
+    samples = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, encoding="utf-8", errors="replace") as file:
+            text = file.read()
+        position = 0
+        while text[position:].strip():
+            event, position = decoder.raw_decode(text, text.index("{", position))
+            samples.append(event)
+    return samples
+
+
+class FakeAri:
+    """Fake ARI application
+
+    Arguments:
+        rate -- events per second, 0 - no events, -1 - max speed
+        count -- stop sending events after count events of all connections
+            (None - infinite), the agent reconnects do not send them again
+        stamp -- add "bench_sent" (time.time()) to every event for end-to-end latency
+    """
+
+    def __init__(
+        self,
+        rate: float = 0,
+        count: int | None = None,
+        stamp: bool = False,
+        samples: list[dict] | None = None,
+    ) -> None:
+        self.rate = rate
+        self.count = count
+        self.stamp = stamp
+        self.samples = samples or load_samples()
+        self.events_sent = 0
+        self.connections = 0
+        self._ids = itertools.count(1)
+        self.app = FastAPI()
+        self.app.add_api_websocket_route("/ari/events", self.events)
+        self.app.add_api_route(
+            "/ari/applications/{name}/subscription", self.empty, methods=["POST", "DELETE"]
+        )
+        self.app.add_api_route("/ari/applications/{name}/eventFilter", self.empty, methods=["PUT"])
+        self.app.add_api_route("/ari/channels", self.empty_list)
+        self.app.add_api_route("/ari/bridges", self.empty_list)
+        self.app.add_api_route("/ari/endpoints", self.empty_list)
+        self.app.add_api_route("/ari/asterisk/info", self.info)
+
+    async def empty(self):
+        return {}
+
+    async def empty_list(self):
+        return []
+
+    async def info(self):
+        return {"system": {"version": "16.30.0", "entity_id": "52:54:00:02:46:7d"}}
+
+    def event(self) -> str:
+        """Next sample event with unique channel id"""
+        event = copy.deepcopy(self.samples[self.events_sent % len(self.samples)])
+        if "channel" in event:
+            event["channel"]["id"] = f"1715519323.{next(self._ids)}"
+        if self.stamp:
+            event["bench_sent"] = time.time()
+        if "timestamp" in event:
+            # ARI format, agent measures delivery latency from it
+            now = datetime.datetime.now().astimezone()
+            event["timestamp"] = f"{now:%Y-%m-%dT%H:%M:%S}.{now.microsecond // 1000:03d}{now:%z}"
+        return json.dumps(event, ensure_ascii=False)
+
+    async def events(self, websocket: WebSocket):
+        await websocket.accept()
+        self.connections += 1
+        # send events by batches every 10 ms to keep rate without sleep per event
+        tick = 0.01
+        batch = max(1, int(self.rate * tick)) if self.rate > 0 else 100
+        try:
+            if not self.rate:
+                await websocket.receive_text()
+            while self.count is None or self.events_sent < self.count:
+                started = time.monotonic()
+                for _ in range(batch):
+                    await websocket.send_text(self.event())
+                    self.events_sent += 1
+                    if self.count is not None and self.events_sent >= self.count:
+                        break
+                if self.rate > 0:
+                    await asyncio.sleep(max(0, tick - (time.monotonic() - started)))
+                else:
+                    await asyncio.sleep(0)
+            # keep connection open, the agent reconnects on close
+            await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+
+async def serve(app, host: str, port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    """Run ASGI app by uvicorn in current loop
+
+    Returns:
+        server (set should_exit to stop) and its task
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--rate", type=float, default=10, help="events/sec, -1 max speed")
+    args = parser.parse_args()
+
+    fake = FakeAri(rate=args.rate)
+    _, task = await serve(fake.app, args.host, args.port)
+    log.info("Fake ARI server listen %s:%s", args.host, args.port)
+    await task
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Seeded SQLite database with Asterisk cdr and cel tables for benchmarks.
+
+Calls are spread evenly over the last days, every call has two cdr rows
+(inbound leg and dialed leg with the same linkedid) and CEL events
+CHAN_START, ANSWER, HANGUP, CHAN_END of both legs. The same seed gives the
+same database.
+
+    python -m benchmarks.seed_db /tmp/cdr.db --calls 1000000
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import time
+
+CDR_TABLE = """
+CREATE TABLE cdr (
+    calldate datetime NOT NULL, clid text, src text, dst text, dcontext text,
+    channel text, dstchannel text, lastapp text, lastdata text, duration int,
+    billsec int, disposition text, amaflags int, accountcode text, uniqueid text,
+    userfield text, did text, recordingfile text, linkedid text, sequence int
+)
+"""
+CEL_TABLE = """
+CREATE TABLE cel (
+    id integer PRIMARY KEY, eventtype text, eventtime datetime, cid_name text,
+    cid_num text, cid_ani text, cid_rdnis text, cid_dnid text, exten text, context text,
+    channame text, appname text, appdata text, amaflags int, accountcode text,
+    peeraccount text, uniqueid text, linkedid text, userfield text, peer text, extra text
+)
+"""
+INDEXES = (
+    "CREATE INDEX cdr_calldate ON cdr (calldate)",
+    "CREATE INDEX cdr_uniqueid ON cdr (uniqueid)",
+    "CREATE INDEX cdr_linkedid ON cdr (linkedid)",
+    "CREATE INDEX cel_eventtime ON cel (eventtime)",
+)
+BATCH = 10000
+HANGUP_EXTRA = json.dumps({"hangupcause": 16})
+
+
+def calls(count: int, days: float, seed: int, now: float):
+    """(cdr rows, cel rows) of every call, oldest first, times are unix timestamps
+    (formatted by sqlite, much faster than in python)"""
+    rnd = random.Random(seed)
+    step = days * 86400 / max(count, 1)
+    start = int(now - days * 86400)
+    for i in range(count):
+        calldate = start + int(i * step)
+        linkedid = f"{calldate}.{2 * i}"
+        dialed = f"{calldate}.{2 * i + 1}"
+        src = f"79{rnd.randrange(10**9):09d}"
+        dst = f"{rnd.randrange(100, 200)}"
+        answered = rnd.random() < 0.7
+        billsec = rnd.randrange(5, 600) if answered else 0
+        duration = billsec + rnd.randrange(1, 30)
+        disposition = "ANSWERED" if answered else "NO ANSWER"
+        channel = f"SIP/trunk-{2 * i:08x}"
+        dstchannel = f"SIP/{dst}-{2 * i + 1:08x}"
+        cdr = [
+            (calldate, src, dst, "from-trunk", channel, dstchannel, "Dial", f"SIP/{dst}", duration,
+             billsec, disposition, linkedid, linkedid, 1),
+            (calldate, src, dst, "from-internal", dstchannel, "", "AppDial", "(Outgoing Line)",
+             duration, billsec, disposition, dialed, linkedid, 2),
+        ]  # fmt: skip
+        events = ["CHAN_START"] + (["ANSWER"] if answered else []) + ["HANGUP", "CHAN_END"]
+        cel = []
+        for uniqueid, channame in ((linkedid, channel), (dialed, dstchannel)):
+            for offset, eventtype in enumerate(events):
+                extra = HANGUP_EXTRA if eventtype == "HANGUP" else ""
+                eventtime = calldate + offset * duration // 3
+                cel.append(
+                    (eventtype, eventtime, src, dst, "from-trunk", channame, uniqueid, linkedid,
+                     extra)
+                )  # fmt: skip
+        yield cdr, cel
+
+
+def seed(path: str, count: int, days: float = 365, seed: int = 1) -> dict:
+    """Create database, existing file is replaced
+
+    Arguments:
+        path -- sqlite file
+        count -- calls count (2 cdr rows and 6-8 cel rows per call)
+        days -- calls are spread over last days
+        seed -- random seed
+
+    Returns:
+        rows counts and seconds spent
+    """
+    started = time.perf_counter()
+    if os.path.exists(path):
+        os.remove(path)
+    database = sqlite3.connect(path)
+    database.execute("PRAGMA journal_mode = OFF")
+    database.execute("PRAGMA synchronous = OFF")
+    database.execute(CDR_TABLE)
+    database.execute(CEL_TABLE)
+    cdr_rows, cel_rows = [], []
+    counts = {"calls": count, "cdr": 0, "cel": 0}
+
+    def flush():
+        database.executemany(
+            "INSERT INTO cdr (calldate, src, dst, dcontext, channel, dstchannel, lastapp, "
+            "lastdata, duration, billsec, disposition, uniqueid, linkedid, sequence) "
+            "VALUES (datetime(?, 'unixepoch', 'localtime'), "
+            "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            cdr_rows,
+        )
+        database.executemany(
+            "INSERT INTO cel (eventtype, eventtime, cid_num, exten, context, channame, "
+            "uniqueid, linkedid, extra) "
+            "VALUES (?, datetime(?, 'unixepoch', 'localtime'), ?, ?, ?, ?, ?, ?, ?)",
+            cel_rows,
+        )
+        counts["cdr"] += len(cdr_rows)
+        counts["cel"] += len(cel_rows)
+        cdr_rows.clear()
+        cel_rows.clear()
+
+    for cdr, cel in calls(count, days, seed, time.time()):
+        cdr_rows.extend(cdr)
+        cel_rows.extend(cel)
+        if len(cdr_rows) >= BATCH:
+            flush()
+    flush()
+    for index in INDEXES:
+        database.execute(index)
+    database.commit()
+    database.close()
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--calls", type=int, default=1000000)
+    parser.add_argument("--days", type=float, default=365)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(seed(args.path, args.calls, args.days, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""End-to-end benchmark of the agent with local stand-ins of Asterisk and webhook.
+
+Runs fake ARI websocket, fake AMI server and webhook sink in this process, the
+agent (uvicorn main:app) as subprocess on a seeded SQLite CDR/CEL database, then
+measures:
+
+1. events: events/sec from fake Asterisk through the agent to the webhook and
+   end-to-end latency percentiles, ARI and AMI separately
+2. history: /api/calls/hisroty/ and /api/events/hisroty/ throughput of random
+   one day windows, /api/calls/hisroty/uniqueid lookups
+3. memory: agent RSS and high-water mark (VmHWM) after every phase
+
+Results are written as JSON, --compare prints difference with previous results.
+
+    python -m benchmarks.suite --calls 1000000 --output results.json
+    python -m benchmarks.suite --output new.json --compare results.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.fake_ami import FakeAmiServer
+from benchmarks.fake_ari import FakeAri, serve
+from benchmarks.seed_db import seed
+from benchmarks.webhook_sink import WebhookSink, percentiles
+
+log = logging.getLogger("asterisk_agent")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGIN, PASSWORD = "bench", "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def memory(pid: int) -> dict[str, int]:
+    """VmRSS and VmHWM (kB) of process, empty dict where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as file:
+            lines = file.read().splitlines()
+    except OSError:
+        return {}
+    result = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in ("VmRSS", "VmHWM"):
+            result[f"{name.lower()}_kb"] = int(value.split()[0])
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def agent_env(args, tmp: str, ari_port: int, ami_port: int, sink_port: int) -> dict:
+    """Agent settings, environment overrides .env of the repository"""
+    return {
+        **os.environ,
+        "log_file": os.path.join(tmp, "asterisk_agent.log"),
+        "log_level": "WARNING",
+        "path_recordings": tmp,
+        "webhook_url": f"http://127.0.0.1:{sink_port}/",
+        "db_dialect": "sqlite",
+        "db_host": args.db,
+        "db_port": "0",
+        "db_database": "",
+        "db_user": "",
+        "db_password": "",
+        "db_table_cdr_name": "cdr",
+        "db_check_cdr_enable": "1",
+        "ari_enable": "1",
+        "ari_url": f"http://127.0.0.1:{ari_port}/ari",
+        "ari_wss": f"ws://127.0.0.1:{ari_port}/ari/events",
+        "ari_login": LOGIN,
+        "ari_password": PASSWORD,
+        "ari_events_ignore": "[]",
+        "ari_events_used": "[]",
+        # at max rate pong waits behind thousands of events in the socket, the agent
+        # must not reconnect because of it
+        "ari_ping_timeout": "120",
+        "ami_enable": "1",
+        "ami_host": "127.0.0.1",
+        "ami_port": f"{ami_port}",
+        "ami_login": "admin",
+        "ami_password": "secret",
+        "ami_events_ignore": "[]",
+        "ami_events_used": "[]",
+        "cel_tail_enable": "0",
+        "cel_tail_state_file": os.path.join(tmp, "cel_tail.json"),
+        "pbx_list": "{}",
+        "history_peers": "{}",
+    }
+
+
+async def wait_agent(client: httpx.AsyncClient, process: subprocess.Popen, timeout: float = 30):
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"agent exited with code {process.returncode}")
+        try:
+            if (await client.get("/api/checkup/live")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise TimeoutError("agent did not start")
+
+
+async def bench_events(sink: WebhookSink, expected: int, idle: float) -> dict:
+    """Wait until sink received expected events or nothing comes for idle seconds"""
+    started = time.monotonic()
+    last_count, last_change = -1, time.monotonic()
+    while sink.count() < expected and time.monotonic() - last_change < idle:
+        await asyncio.sleep(0.1)
+        if sink.count() != last_count:
+            last_count, last_change = sink.count(), time.monotonic()
+    stats = sink.stats()
+    return {
+        "expected": expected,
+        "delivered": sink.count(),
+        "seconds": round(time.monotonic() - started, 2),
+        "ari": stats.get("/", {}),
+        "ami": stats.get("ami", {}),
+    }
+
+
+async def load(requests: list, concurrency: int) -> dict:
+    """Run requests (coroutine factories returning rows count) by concurrency workers"""
+    latencies: list[float] = []
+    rows = errors = 0
+    pending = iter(requests)
+
+    async def worker():
+        nonlocal rows, errors
+        for request in pending:
+            started = time.perf_counter()
+            try:
+                count = await request()
+                rows += count
+            except Exception as exc:
+                log.error("Benchmark request error: %r", exc)
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "rows": rows,
+        "requests_per_sec": round(len(requests) / seconds, 1),
+        "rows_per_sec": round(rows / seconds, 1),
+        "latency": percentiles(latencies),
+    }
+
+
+async def bench_history(client: httpx.AsyncClient, args) -> dict:
+    """Random one day windows of seeded period and uniqueid lookups"""
+    rnd = random.Random(args.seed)
+    now = datetime.datetime.now().astimezone()
+    database = sqlite3.connect(args.db)
+    uniqueids = [
+        row[0]
+        for row in database.execute(
+            "SELECT uniqueid FROM cdr ORDER BY random() LIMIT ?", (args.requests,)
+        )
+    ]
+    database.close()
+
+    def window() -> dict:
+        start = now - datetime.timedelta(days=rnd.uniform(1, args.days))
+        end = start + datetime.timedelta(days=1)
+        return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+
+    def history(path: str, params: dict):
+        async def request() -> int:
+            res = await client.get(path, params=params)
+            res.raise_for_status()
+            return len(res.json())
+
+        return request
+
+    def lookup(uniqueid: str):
+        async def request() -> int:
+            res = await client.get("/api/calls/hisroty/uniqueid", params={"uniqueid": uniqueid})
+            res.raise_for_status()
+            return len(res.json())
+
+        return request
+
+    return {
+        "calls": await load(
+            [history("/api/calls/hisroty/", window()) for _ in range(args.requests)],
+            args.concurrency,
+        ),
+        "events": await load(
+            [history("/api/events/hisroty/", window()) for _ in range(args.requests)],
+            args.concurrency,
+        ),
+        "uniqueid": await load([lookup(uniqueid) for uniqueid in uniqueids], args.concurrency),
+    }
+
+
+async def run(args) -> dict:
+    if not os.path.exists(args.db):
+        log.info("Seed %s calls to %s", args.calls, args.db)
+        log.info("Seeded: %s", seed(args.db, args.calls, args.days, args.seed))
+
+    sink = WebhookSink(latency=args.webhook_latency, jitter=args.webhook_jitter)
+    fake_ari = FakeAri(rate=args.rate, count=args.events, stamp=True)
+    fake_ami = FakeAmiServer(rate=args.rate, count=args.events, stamp=True)
+    sink_port, ari_port = free_port(), free_port()
+    sink_server, sink_task = await serve(sink.app, "127.0.0.1", sink_port)
+    ari_server, ari_task = await serve(fake_ari.app, "127.0.0.1", ari_port)
+    await fake_ami.start()
+
+    results: dict = {
+        "meta": {
+            "time": datetime.datetime.now().astimezone().isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "args": {name: value for name, value in vars(args).items() if name != "compare"},
+        }
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        agent_port = free_port()
+        env = agent_env(args, tmp, ari_port, fake_ami.port, sink_port)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", f"{agent_port}"]
+            + ["--log-level", "warning", "--no-access-log"],
+            cwd=ROOT,
+            env=env,
+        )
+        try:
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{agent_port}",
+                auth=(LOGIN, PASSWORD),
+                timeout=args.timeout,
+            ) as client:
+                await wait_agent(client, process)
+                results["memory"] = {"start": memory(process.pid)}
+                log.info("Events phase: %s ARI and %s AMI events", args.events, args.events)
+                results["events"] = await bench_events(sink, 2 * args.events, args.idle)
+                results["memory"]["events"] = memory(process.pid)
+                log.info("History phase: %s requests", args.requests)
+                results["history"] = await bench_history(client, args)
+                results["memory"]["history"] = memory(process.pid)
+        finally:
+            process.terminate()
+            process.wait(10)
+            await fake_ami.close()
+            ari_server.should_exit = sink_server.should_exit = True
+            await asyncio.gather(ari_task, sink_task)
+    return results
+
+
+def flatten(value, prefix: str = "") -> dict[str, float]:
+    """Numeric leaves of nested dict as dotted names"""
+    if isinstance(value, dict):
+        return {
+            name: number
+            for key, item in value.items()
+            for name, number in flatten(item, f"{prefix}{key}.").items()
+        }
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix.rstrip("."): value}
+    return {}
+
+
+def compare(baseline: dict, results: dict) -> str:
+    """Table of measurements (not arguments) with change from baseline in percent"""
+    before = flatten({name: value for name, value in baseline.items() if name != "meta"})
+    after = flatten({name: value for name, value in results.items() if name != "meta"})
+    lines = [f"{'metric':<45} {'baseline':>14} {'current':>14} {'change':>9}"]
+    for name in sorted(before.keys() | after.keys()):
+        old, new = before.get(name), after.get(name)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ""
+        lines.append(
+            f"{name:<45} {'' if old is None else f'{old:.6g}':>14} "
+            f"{'' if new is None else f'{new:.6g}':>14} {change:>9}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "bench_cdr.db"))
+    parser.add_argument("--calls", type=int, default=1000000, help="seeded calls, new --db")
+    parser.add_argument("--days", type=float, default=365, help="seeded period, new --db")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--events", type=int, default=2000, help="ARI and AMI events each")
+    parser.add_argument("--rate", type=float, default=-1, help="events/sec, -1 max speed")
+    parser.add_argument("--webhook-latency", type=float, default=0)
+    parser.add_argument("--webhook-jitter", type=float, default=0)
+    parser.add_argument("--idle", type=float, default=10, help="stop waiting events after")
+    parser.add_argument("--requests", type=int, default=200, help="history requests each")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="results JSON file")
+    parser.add_argument("--compare", help="previous results JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+    print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            print(compare(json.load(file), results))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
@@ -0,0 +1,111 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Local webhook receiver for tests and benchmarks.
+
+Accepts POST on any path with injectable latency, counts events per path and
+end-to-end latency of events with "bench_sent" (ARI) or "BenchSent" (AMI).
+
+    python -m benchmarks.webhook_sink --port 8099 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from fastapi import FastAPI, Request, Response
+
+from benchmarks.fake_ari import serve
+
+log = logging.getLogger("asterisk_agent")
+
+
+def percentiles(values: list[float], points=(50, 90, 99)) -> dict[str, float]:
+    """Percentiles of values (nearest rank), empty dict for no values"""
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        f"p{point}": values[min(len(values) - 1, int(len(values) * point / 100))]
+        for point in points
+    } | {"max": values[-1]}
+
+
+class WebhookSink:
+    """Webhook receiver
+
+    Arguments:
+        latency -- seconds before answer
+        jitter -- random extra seconds from 0 to jitter
+        status -- answer status code
+    """
+
+    def __init__(self, latency: float = 0, jitter: float = 0, status: int = 200) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.status = status
+        self.app = FastAPI()
+        self.app.add_api_route("/{path:path}", self.hook, methods=["POST"])
+        self.reset()
+
+    async def hook(self, path: str, req: Request):
+        if not await req.body():
+            # agent checkup probe
+            return Response(status_code=self.status)
+        payload = await req.json()
+        now = time.time()
+        received = self.received.setdefault(path, {"events": 0, "first": now, "latencies": []})
+        received["events"] += 1
+        received["last"] = now
+        sent = payload.get("bench_sent") or payload.get("BenchSent")
+        if sent:
+            # end-to-end seconds from fake Asterisk send to webhook receive
+            received["latencies"].append(now - float(sent))
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        return Response(status_code=self.status)
+
+    def reset(self):
+        self.received: dict[str, dict] = {}
+
+    def count(self, path: str | None = None) -> int:
+        """Events received on path (all paths by default)"""
+        if path is not None:
+            return self.received.get(path, {}).get("events", 0)
+        return sum(received["events"] for received in self.received.values())
+
+    def stats(self) -> dict:
+        """path -> events, events_per_sec, latency percentiles (seconds)"""
+        stats = {}
+        for path, received in self.received.items():
+            duration = received["last"] - received["first"]
+            stats[path or "/"] = {
+                "events": received["events"],
+                "events_per_sec": round(received["events"] / duration, 1) if duration > 0 else 0,
+                "latency": percentiles(received["latencies"]),
+            }
+        return stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0, help="seconds before answer")
+    parser.add_argument("--jitter", type=float, default=0, help="random extra seconds")
+    parser.add_argument("--status", type=int, default=200)
+    args = parser.parse_args()
+
+    sink = WebhookSink(latency=args.latency, jitter=args.jitter, status=args.status)
+    _, task = await serve(sink.app, args.host, args.port)
+    log.info("Webhook sink listen %s:%s", args.host, args.port)
+    while not task.done():
+        await asyncio.sleep(5)
+        log.info("Webhook sink: %s", sink.stats())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    asyncio.run(main())
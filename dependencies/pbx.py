@@ -0,0 +1,28 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+from typing import Annotated
+
+from fastapi import Depends, Request
+from starlette.datastructures import State
+
+from exceptions.exceptions import BusinessError
+
+
+def get_pbx(req: Request, pbx: str | None = None) -> State:
+    """
+    State of PBX selected by pbx query parameter: config, ari, ami,
+    connector_database... Main PBX (app.state) when pbx is not set.
+
+    Raises:
+        BusinessError: unknown pbx
+    """
+    if pbx is None:
+        return req.app.state
+    state = req.app.state.pbx.get(pbx)
+    if state is None:
+        raise BusinessError(f"Unknown pbx {pbx}, available: {', '.join(req.app.state.pbx)}")
+    return state
+
+
+Pbx = Annotated[State, Depends(get_pbx)]
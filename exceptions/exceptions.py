@@ -14,3 +14,22 @@ class BusinessError(Exception):
 
         super().__init__()
         self.detail = detail
+
+
+class AmiError(Exception):
+    """Asterisk AMI action error."""
+
+    def __init__(self, detail: str) -> None:
+
+        super().__init__(detail)
+        self.detail = detail
+
+
+class OverloadError(Exception):
+    """Service is overloaded, request may be repeated after retry_after seconds."""
+
+    def __init__(self, detail: str, retry_after: int = 1) -> None:
+
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
@@ -3,48 +3,39 @@
 
 import asyncio
 import logging
-import sys
-from logging.handlers import RotatingFileHandler
+import signal
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import State
 from starlette.status import (
     HTTP_400_BAD_REQUEST,
     HTTP_401_UNAUTHORIZED,
     HTTP_422_UNPROCESSABLE_ENTITY,
     HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_503_SERVICE_UNAVAILABLE,
 )
 
 from const import VERSION
-from dependencies.db import get_db_connector
-from exceptions.exceptions import AuthError, BusinessError
+from exceptions.exceptions import AmiError, AuthError, BusinessError, OverloadError
+from routers.ami import router as ami_actions
+from routers.channels import router as channels
 from routers.checkup import router as checkup
+from routers.checkup import router_probes as checkup_probes
+from routers.config import router as config_reload
+from routers.contacts import router as contacts
+from routers.exports import router as exports
 from routers.history_calls import router as history_calls
 from routers.history_events import router as history_events
+from routers.metrics import router as metrics
 from routers.numbers import router as numbers
 from routers.recordings import router as recordings
 from schemas.config_schema import Config
-from services.ami import Ami
-
-# from services.ami_new import Ami as AmiNew
-from services.ari import Ari
-from services.websocket import WebsocketEvents
-
-log_file_handler = RotatingFileHandler(
-    filename="asterisk_agent.log",
-    mode="a",
-    maxBytes=5 * 1024 * 1024,
-    backupCount=2,
-    encoding=None,
-)
-logging.basicConfig(
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%H:%M:%S",
-    level="DEBUG",
-    handlers=[log_file_handler, logging.StreamHandler(sys.stdout)],
-)
+from services.lifecycle import init_pbx, reload_config_signal, start_pbx, start_task, stop_pbx
+from services.logger import setup_logging, stop_logging
+from services.metrics import MetricsMiddleware
 
 log = logging.getLogger("asterisk_agent")
 
@@ -65,6 +56,9 @@ app = FastAPI(
         HTTP_500_INTERNAL_SERVER_ERROR: {
             "description": "Internal Server Error",
         },
+        HTTP_503_SERVICE_UNAVAILABLE: {
+            "description": "Database is busy, repeat after Retry-After seconds",
+        },
     },
 )
 app.add_middleware(
@@ -74,6 +68,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get("/docs", include_in_schema=False)
@@ -113,10 +108,17 @@ app.mount(
 )
 
 app.include_router(checkup)
+app.include_router(checkup_probes)
 app.include_router(recordings)
 app.include_router(history_events)
 app.include_router(history_calls)
+app.include_router(exports)
 app.include_router(numbers)
+app.include_router(ami_actions)
+app.include_router(channels)
+app.include_router(contacts)
+app.include_router(metrics)
+app.include_router(config_reload)
 
 
 @app.exception_handler(BusinessError)
@@ -128,6 +130,15 @@ async def catch_exception_buisness(req: Request, exc: BusinessError):
     )
 
 
+@app.exception_handler(AmiError)
+async def catch_exception_ami(req: Request, exc: AmiError):
+    log.info("AMI error %s", exc)
+    raise HTTPException(
+        status_code=HTTP_400_BAD_REQUEST,
+        detail=exc.detail,
+    )
+
+
 @app.exception_handler(AuthError)
 async def catch_exception_auth(req: Request, exc: AuthError):
     log.info("Auth error %s", exc)
@@ -137,78 +148,49 @@ async def catch_exception_auth(req: Request, exc: AuthError):
     )
 
 
+@app.exception_handler(OverloadError)
+async def catch_exception_overload(req: Request, exc: OverloadError):
+    log.warning("Overload error %s", exc)
+    raise HTTPException(
+        status_code=HTTP_503_SERVICE_UNAVAILABLE,
+        detail=exc.detail,
+        headers={"Retry-After": f"{exc.retry_after}"},
+    )
+
+
 @app.exception_handler(Exception)
 async def catch_exception_internal(req: Request, exc: Exception):
     log.exception("Internal server error %s", exc)
     raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-async def producer_webhook(config: Config, timeout: int = 30) -> None:
-    """Producer send events to cusomer webhook from config file"""
-
-    while True:
-        try:
-            if not getattr(app.state, "websocket_client", None):
-                websocket_client = WebsocketEvents(
-                    ari_config=config.ari_config,
-                    api_key=config.api_key,
-                    api_key_base64=config.api_key_base64,
-                    webhook_url=f"{config.webhook_url}",
-                    timeout=timeout,
-                )
-                app.state.websocket_client = websocket_client
-
-            await websocket_client.start_consumer()
-        except asyncio.CancelledError:
-            break
-        except Exception as exc:
-            log.exception("Unknown producer_webhook error: %s", exc)
-        finally:
-            await asyncio.sleep(timeout)
-
-
 @app.on_event("startup")
 async def start() -> None:
     """Create backgrond task and init app"""
     # read and validate config file
     config = Config()  # type: ignore
-    ari = Ari(api_key=config.api_key, ari_url=str(config.ari_url))
-
-    # ami = AmiNew(
-    #     ami_config=config.ami_config,
-    #     api_key_base64=config.api_key_base64,
-    #     webhook_url=str(config.webhook_url),
-    # )
-    ami = Ami(
-        ami_config=config.ami_config,
-        api_key_base64=config.api_key_base64,
-        webhook_url=str(config.webhook_url),
-    )
-
-    app.state.background_tasks = []
-    app.state.config = config
-    app.state.ari = ari
-    app.state.ami = ami
-    app.state.connector_database = get_db_connector(config)
-
-    if config.db_check_cdr_enable:
-        log.info("start check cdr version...")
-        try:
-            await app.state.connector_database.check_cdr_old()
-        except Exception as exc:
-            log.exception("Unknown check_cdr_old error: %s", exc)
-        log.info("end check cdr version")
-
-    if config.ami_enable:
-        asyncio.gather(ami.start_catch_events())
-
-    if config.ari_enable:
-        app.state.background_tasks = [
-            asyncio.create_task(producer_webhook(config)),
-        ]
+    setup_logging(config)
+
+    # main PBX is app.state, others from pbx_list have their own State
+    app.state.pbx = {}
+    for name, pbx_config in config.pbx_configs().items():
+        state = app.state if pbx_config is config else State()
+        await init_pbx(state, pbx_config)
+        app.state.pbx[name] = state
+    for state in app.state.pbx.values():
+        start_pbx(state)
+
+    # kill -HUP <pid> reloads config, the same as POST /api/config/reload
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: start_task(app.state, "config_reload", reload_config_signal(app))
+        )
+    except (NotImplementedError, ValueError, RuntimeError):
+        log.info("SIGHUP config reload is not supported")
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    for task in app.state.background_tasks:
-        task.cancel()
+    for state in app.state.pbx.values():
+        await stop_pbx(state)
+    stop_logging()
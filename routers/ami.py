@@ -0,0 +1,67 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import logging
+
+from fastapi import APIRouter, Depends
+
+from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
+from schemas.ami_schema import HangupRequest, OriginateRequest, RedirectRequest
+from services.ami import Ami
+
+log = logging.getLogger("asterisk_agent")
+router = APIRouter(tags=["AMI"], dependencies=[Depends(verify_basic_auth)])
+
+
+@router.post("/api/ami/originate")
+async def originate(pbx: Pbx, body: OriginateRequest):
+    """Click to call over the agent AMI connection
+
+    Returns:
+        AMI response, call result comes later as OriginateResponse event
+    """
+    log.info("AMI ORIGINATE %s", body.channel)
+
+    ami: Ami = pbx.ami
+    return await ami.originate(body)
+
+
+@router.post("/api/ami/hangup")
+async def hangup(pbx: Pbx, body: HangupRequest):
+    """Hangup channel"""
+    log.info("AMI HANGUP %s", body.channel)
+
+    ami: Ami = pbx.ami
+    return await ami.hangup(body)
+
+
+@router.post("/api/ami/redirect")
+async def redirect(pbx: Pbx, body: RedirectRequest):
+    """Transfer channel to exten@context"""
+    log.info("AMI REDIRECT %s", body.channel)
+
+    ami: Ami = pbx.ami
+    return await ami.redirect(body)
+
+
+@router.get("/api/ami/queue_status")
+async def queue_status(pbx: Pbx, queue: str | None = None):
+    """Return queues status (QueueParams, QueueMember, QueueEntry events)
+
+    Arguments:
+        queue -- queue name, all queues if empty
+    """
+    log.info("AMI QUEUE STATUS")
+
+    ami: Ami = pbx.ami
+    return await ami.queue_status(queue)
+
+
+@router.get("/api/ami/channels")
+async def channels(pbx: Pbx):
+    """Return active channels (CoreShowChannel events)"""
+    log.info("AMI CHANNELS")
+
+    ami: Ami = pbx.ami
+    return await ami.core_show_channels()
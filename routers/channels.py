@@ -0,0 +1,45 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import logging
+
+from fastapi import APIRouter, Depends
+
+from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
+from exceptions.exceptions import BusinessError
+from services.channels import ChannelStore
+
+log = logging.getLogger("asterisk_agent")
+router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
+
+
+def get_channels(pbx) -> ChannelStore:
+    channels: ChannelStore | None = pbx.channels
+    if channels is None:
+        raise BusinessError("Channels tracking is disabled (channels_enable = 0)")
+    return channels
+
+
+@router.get("/api/channels/")
+async def channels(pbx: Pbx):
+    """Return alive channels and bridges tracked from ARI and AMI events,
+    without requests to Asterisk"""
+    log.info("CHANNELS")
+
+    return get_channels(pbx).snapshot()
+
+
+@router.get("/api/channels/{uniqueid}")
+async def channel(pbx: Pbx, uniqueid: str):
+    """Return tracked channel
+
+    Raises:
+        BusinessError: channel is not alive or not tracked
+    """
+    log.info("CHANNEL %s", uniqueid)
+
+    record = get_channels(pbx).get(uniqueid)
+    if record is None:
+        raise BusinessError(f"Channel {uniqueid} is not found")
+    return record
@@ -1,144 +1,94 @@
 # Copyright 2024 Artem Shurshilov
 # Apache License Version 2.0
 
-import datetime
-import json
 import logging
-import posixpath
 
-import httpx
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
+from starlette.status import HTTP_200_OK, HTTP_503_SERVICE_UNAVAILABLE
 
-from const import VERSION
 from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
+from exceptions.exceptions import BusinessError
 from schemas.config_schema import Config
-from services.database import MysqlStrategy, PostgresqlStrategy, SqliteStrategy
+from services.checkup import Checkup
 
 log = logging.getLogger("asterisk_agent")
 router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
+# probes of load balancer or orchestrator, without auth and without secrets in answer
+router_probes = APIRouter(tags=["API"])
 
 # disable httpx logger, for not log get request with api_key
 logging.getLogger("httpx").setLevel("CRITICAL")
 
 
 @router.get("/api/checkup/")
-async def checkup(req: Request):
+async def checkup(pbx: Pbx, refresh: bool = False):
     """
-    1. Asterisk Database connect
+    1. Asterisk Database connect, missing indexes of cdr and cel tables
     2. Asterisk ARI connect (request to asterisk version)
     3. Webhook connect
     4. Websocket connect
     5. Asterisk AMI
-    """
-    log.info("CHECKUP")
-    config: Config = req.app.state.config
-
-    result = {
-        "vesrion": VERSION,
-        "webhook_url": f"{config.webhook_url}",
-        "ari_events_ignore": config.ari_events_ignore,
-        "ari_events_used": config.ari_events_used,
-        "ami_events_ignore": config.ami_events_ignore,
-        "ami_events_used": config.ami_events_used,
-        "status": {
-            "checkup_db": "ok",
-            "checkup_ari": "ok",
-            "checkup_ami": "ok",
-            "checkup_webhook_url": "ok",
-            "checkup_websocket": "ok",
-        },
-        "info": {
-            "checkup_db": {},
-            "checkup_ari": {},
-            "checkup_ami": {},
-            "checkup_webhook_url": {},
-            "checkup_websocket": {},
-        },
-    }
-
-    # 1 Asterisk Database
-    try:
-        result["info"]["checkup_db"]["dialect"] = config.db_dialect
+    6. ARI and AMI events deduplication
+    7. CEL table tailing
 
-        connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-            req.app.state.connector_database
-        )
+    1-2 are checked in background, result is cached (see updated_time). 3 posts
+    to webhook, it is checked on refresh only (in background with checkup_webhook_enable)
 
-        result["info"]["checkup_db"]["cdr_start_field"] = connector_database.cdr_start_field
+    Arguments:
+        refresh -- check 1-3 now
+    """
+    log.info("CHECKUP")
+    checkup_service: Checkup = pbx.checkup
+    if refresh:
+        await checkup_service.refresh(webhook=True)
 
-        start_date = (datetime.datetime.now() - datetime.timedelta(days=3)).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
-        end_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        rows = await connector_database.get_cdr(start_date, end_date)
+    return JSONResponse(content=checkup_service.result())
 
-        result["info"]["checkup_db"]["history_last_call"] = str(rows[0]) if len(rows) else str(rows)
-    except Exception as exc:
-        result["info"]["checkup_db"]["error"] = str(exc)
-        result["status"]["checkup_db"] = "error"
 
-    # 2 Asterisk ARI
-    try:
-        async with httpx.AsyncClient() as client:
-            url1 = f"{config.ari_url}"
-            endpont_url = posixpath.join(url1, "asterisk/info")
-            url = f"{endpont_url}?api_key={config.api_key}"
+@router.post("/api/checkup/indexes")
+async def checkup_create_indexes(pbx: Pbx):
+    """Create missing indexes of cdr and cel tables (see missing_indexes of checkup_db).
+    Allowed by db_create_indexes_enable = 1, creating index on big table takes time.
 
-            checkup_ari = await client.get(url)
-            checkup_ari.raise_for_status()
+    Raises:
+        BusinessError: creating indexes is disabled or database error
 
-            result["info"]["checkup_ari"] = json.loads(checkup_ari.text)
-    except Exception as exc:
-        result["info"]["checkup_ari"] = str(exc)
-        result["status"]["checkup_ari"] = "error"
+    Returns:
+        executed statements and indexes still missing
+    """
+    log.info("CHECKUP CREATE INDEXES")
+    config: Config = pbx.config
+    if not config.db_create_indexes_enable:
+        raise BusinessError("Creating indexes is disabled, set db_create_indexes_enable = 1")
 
-    # 3. Webhook connect
+    connector_database = pbx.connector_database
     try:
-        async with httpx.AsyncClient() as client:
-            url = f"{config.webhook_url}"
+        statements = await connector_database.create_indexes()
+    except Exception as exc:
+        log.exception("Create indexes error: %s", exc)
+        raise BusinessError(f"Create indexes error: {exc}") from exc
+    return {"created": statements, "missing_indexes": connector_database.missing_indexes()}
 
-            checkup_webhook_url = await client.post(url)
 
-            result["info"]["checkup_webhook_url"] = f"status code {checkup_webhook_url.status_code}"
-            if checkup_webhook_url.status_code != 200:
-                result["status"]["checkup_webhook_url"] = "error"
-    except Exception as exc:
-        result["info"]["checkup_webhook_url"] = str(exc)
-        result["status"]["checkup_webhook_url"] = "error"
+@router_probes.get("/api/checkup/live")
+async def checkup_live():
+    """Liveness probe, process answers"""
+    return {"status": "ok"}
 
-    # 4. Websocket last message
-    try:
-        result["info"]["checkup_websocket"] = {
-            "answer_last_message_time": req.app.state.websocket_client.answer_last_message_time,
-            "answer_last_message": req.app.state.websocket_client.answer_last_message,
-            "no_answer_last_message_time": req.app.state.websocket_client.no_answer_last_message_time,
-            "no_answer_last_message": req.app.state.websocket_client.no_answer_last_message,
-            "last_try_connected_time": req.app.state.websocket_client.last_try_connected_time,
-            "last_connected_time": req.app.state.websocket_client.last_connected_time,
-            "connected": req.app.state.websocket_client.connected,
-            "disconnected_time": req.app.state.websocket_client.disconnected_time,
-            "disconnected_reason": req.app.state.websocket_client.disconnected_reason,
-            "disconnect_count": req.app.state.websocket_client.disconnect_count,
-        }
-        if not req.app.state.websocket_client.connected:
-            result["status"]["checkup_websocket"] = "error"
-    except Exception as exc:
-        result["info"]["checkup_websocket"]["error"] = str(exc)
-        result["status"]["checkup_websocket"] = "error"
 
-    # 5. Asterisk AMI
-    try:
-        ami = req.app.state.ami
-        result["info"]["checkup_ami"] = {
-            "connected_status": ami.connected,
-            "disconnect_count": ami.disconnect_count,
-        }
-        if not ami.connected:
-            result["status"]["checkup_ami"] = "error"
-    except Exception as exc:
-        result["info"]["checkup_ami"] = str(exc)
-        result["status"]["checkup_ami"] = "error"
+@router_probes.get("/api/checkup/ready")
+async def checkup_ready(pbx: Pbx):
+    """Readiness probe, from cached checkup: database and enabled ARI, AMI are available
 
-    log.info(result)
-    return JSONResponse(content=result)
+    Returns:
+        200 or 503 with status of every probe
+    """
+    checkup_service: Checkup = pbx.checkup
+    status = checkup_service.ready()
+    ready = bool(status) and all(value == "ok" for value in status.values())
+    return JSONResponse(
+        status_code=HTTP_200_OK if ready else HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "ok" if ready else "error", "checks": status},
+    )
@@ -0,0 +1,25 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import logging
+
+from fastapi import APIRouter, Depends, Request
+
+from dependencies.auth import verify_basic_auth
+from services.lifecycle import reload_config
+
+log = logging.getLogger("asterisk_agent")
+router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
+
+
+@router.post("/api/config/reload")
+async def config_reload(req: Request):
+    """Read .env again and apply it without restart (the same as SIGHUP).
+    Not valid config is not applied, old config is kept.
+
+    Returns:
+        names of changed settings
+    """
+    log.info("CONFIG RELOAD")
+    changed = await reload_config(req.app)
+    return {"changed": changed}
@@ -0,0 +1,55 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import logging
+
+from fastapi import APIRouter, Depends
+
+from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
+from exceptions.exceptions import BusinessError
+from services.contacts import Contacts
+
+log = logging.getLogger("asterisk_agent")
+router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
+
+
+def get_contacts(pbx) -> Contacts:
+    contacts: Contacts | None = pbx.contacts
+    if contacts is None:
+        raise BusinessError("Contacts are disabled (contacts_enable = 0)")
+    return contacts
+
+
+@router.get("/api/contacts/lookup")
+async def contacts_lookup(pbx: Pbx, number: str):
+    """Return normalized number and contact id of contacts_source
+
+    Arguments:
+        number -- phone number in any format
+
+    Returns:
+        number, normalized (E.164 or digits of extension), contact_id (null if not found)
+    """
+    log.info("CONTACTS LOOKUP")
+
+    normalized, contact_id = get_contacts(pbx).lookup(number)
+    return {"number": number, "normalized": normalized, "contact_id": contact_id}
+
+
+@router.post("/api/contacts/reload")
+async def contacts_reload(pbx: Pbx):
+    """Load contacts_source now
+
+    Raises:
+        BusinessError: source is not available or not valid, the old contacts are kept
+    """
+    log.info("CONTACTS RELOAD")
+
+    contacts = get_contacts(pbx)
+    try:
+        await contacts.load()
+    except Exception as exc:
+        log.exception("Contacts load error: %s", exc)
+        raise BusinessError(f"Contacts are not loaded: {exc}") from exc
+    return contacts.stats()
@@ -0,0 +1,90 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import logging
+
+from fastapi import APIRouter, Depends, Header
+
+from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
+from exceptions.exceptions import BusinessError
+from schemas.export_schema import ExportRequest
+from services.export import EXTENSIONS, MEDIA_TYPES, ExportJobs
+from services.streaming import file_range_response
+
+log = logging.getLogger("asterisk_agent")
+router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
+
+
+@router.post("/api/exports/")
+async def export_create(pbx: Pbx, body: ExportRequest):
+    """Start export of history range to file in background, without rows limit
+
+    Raises:
+        BusinessError: wrong range, too many jobs, parquet without pyarrow
+
+    Returns:
+        job, poll GET /api/exports/{id} until status is done
+    """
+    log.info("EXPORT %s %s - %s", body.kind, body.start_date, body.end_date)
+
+    exports: ExportJobs = pbx.exports
+    job = exports.submit(body.kind, body.format, body.start_date, body.end_date)
+    return job.as_dict()
+
+
+@router.get("/api/exports/")
+async def export_list(pbx: Pbx):
+    """Return export jobs"""
+    log.info("EXPORT LIST")
+
+    exports: ExportJobs = pbx.exports
+    return [job.as_dict() for job in exports.jobs.values()]
+
+
+@router.get("/api/exports/{job_id}")
+async def export_status(pbx: Pbx, job_id: str):
+    """Return export job: status (queued, running, done, error, cancelled),
+    progress 0-1 by exported time range, rows, size"""
+    log.info("EXPORT STATUS %s", job_id)
+
+    exports: ExportJobs = pbx.exports
+    return exports.get(job_id).as_dict()
+
+
+@router.get("/api/exports/{job_id}/download")
+async def export_download(
+    pbx: Pbx,
+    job_id: str,
+    range_header: str | None = Header(default=None, alias="Range"),
+    if_range: str | None = Header(default=None, alias="If-Range"),
+):
+    """Download file of finished export job, Range header resumes broken download
+
+    Raises:
+        BusinessError: job is not found or not finished
+    """
+    log.info("EXPORT DOWNLOAD %s %s", job_id, range_header or "")
+
+    exports: ExportJobs = pbx.exports
+    job = exports.get(job_id)
+    if job.status != "done":
+        raise BusinessError(f"Export job {job_id} is {job.status}")
+    return file_range_response(
+        job.path,
+        filename=f"{job.kind}-{job.start_date:%Y%m%d}-{job.end_date:%Y%m%d}.{EXTENSIONS[job.format]}",
+        media_type=MEDIA_TYPES[job.format],
+        etag=f"{job.id}-{job.size}",
+        range_header=range_header,
+        if_range=if_range,
+    )
+
+
+@router.delete("/api/exports/{job_id}")
+async def export_delete(pbx: Pbx, job_id: str):
+    """Cancel export job and remove its file"""
+    log.info("EXPORT DELETE %s", job_id)
+
+    exports: ExportJobs = pbx.exports
+    exports.delete(job_id)
+    return {"id": job_id, "status": "deleted"}
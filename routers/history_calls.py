@@ -7,9 +7,14 @@ from fastapi import APIRouter, Depends, Request
 from pydantic import AwareDatetime
 
 from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
 from exceptions.exceptions import BusinessError
 from schemas.config_schema import Id
-from services.database import MysqlStrategy, PostgresqlStrategy, SqliteStrategy
+from services.cdr_cache import CdrCache
+from services.contacts import Contacts
+from services.federation import cdr_time, history_sources, merge_sources
+from services.history_cache import HistoryCache
+from services.streaming import json_array_response, ndjson_response
 
 log = logging.getLogger("asterisk_agent")
 router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
@@ -17,34 +22,34 @@ router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
 
 @router.get("/api/calls/hisroty/uniqueid")
 async def calls_history_uniqueid(
-    req: Request,
+    pbx: Pbx,
     uniqueid: Id,
 ):
     log.info("HISTORY UNIQUEID")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    cdr_cache: CdrCache = pbx.cdr_cache
+    contacts: Contacts | None = pbx.contacts
 
-    return await connector_database.get_cdr_uniqueid_or_linkedid(uniqueid)
+    rows = await cdr_cache.get_cdr_uniqueid_or_linkedid(uniqueid)
+    return [contacts.enrich_row(row) for row in rows] if contacts else rows
 
 
 @router.get("/api/calls/hisroty/uniqueid_or_linkedid")
 async def calls_history_uniqueid_or_linkedid(
-    req: Request,
+    pbx: Pbx,
     uniqueid: Id,
 ):
     log.info("HISTORY UNIQUEID OR LINKEDID")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    cdr_cache: CdrCache = pbx.cdr_cache
+    contacts: Contacts | None = pbx.contacts
 
-    return await connector_database.get_cdr_uniqueid_or_linkedid(uniqueid)
+    rows = await cdr_cache.get_cdr_uniqueid_or_linkedid(uniqueid)
+    return [contacts.enrich_row(row) for row in rows] if contacts else rows
 
 
 @router.get("/api/calls/hisroty/")
-async def calls_history(req: Request, start_date: AwareDatetime, end_date: AwareDatetime):
+async def calls_history(pbx: Pbx, start_date: AwareDatetime, end_date: AwareDatetime):
     """
     Arguments:
         start_date -- start date
@@ -61,8 +66,36 @@ async def calls_history(req: Request, start_date: AwareDatetime, end_date: Aware
     if start_date >= end_date:
         raise BusinessError("The start date cannot be greater than or equal to the end date")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    history_cache: HistoryCache = pbx.history_cache
+    contacts: Contacts | None = pbx.contacts
 
-    return await connector_database.get_cdr(start_date, end_date)
+    rows = history_cache.iter_cdr(start_date, end_date)
+    return await json_array_response(contacts.enrich_rows(rows) if contacts else rows)
+
+
+@router.get("/api/calls/hisroty/federated")
+async def calls_history_federated(
+    req: Request, start_date: AwareDatetime, end_date: AwareDatetime, local: bool = False
+):
+    """Calls history of every PBX of this agent and of peer agents (history_peers),
+    merged in start time order
+
+    Arguments:
+        start_date -- start date
+        end_date -- end date
+        local -- only PBX of this agent (request of peer agent)
+
+    Raises:
+        BusinessError: The start date cannot be greater than or equal to the end date
+
+    Returns:
+        NDJSON, cdr with "pbx" per line, {"pbx", "error"} line for failed source
+    """
+    log.info("HISTORY FEDERATED")
+
+    if start_date >= end_date:
+        raise BusinessError("The start date cannot be greater than or equal to the end date")
+
+    state = req.app.state
+    sources = history_sources(state, "cdr", start_date, end_date, local)
+    return ndjson_response(merge_sources(sources, cdr_time, state.config.history_peer_timeout))
@@ -7,15 +7,18 @@ from fastapi import APIRouter, Depends, Request
 from pydantic import AwareDatetime
 
 from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
 from exceptions.exceptions import BusinessError
-from services.database import MysqlStrategy, PostgresqlStrategy, SqliteStrategy
+from services.federation import cel_time, history_sources, merge_sources
+from services.history_cache import HistoryCache
+from services.streaming import json_array_response, ndjson_response
 
 log = logging.getLogger("asterisk_agent")
 router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
 
 
 @router.get("/api/events/hisroty/")
-async def events_history(req: Request, start_date: AwareDatetime, end_date: AwareDatetime):
+async def events_history(pbx: Pbx, start_date: AwareDatetime, end_date: AwareDatetime):
     """Return events history
 
     Arguments:
@@ -33,8 +36,34 @@ async def events_history(req: Request, start_date: AwareDatetime, end_date: Awar
     if start_date >= end_date:
         raise BusinessError("The start date cannot be greater than or equal to the end date")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    history_cache: HistoryCache = pbx.history_cache
 
-    return await connector_database.get_cel(start_date, end_date)
+    return await json_array_response(history_cache.iter_cel(start_date, end_date))
+
+
+@router.get("/api/events/hisroty/federated")
+async def events_history_federated(
+    req: Request, start_date: AwareDatetime, end_date: AwareDatetime, local: bool = False
+):
+    """Events history of every PBX of this agent and of peer agents (history_peers),
+    merged in eventtime order
+
+    Arguments:
+        start_date -- start date
+        end_date -- end date
+        local -- only PBX of this agent (request of peer agent)
+
+    Raises:
+        BusinessError: The start date cannot be greater than or equal to the end date
+
+    Returns:
+        NDJSON, cel with "pbx" per line, {"pbx", "error"} line for failed source
+    """
+    log.info("EVENTS FEDERATED")
+
+    if start_date >= end_date:
+        raise BusinessError("The start date cannot be greater than or equal to the end date")
+
+    state = req.app.state
+    sources = history_sources(state, "cel", start_date, end_date, local)
+    return ndjson_response(merge_sources(sources, cel_time, state.config.history_peer_timeout))
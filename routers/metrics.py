@@ -0,0 +1,24 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import os
+
+from fastapi import APIRouter, Depends, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from dependencies.auth import verify_basic_auth
+
+router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
+
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus metrics.
+    With uvicorn --workers set PROMETHEUS_MULTIPROC_DIR env to collect metrics of all workers.
+    """
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
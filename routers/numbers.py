@@ -4,9 +4,10 @@
 import json
 import logging
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends
 
 from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
 from services.ari import Ari
 from services.database import MysqlStrategy, PostgresqlStrategy, SqliteStrategy
 
@@ -15,43 +16,37 @@ router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
 
 
 @router.get("/api/numbers/ring_groups/")
-async def ring_groups(req: Request):
+async def ring_groups(pbx: Pbx):
     """Return ring_groups"""
     log.info("RING GROUPS")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = pbx.connector_database
 
     return await connector_database.get_ring_groups()
 
 
 @router.get("/api/numbers/queues_config/")
-async def queues_config(req: Request):
+async def queues_config(pbx: Pbx):
     """Return queues_config"""
     log.info("QUEUES CONFIG")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = pbx.connector_database
 
     return await connector_database.get_queues_config()
 
 
 @router.get("/api/numbers/redirects/")
-async def redirects(req: Request):
+async def redirects(pbx: Pbx):
     """Return redirects"""
     log.info("REDIRECTS")
 
-    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = (
-        req.app.state.connector_database
-    )
+    connector_database: PostgresqlStrategy | MysqlStrategy | SqliteStrategy = pbx.connector_database
 
     return await connector_database.get_findmefollow()
 
 
 @router.get("/api/numbers/")
-async def numbers(req: Request):
+async def numbers(pbx: Pbx):
     """Return numbers (endpoints) Asterisk
 
     Returns:
@@ -59,7 +54,7 @@ async def numbers(req: Request):
     """
     log.info("NUMBERS")
 
-    ari: Ari = req.app.state.ari
+    ari: Ari = pbx.ari
     # answer already in json
     res = await ari.numbers()
     return json.loads(res)
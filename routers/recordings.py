@@ -6,11 +6,13 @@ import os
 import urllib.parse
 
 import aiofiles
-from fastapi import APIRouter, Depends, Request, Response
+from fastapi import APIRouter, Depends, Response
 
 from dependencies.auth import verify_basic_auth
+from dependencies.pbx import Pbx
 from exceptions.exceptions import BusinessError
 from schemas.config_schema import Config
+from services import metrics
 from services.ari import Ari
 
 log = logging.getLogger("asterisk_agent")
@@ -18,7 +20,7 @@ router = APIRouter(tags=["API"], dependencies=[Depends(verify_basic_auth)])
 
 
 @router.get("/api/call/recording/ari")
-async def call_recording_ari(req: Request, filename: str):
+async def call_recording_ari(pbx: Pbx, filename: str):
     """Return binary record of call, from ARI
     Arguments:
         filename -- filename
@@ -27,12 +29,14 @@ async def call_recording_ari(req: Request, filename: str):
     """
     log.info("RECORDING ARI")
 
-    ari: Ari = req.app.state.ari
-    return await ari.call_recording(filename)
+    ari: Ari = pbx.ari
+    recording = await ari.call_recording(filename)
+    metrics.pbx_metrics(pbx.config.pbx_name).recording_bytes_ari.inc(len(recording))
+    return recording
 
 
 @router.get("/api/call/recording")
-async def call_recording(req: Request, filename: str):
+async def call_recording(pbx: Pbx, filename: str):
     """Return binary record of call, from directly server folder
     Arguments:
         filename -- filename
@@ -41,7 +45,7 @@ async def call_recording(req: Request, filename: str):
     """
     log.info("RECORDING")
 
-    config: Config = req.app.state.config
+    config: Config = pbx.config
     path_file = ""
     log.info("Path recordings: %s", path_file)
 
@@ -56,6 +60,7 @@ async def call_recording(req: Request, filename: str):
 
     async with aiofiles.open(path_file, "rb") as file:
         recording = await file.read()
+    metrics.pbx_metrics(pbx.config.pbx_name).recording_bytes_file.inc(len(recording))
 
     return Response(
         headers={
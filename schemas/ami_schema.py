@@ -0,0 +1,35 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+from pydantic import BaseModel, Field
+
+
+class OriginateRequest(BaseModel):
+    """Click to call. Call channel and when it answers connect it to
+    exten@context (or application)."""
+
+    channel: str = Field(examples=["PJSIP/101"])
+    exten: str | None = Field(default=None, examples=["79111111111"])
+    context: str | None = Field(default=None, examples=["from-internal"])
+    priority: int = 1
+    application: str | None = None
+    data: str | None = None
+    caller_id: str | None = Field(default=None, examples=["CRM <101>"])
+    timeout: int = Field(default=30000, description="ms to wait for answer")
+    account: str | None = None
+    variables: dict[str, str] = {}
+
+
+class HangupRequest(BaseModel):
+    channel: str = Field(examples=["PJSIP/101-00000001"])
+    cause: int | None = None
+
+
+class RedirectRequest(BaseModel):
+    """Transfer channel to exten@context"""
+
+    channel: str = Field(examples=["PJSIP/101-00000001"])
+    exten: str
+    context: str
+    priority: int = 1
+    extra_channel: str | None = None
@@ -0,0 +1,17 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+from typing import Literal
+
+from pydantic import AwareDatetime, BaseModel, Field
+
+
+class ExportRequest(BaseModel):
+    """Export of calls (cdr) or events (cel) history of time range to file"""
+
+    kind: Literal["cdr", "cel"] = "cdr"
+    format: Literal["csv", "parquet"] = Field(
+        default="csv", description="csv - gzip CSV, parquet requires pyarrow"
+    )
+    start_date: AwareDatetime
+    end_date: AwareDatetime
@@ -0,0 +1,150 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import collections
+import contextlib
+import math
+import time
+
+from exceptions.exceptions import OverloadError
+from schemas.config_schema import Config
+from services import metrics
+
+# query classes, bulk is low priority lane of long range scans
+LANES = ("lookup", "range", "bulk")
+
+
+class QueryLane:
+    """Concurrency limit of one query class, waiting queries get slots in FIFO order"""
+
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        # moving average of seconds a query holds the slot
+        self.hold = 0.0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float):
+        """
+        Raises:
+            OverloadError: no free slot in timeout seconds
+        """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            # released slot is passed to the future (in_flight is already counted)
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise OverloadError(
+                f"Database is busy ({self.name} queries), try again later", self.retry_after()
+            ) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(0)
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+        self.admitted += 1
+
+    def release(self, held: float):
+        if held:
+            self.hold = held if not self.hold else self.hold * 0.9 + held * 0.1
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        """Pass free slots to waiting queries (after release or limit increase)"""
+        while self._waiters and self.in_flight < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                self.in_flight += 1
+
+    def retry_after(self) -> int:
+        """Seconds until queued queries are expected to finish"""
+        return max(1, math.ceil(self.hold * (self.waiting + 1) / self.limit))
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "hold_seconds": round(self.hold, 4),
+        }
+
+
+class Admission:
+    """Admission control of database queries.
+
+    Queries are classified: lookup (by id, last row, schema), range (history of
+    time range) and bulk (range longer than db_bulk_range seconds or export).
+    Every class has own concurrency limit, so a few dashboards reading big
+    ranges do not take connections of uniqueid lookups and do not saturate the
+    database where Asterisk writes CDR. A query waits for a slot no more than
+    db_queue_timeout seconds, then OverloadError (HTTP 503 with Retry-After).
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.metrics = metrics.pbx_metrics(config.pbx_name)
+        self.lanes = {lane: QueryLane(lane, self.limit(config, lane)) for lane in LANES}
+
+    @staticmethod
+    def limit(config: Config, lane: str) -> int:
+        return getattr(config, f"db_concurrency_{lane}")
+
+    def set_config(self, config: Config):
+        """Apply changed limits, running queries above new limit are not stopped"""
+        self.config = config
+        for name, lane in self.lanes.items():
+            lane.limit = self.limit(config, name)
+            lane.wake()
+
+    def classify(self, values: dict) -> str:
+        """Query class by parameters: range cost is its length"""
+        start_date, end_date = values.get("start_date"), values.get("end_date")
+        if start_date is None or end_date is None:
+            return "lookup"
+        if (end_date - start_date).total_seconds() > self.config.db_bulk_range:
+            return "bulk"
+        return "range"
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane: str):
+        """Hold slot of query class while query runs
+
+        Raises:
+            OverloadError: no free slot in db_queue_timeout seconds
+        """
+        query_lane = self.lanes[lane]
+        started = time.perf_counter()
+        try:
+            await query_lane.acquire(self.config.db_queue_timeout)
+        except OverloadError:
+            self.metrics.db_rejected[lane].inc()
+            raise
+        admitted = time.perf_counter()
+        self.metrics.db_queue_wait[lane].observe(admitted - started)
+        try:
+            yield
+        finally:
+            query_lane.release(time.perf_counter() - admitted)
+
+    def stats(self) -> dict:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
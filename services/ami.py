@@ -1,15 +1,25 @@
 # Copyright 2024 Artem Shurshilov
 # Apache License Version 2.0
 
+import asyncio
 import logging
 import posixpath
 
-import requests
-from panoramisk import Manager
-
+from exceptions.exceptions import AmiError
+from schemas.ami_schema import HangupRequest, OriginateRequest, RedirectRequest
 from schemas.config_schema import AmiConfig
+from services import metrics
+from services.ami_client import AmiClient
+from services.cache import SingleFlight, TTLCache
+from services.capture import EventCapture
+from services.channels import AMI_EVENTS as CHANNELS_EVENTS
+from services.channels import ChannelStore
+from services.contacts import Contacts
+from services.dedup import EventDeduplicator
+from services.webhook import WebhookSender
 
-log = logging.getLogger("asterisk_agent")
+log = logging.getLogger("asterisk_agent.ami")
+log_events = logging.getLogger("asterisk_agent.ami.events")
 
 
 class Ami:
@@ -18,72 +28,197 @@ class Ami:
     def __init__(
         self,
         ami_config: AmiConfig,
-        api_key_base64: str,
+        webhook: WebhookSender,
         webhook_url: str,
+        dedup: EventDeduplicator | None = None,
+        pbx: str = "default",
+        capture: EventCapture | None = None,
+        channels: ChannelStore | None = None,
+        contacts: Contacts | None = None,
     ) -> None:
         super().__init__()
+        self.dedup = dedup
+        self.capture = capture
+        self.channels = channels
+        self.contacts = contacts
+        self.metrics = metrics.pbx_metrics(pbx)
         self.ami_config = ami_config
-        self.api_key_base64 = api_key_base64
+        self.webhook = webhook
         self.webhook_url = webhook_url
         self.connected = False
         self.disconnect_count = 0
+        self.client = AmiClient(
+            host=self.ami_config.host,
+            port=self.ami_config.port,
+            username=self.ami_config.login,
+            secret=self.ami_config.password,
+            events_used=self.subscribed_events(),
+            on_connect=self.on_connect,
+            on_disconnect=self.on_disconnect,
+            ping_interval=5,
+            ping_timeout=5,
+        )
+        # read only actions: identical concurrent requests share one AMI action,
+        # list responses are cached for a short time
+        self.single_flight = SingleFlight()
+        self.cache = TTLCache(maxsize=256, ttl=self.ami_config.cache_ttl)
 
     async def start_catch_events(self):
+        """Keep AMI connection and send events to webhook until cancelled"""
+        log.info("AMI create async task...")
+        client_task = asyncio.create_task(self.client.run())
         try:
-            self.client = Manager(
-                host=self.ami_config.host,
-                port=self.ami_config.port,
-                username=self.ami_config.login,
-                secret=self.ami_config.password,
-                on_login=self.on_login,
-                on_connect=self.on_connect,
-                on_disconnect=self.on_disconnect,
-                ping_delay=5,
-                ping_interval=5,
-                reconnect_timeout=2,
-            )
-
-            log.info("AMI create async task...")
-            for event in self.ami_config.events_used:
-                log.info("AMI register event: %s", event)
-                self.client.register_event(event, self.send_webhook_event)
-
-            return self.client.connect(run_forever=False, on_shutdown=self.on_shutdown)
-
-        except Exception as exc:
-            log.exception("AMI start error: %s", exc)
-
-    def on_login(self, mngr):
-        log.info("AMI succesfull login")
-
-    def on_disconnect(self, mngr, exc):
+            async for event in self.client.events():
+                if self.capture:
+                    self.capture.write("ami", event)
+                await self.process_event(event)
+        except asyncio.CancelledError:
+            log.info("AMI shutdown...")
+        finally:
+            client_task.cancel()
+
+    async def process_event(self, event: dict):
+        """Filter event and send it to webhook
+
+        Arguments:
+            event -- AMI event
+        """
+        event_type = event.get("Event")
+        self.metrics.ami_events_received[event_type].inc()
+        # before webhook filters: Hangup releases the channel even when it is ignored
+        if self.channels:
+            self.channels.on_ami_event(event)
+        if event_type in self.ami_config.events_ignore:
+            self.metrics.ami_events_filtered[event_type].inc()
+            return
+        if self.ami_config.events_used and event_type not in self.ami_config.events_used:
+            # received for channels state only
+            self.metrics.ami_events_filtered[event_type].inc()
+            return
+        if self.dedup and self.dedup.is_duplicate("ami", event):
+            self.metrics.ami_events_filtered[event_type].inc()
+            return
+        if self.contacts:
+            event = self.contacts.enrich_ami(event)
+        if await self.send_webhook_event(event):
+            self.metrics.ami_events_delivered[event_type].inc()
+
+    async def set_config(
+        self,
+        ami_config: AmiConfig,
+        webhook_url: str,
+        dedup: EventDeduplicator | None,
+    ):
+        """Apply changed events filter and webhook without reconnect"""
+        self.ami_config = ami_config
+        self.webhook_url = webhook_url
+        self.dedup = dedup
+        self.cache.ttl = ami_config.cache_ttl
+        events = self.subscribed_events()
+        if set(events) != self.client.events_used:
+            await self.client.set_events_used(events)
+
+    def subscribed_events(self) -> list[str]:
+        """Events filter of AMI connection: events_used of webhook and events of
+        channels state, empty - all events"""
+        events = list(self.ami_config.events_used)
+        if events and self.channels:
+            events.extend(CHANNELS_EVENTS)
+        return list(dict.fromkeys(events))
+
+    def on_disconnect(self, exc):
         log.info("AMI disconnect, error: %s", exc)
         self.connected = False
         self.disconnect_count += 1
 
-    def on_connect(self, mngr):
+    def on_connect(self):
         log.info("AMI succesfull connected")
         self.connected = True
 
-    async def on_shutdown(self, mngr):
-        log.info("AMI shutdown...")
-
-    def send_webhook_event(self, manager, payload: dict):
+    async def send_webhook_event(self, payload: dict) -> bool:
         """send asterisk ami event to customer webhook url
 
         Arguments:
             payload -- asterisk event
+
+        Returns:
+            True if delivered
+        """
+        log_events.info("AMI event: %s", payload)
+        return await self.webhook.send("ami", posixpath.join(self.webhook_url, "ami"), payload)
+
+    async def send_action(self, action: dict, timeout: float = 10) -> dict:
+        """Send action over the agent AMI connection
+
+        Raises:
+            AmiError: AMI not connected or action error
         """
+        if not self.connected:
+            raise AmiError("AMI not connected")
         try:
-            log.info("AMI event:")
-            log.info(payload)
-            res = requests.post(
-                posixpath.join(self.webhook_url, "ami"),
-                json=dict(payload),
-                headers={
-                    "Authorization": f"Basic {self.api_key_base64}",
-                },
-            )
-            res.raise_for_status()
-        except Exception as exc:
-            log.exception("Unknown AMI send_webhook_event error: %s", exc)
+            return await self.client.send_action(action, timeout=timeout)
+        except (ConnectionError, asyncio.TimeoutError) as exc:
+            raise AmiError(f"AMI action {action.get('Action')} failed: {exc!r}") from exc
+
+    async def send_action_cached(self, action: dict) -> dict:
+        """Send read only action, coalesce identical concurrent actions
+        and cache response for ami_cache_ttl seconds"""
+        key = tuple(sorted((k, f"{v}") for k, v in action.items()))
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.single_flight.do(key, lambda: self.send_action(action))
+            self.cache.set(key, response)
+        return response
+
+    async def originate(self, request: OriginateRequest) -> dict:
+        action = {
+            "Action": "Originate",
+            "Channel": request.channel,
+            "Priority": request.priority,
+            "Timeout": request.timeout,
+            # do not wait for answer, result comes as OriginateResponse event
+            "Async": "true",
+        }
+        if request.application:
+            action["Application"] = request.application
+            if request.data is not None:
+                action["Data"] = request.data
+        else:
+            if not request.exten or not request.context:
+                raise AmiError("exten and context or application are required")
+            action["Exten"] = request.exten
+            action["Context"] = request.context
+        if request.caller_id:
+            action["CallerID"] = request.caller_id
+        if request.account:
+            action["Account"] = request.account
+        if request.variables:
+            action["Variable"] = [f"{key}={value}" for key, value in request.variables.items()]
+        return await self.send_action(action)
+
+    async def hangup(self, request: HangupRequest) -> dict:
+        action = {"Action": "Hangup", "Channel": request.channel}
+        if request.cause is not None:
+            action["Cause"] = request.cause
+        return await self.send_action(action)
+
+    async def redirect(self, request: RedirectRequest) -> dict:
+        action = {
+            "Action": "Redirect",
+            "Channel": request.channel,
+            "Exten": request.exten,
+            "Context": request.context,
+            "Priority": request.priority,
+        }
+        if request.extra_channel:
+            action["ExtraChannel"] = request.extra_channel
+        return await self.send_action(action)
+
+    async def queue_status(self, queue: str | None = None) -> dict:
+        action = {"Action": "QueueStatus"}
+        if queue:
+            action["Queue"] = queue
+        return await self.send_action_cached(action)
+
+    async def core_show_channels(self) -> dict:
+        return await self.send_action_cached({"Action": "CoreShowChannels"})
@@ -0,0 +1,328 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import itertools
+import logging
+import random
+from typing import AsyncIterator, Callable
+
+from exceptions.exceptions import AmiError
+
+log = logging.getLogger("asterisk_agent.ami")
+
+# end of AMI message
+AMI_EOM = b"\r\n\r\n"
+# max size of one AMI message (StreamReader buffer limit)
+AMI_READ_LIMIT = 1024 * 1024
+RECONNECT_MIN_TIMEOUT = 0.5
+
+
+def parse_message(data: bytes) -> dict:
+    """Parse one AMI message "Key: Value\\r\\nKey: Value\\r\\n\\r\\n".
+    The frame is decoded to str once and split into line strings, lines are
+    not decoded one by one.
+
+    Arguments:
+        data -- message bytes with trailing \\r\\n\\r\\n
+
+    Returns:
+        message dict, repeated keys (ChanVariable, Output) are collected to list
+    """
+    message = {}
+    for line in data.decode("utf-8", "replace").split("\r\n"):
+        if not line:
+            continue
+        key, sep, value = line.partition(": ")
+        if not sep:
+            key, sep, value = line.partition(":")
+            if not sep:
+                # old "Response: Follows" command output lines
+                key, value = "Output", line
+        if key in message:
+            prev = message[key]
+            if isinstance(prev, list):
+                prev.append(value)
+            else:
+                message[key] = [prev, value]
+        else:
+            message[key] = value
+    return message
+
+
+def build_action(action: dict) -> bytes:
+    """Serialize AMI action, list values are sent as repeated keys (Variable)
+
+    Raises:
+        AmiError: value contains line break (AMI header injection)
+    """
+    lines = []
+    for key, value in action.items():
+        for item in value if isinstance(value, (list, tuple)) else (value,):
+            item = f"{item}"
+            if "\r" in item or "\n" in item:
+                raise AmiError(f"Invalid AMI value of {key}")
+            lines.append(f"{key}: {item}\r\n")
+    lines.append("\r\n")
+    return "".join(lines).encode("utf-8")
+
+
+class AmiClient:
+    """Asyncio AMI (Asterisk Manager Interface) client.
+
+    One TCP connection. Actions are pipelined: every action gets its own ActionID
+    and the response is matched by it, so many coroutines can send actions
+    concurrently without waiting for each other. Responses with EventList
+    (CoreShowChannels, QueueStatus) are collected to response["Events"].
+    Events are put to bounded queue and read by events() async iterator.
+    Connection is checked by Ping and restored with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        secret: str,
+        events_used: list[str] | None = None,
+        ping_interval: float = 5.0,
+        ping_timeout: float = 5.0,
+        reconnect_timeout: float = 30.0,
+        queue_size: int = 10000,
+        on_connect: Callable[[], None] | None = None,
+        on_disconnect: Callable[[Exception | None], None] | None = None,
+    ) -> None:
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.username = username
+        self.secret = secret
+        self.events_used = set(events_used or [])
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reconnect_timeout = reconnect_timeout
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+
+        self.connected = False
+        self.banner = ""
+        self.events_dropped = 0
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self._closed = False
+        self._action_ids = itertools.count(1)
+        self._action_prefix = f"agent-{id(self):x}"
+        self._pending: dict[str, asyncio.Future] = {}
+        self._lists: dict[str, list[dict]] = {}
+        self._events: asyncio.Queue = asyncio.Queue(queue_size)
+
+    async def connect(self):
+        """Open connection, read banner and login"""
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, limit=AMI_READ_LIMIT
+        )
+        self.banner = (await self.reader.readline()).decode("utf-8", "replace").strip()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+        await self.send_action(
+            {
+                "Action": "Login",
+                "Username": self.username,
+                "Secret": self.secret,
+                "Events": "on",
+            }
+        )
+        self.connected = True
+        log.info("AMI login %s", self.banner)
+
+        # ask Asterisk to send only used events, not supported by old versions
+        for event in sorted(self.events_used):
+            try:
+                await self.send_action(
+                    {"Action": "Filter", "Operation": "Add", "Filter": f"Event: {event}"}
+                )
+            except AmiError as exc:
+                log.info("AMI event filter not applied: %s", exc.detail)
+                break
+
+        if self.on_connect:
+            self.on_connect()
+
+    async def run(self):
+        """Keep connection: connect, ping and reconnect with backoff until close()"""
+        delay = RECONNECT_MIN_TIMEOUT
+        while not self._closed:
+            error = None
+            try:
+                await self.connect()
+                delay = RECONNECT_MIN_TIMEOUT
+                await self._keepalive()
+            except asyncio.CancelledError:
+                await self.close()
+                raise
+            except Exception as exc:
+                error = exc
+                log.warning("AMI connection error: %s", exc)
+            await self._disconnect(error)
+            if self._closed:
+                break
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.reconnect_timeout)
+
+    async def close(self):
+        """Logoff and close connection, run() will not reconnect"""
+        self._closed = True
+        if self.connected:
+            try:
+                await self.send_action({"Action": "Logoff"}, timeout=1)
+            except Exception:
+                pass
+        await self._disconnect()
+
+    async def send_action(self, action: dict, timeout: float = 10.0) -> dict:
+        """Send action and wait its response, safe to call concurrently
+
+        Arguments:
+            action -- AMI action {"Action": "QueueStatus", ...}
+            timeout -- response timeout in seconds
+
+        Raises:
+            AmiError: Asterisk returns "Response: Error"
+            ConnectionError: not connected or connection lost
+            asyncio.TimeoutError: no response in timeout
+
+        Returns:
+            response dict, for event lists events are in response["Events"]
+        """
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("AMI not connected")
+
+        action_id = f"{self._action_prefix}-{next(self._action_ids)}"
+        future = asyncio.get_running_loop().create_future()
+        self._pending[action_id] = future
+        try:
+            self.writer.write(build_action({**action, "ActionID": action_id}))
+            await self.writer.drain()
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(action_id, None)
+            self._lists.pop(action_id, None)
+
+        if response.get("Response") == "Error":
+            raise AmiError(response.get("Message", "AMI action error"))
+        return response
+
+    async def set_events_used(self, events_used: list[str]):
+        """Change events filter, without reconnect when possible"""
+        old = self.events_used
+        self.events_used = set(events_used)
+        if not self.connected:
+            return
+        if old and not self.events_used:
+            # Asterisk filters can not be removed, reconnect without them
+            self.writer.close()
+            return
+        for event in sorted(self.events_used - old):
+            try:
+                await self.send_action(
+                    {"Action": "Filter", "Operation": "Add", "Filter": f"Event: {event}"}
+                )
+            except AmiError as exc:
+                log.info("AMI event filter not applied: %s", exc.detail)
+                break
+
+    async def events(self) -> AsyncIterator[dict]:
+        """Iterate over received events, survives reconnects"""
+        while True:
+            yield await self._events.get()
+
+    async def _keepalive(self):
+        """Return when connection is lost or Asterisk does not answer to Ping"""
+        while True:
+            done, _ = await asyncio.wait({self._reader_task}, timeout=self.ping_interval)
+            if done:
+                return
+            try:
+                await self.send_action({"Action": "Ping"}, timeout=self.ping_timeout)
+            except (asyncio.TimeoutError, ConnectionError, AmiError) as exc:
+                log.warning("AMI ping failed: %r", exc)
+                return
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.readuntil(AMI_EOM)
+                self._dispatch(parse_message(data))
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            log.info("AMI connection closed: %r", exc)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            log.exception("AMI read error: %s", exc)
+        finally:
+            self._fail_pending()
+
+    def _dispatch(self, message: dict):
+        action_id = message.get("ActionID")
+        if action_id is not None and action_id in self._pending:
+            items = self._lists.get(action_id)
+            if items is not None:
+                if message.get("EventList") == "Complete" or (
+                    message.get("Event", "").endswith("Complete")
+                ):
+                    response = items[0]
+                    response["Events"] = items[1:]
+                    self._resolve(action_id, response)
+                else:
+                    items.append(message)
+                return
+            if "Response" in message:
+                if message.get("EventList") == "start":
+                    self._lists[action_id] = [message]
+                else:
+                    self._resolve(action_id, message)
+                return
+
+        if "Event" not in message:
+            return
+        if self.events_used and message["Event"] not in self.events_used:
+            return
+        try:
+            self._events.put_nowait(message)
+        except asyncio.QueueFull:
+            self.events_dropped += 1
+
+    def _resolve(self, action_id: str, response: dict):
+        future = self._pending.pop(action_id)
+        self._lists.pop(action_id, None)
+        if not future.done():
+            future.set_result(response)
+
+    def _fail_pending(self):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("AMI connection lost"))
+        self._pending.clear()
+        self._lists.clear()
+
+    async def _disconnect(self, error: Exception | None = None):
+        was_connected = self.connected
+        self.connected = False
+        if self._reader_task:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self._fail_pending()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+        if was_connected and self.on_disconnect:
+            self.on_disconnect(error)
@@ -7,7 +7,7 @@ import urllib.parse
 
 import httpx
 
-log = logging.getLogger("asterisk_agent")
+log = logging.getLogger("asterisk_agent.ari")
 
 
 class Ari:
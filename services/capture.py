@@ -0,0 +1,253 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Capture of ARI/AMI event stream and its replay.
+
+Capture file is gzip of JSON lines {"t": monotonic seconds, "source": "ari" or
+"ami", "frame": ARI websocket text or AMI event}. Files roll after
+capture_file_size bytes of lines, only last capture_files files are kept.
+
+Replay feeds capture files through the same filter/dedup/webhook pipeline as
+live events, with settings of .env (webhook_url, events filters...):
+
+    python -m services.capture captures/default-*.jsonl.gz --speed 10
+"""
+
+import argparse
+import asyncio
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Iterator
+
+from starlette.datastructures import State
+
+from schemas.config_schema import Config
+
+log = logging.getLogger("asterisk_agent")
+
+_STOP = object()
+
+
+class EventCapture:
+    """Append raw ARI/AMI frames to compressed rolling files.
+
+    Frames are put to queue in event loop thread, compressed and written by
+    background thread, file is flushed every second without frames, so capture
+    is readable up to last second while agent is running.
+    """
+
+    def __init__(
+        self, directory: str, prefix: str, file_size: int = 64 * 1024 * 1024, files: int = 10
+    ) -> None:
+        """
+        Arguments:
+            directory -- folder of capture files, created if missing
+            prefix -- file name prefix (PBX name)
+            file_size -- bytes of JSON lines in one file before next file
+            files -- capture files kept, older are removed
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.file_size = file_size
+        self.files = files
+        self.frames = 0
+        self.file_name = ""
+        self.error = ""
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, name="capture", daemon=True)
+        self._thread.start()
+
+    def write(self, source: str, frame: str | dict):
+        """Capture frame, does not block
+
+        Arguments:
+            source -- ari or ami
+            frame -- ARI websocket text or AMI event, must not be changed after the call
+        """
+        self._queue.put((time.monotonic(), source, frame))
+
+    def close(self):
+        """Write queued frames and close file"""
+        self._queue.put(_STOP)
+        self._thread.join(5)
+
+    def stats(self) -> dict:
+        return {"file": self.file_name, "frames": self.frames, "error": self.error}
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.prefix}-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}.jsonl.gz"
+        self.file_name = os.path.join(self.directory, name)
+        paths = sorted(glob.glob(os.path.join(self.directory, f"{self.prefix}-*.jsonl.gz")))
+        for path in paths[: max(0, len(paths) - self.files + 1)]:
+            os.remove(path)
+        return gzip.open(self.file_name, "wb", compresslevel=6)
+
+    def _write_loop(self):
+        file = None
+        written = 0
+        dirty = False
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                if dirty and file:
+                    try:
+                        file.flush()
+                    except Exception as exc:
+                        file = self._discard(file, exc)
+                dirty = False
+                continue
+            if item is _STOP:
+                break
+            monotonic, source, frame = item
+            line = json.dumps({"t": monotonic, "source": source, "frame": frame}) + "\n"
+            data = line.encode()
+            try:
+                if file is None or written >= self.file_size:
+                    if file:
+                        file.close()
+                    file = self._open()
+                    written = 0
+                file.write(data)
+                written += len(data)
+                dirty = True
+                self.frames += 1
+                self.error = ""
+            except Exception as exc:
+                # disk full or not writable, frames are lost until next success
+                file = self._discard(file, exc)
+                dirty = False
+        if file:
+            self._discard(file, None)
+
+    def _discard(self, file, exc: Exception | None) -> None:
+        """Close file after write error (or at stop), errors of close are ignored
+
+        Returns:
+            None, the next frame opens new file
+        """
+        if exc is not None:
+            self.error = f"{exc!r}"
+        if file:
+            try:
+                file.close()
+            except Exception as close_exc:
+                log.warning("Capture file %s is not closed: %r", self.file_name, close_exc)
+        return None
+
+
+def create_capture(config: Config) -> EventCapture | None:
+    if not config.capture_enable:
+        return None
+    return EventCapture(
+        directory=config.capture_dir,
+        prefix=config.pbx_name,
+        file_size=config.capture_file_size,
+        files=config.capture_files,
+    )
+
+
+def read_capture(paths: list[str]) -> Iterator[dict]:
+    """Records of capture files in given order, truncated file end (agent was
+    killed) is skipped"""
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            try:
+                for line in file:
+                    if line.endswith("\n"):
+                        yield json.loads(line)
+            except (EOFError, gzip.BadGzipFile) as exc:
+                log.warning("Capture file %s is truncated: %r", path, exc)
+
+
+async def replay(state, records: Iterator[dict], speed: float = 1, sources=("ari", "ami")) -> dict:
+    """Feed captured frames through ARI/AMI events pipeline of PBX
+
+    Arguments:
+        state -- PBX state with websocket_client and ami
+        records -- capture records
+        speed -- 1 - real time, N - N times faster, 0 - max speed
+        sources -- replayed sources
+
+    Returns:
+        events count, seconds, events_per_sec, max_lag (seconds behind schedule)
+    """
+    events = 0
+    max_lag = 0.0
+    previous = None
+    due = 0.0
+    started = time.monotonic()
+    for record in records:
+        source = record["source"]
+        if source not in sources:
+            continue
+        if speed and previous is not None:
+            # capture of several agent runs: monotonic time restarts, no pause
+            due += max(0.0, record["t"] - previous) / speed
+            lag = time.monotonic() - started - due
+            if lag < 0:
+                await asyncio.sleep(-lag)
+            max_lag = max(max_lag, lag)
+        previous = record["t"]
+        frame = record["frame"]
+        if source == "ari":
+            await state.websocket_client.process_event(json.loads(frame), frame)
+        else:
+            await state.ami.process_event(frame)
+        events += 1
+    await state.websocket_client.lanes.join()
+    seconds = time.monotonic() - started
+    return {
+        "events": events,
+        "seconds": round(seconds, 3),
+        "events_per_sec": round(events / seconds, 1) if seconds else 0,
+        "max_lag": round(max_lag, 3),
+    }
+
+
+async def main():
+    # imported here: lifecycle imports websocket and ami, which import this module
+    from services.lifecycle import create_websocket_client, init_pbx, stop_pbx
+    from services.logger import setup_logging
+
+    parser = argparse.ArgumentParser(description="Replay captured ARI/AMI events")
+    parser.add_argument("paths", nargs="+", help="capture files, in time order")
+    parser.add_argument("--speed", type=float, default=1, help="1 - real time, 0 - max speed")
+    parser.add_argument("--pbx", help="PBX of .env pbx_list, main PBX by default")
+    parser.add_argument("--source", choices=("ari", "ami"), action="append")
+    args = parser.parse_args()
+
+    config = Config()  # type: ignore
+    config = config.pbx_configs()[args.pbx or config.pbx_name]
+    # replayed events must not be captured again
+    config = config.model_copy(update={"capture_enable": 0})
+    setup_logging(config)
+    state = State()
+    await init_pbx(state, config)
+    state.websocket_client = create_websocket_client(
+        config,
+        state.webhook,
+        state.dedup,
+        cdr_cache=state.cdr_cache,
+        channels=state.channels,
+        contacts=state.contacts,
+    )
+    try:
+        result = await replay(
+            state, read_capture(args.paths), args.speed, tuple(args.source or ("ari", "ami"))
+        )
+    finally:
+        await stop_pbx(state)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
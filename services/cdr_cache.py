@@ -0,0 +1,132 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import logging
+
+from schemas.config_schema import Config
+from services.cache import SingleFlight, TTLCache
+
+log = logging.getLogger("asterisk_agent")
+
+# prewarm attempts after hangup, delay doubles: CDR is written when the whole call ends
+PREWARM_ATTEMPTS = 3
+# prewarm event, received even when not in ari_events_used
+ARI_EVENTS = ("ChannelDestroyed",)
+
+
+class CdrCache:
+    """Read-through cache of uniqueid or linkedid CDR lookups.
+
+    CRM asks CDR of every finished call, often several times from different
+    agents. Found rows are kept cdr_cache_ttl seconds (LRU, cdr_cache_size
+    entries), empty result (CDR is not written yet) only cdr_cache_negative_ttl
+    seconds. Concurrent identical lookups share one query. ARI ChannelDestroyed
+    prewarms the entry shortly after hangup, so CRM request is served from memory.
+    """
+
+    def __init__(self, state) -> None:
+        """
+        Arguments:
+            state -- app.state with config and connector_database
+        """
+        super().__init__()
+        self.state = state
+        config: Config = state.config
+        self.cache = TTLCache(maxsize=config.cdr_cache_size, ttl=config.cdr_cache_ttl)
+        self.single_flight = SingleFlight()
+        self.prewarmed = 0
+        self.negative = 0
+        self._prewarm_tasks: dict[str, asyncio.Task] = {}
+
+    def set_config(self, config: Config):
+        self.cache.maxsize = config.cdr_cache_size
+        self.cache.ttl = config.cdr_cache_ttl
+        if not config.cdr_cache_enable:
+            self.clear()
+
+    def clear(self):
+        """Drop all entries, database was changed"""
+        self.cache.clear()
+        for task in self._prewarm_tasks.values():
+            task.cancel()
+        self._prewarm_tasks.clear()
+
+    async def fetch(self, uniqueid: str) -> list:
+        """Query database (shared by concurrent callers) and cache result"""
+
+        async def query():
+            rows = await self.state.connector_database.get_cdr_uniqueid_or_linkedid(uniqueid)
+            config: Config = self.state.config
+            if rows:
+                self.cache.set(uniqueid, rows)
+            else:
+                self.negative += 1
+                self.cache.set(uniqueid, rows, ttl=config.cdr_cache_negative_ttl)
+            return rows
+
+        return await self.single_flight.do(uniqueid, query)
+
+    async def get_cdr_uniqueid_or_linkedid(self, uniqueid: str) -> list:
+        """CDR rows with uniqueid or linkedid
+
+        Arguments:
+            uniqueid -- channel uniqueid or call linkedid
+
+        Returns:
+            cdr rows, from cache when possible
+        """
+        if not self.state.config.cdr_cache_enable:
+            return await self.state.connector_database.get_cdr_uniqueid_or_linkedid(uniqueid)
+        rows = self.cache.get(uniqueid)
+        if rows is None:
+            rows = await self.fetch(uniqueid)
+        return rows
+
+    def prewarm(self, uniqueid: str | None):
+        """Fetch CDR of hung up channel in background, errors are only logged"""
+        config: Config = self.state.config
+        if not (uniqueid and config.cdr_cache_enable):
+            return
+        if uniqueid in self._prewarm_tasks or len(self._prewarm_tasks) >= config.cdr_cache_size:
+            return
+        task = asyncio.create_task(self._prewarm(uniqueid))
+        self._prewarm_tasks[uniqueid] = task
+        task.add_done_callback(lambda _: self._prewarm_tasks.pop(uniqueid, None))
+
+    async def _prewarm(self, uniqueid: str):
+        delay = self.state.config.cdr_cache_prewarm_delay
+        for _ in range(PREWARM_ATTEMPTS):
+            await asyncio.sleep(delay)
+            # stale entry (negative or without rows of the just finished leg)
+            self.cache.pop(uniqueid)
+            try:
+                if await self.fetch(uniqueid):
+                    self.prewarmed += 1
+                    return
+            except Exception as exc:
+                log.exception("CDR cache prewarm error: %s", exc)
+                return
+            delay *= 2
+
+    def on_event(self, event: dict):
+        """Prewarm CDR of ARI ChannelDestroyed event: channel and its call"""
+        if event.get("type") != "ChannelDestroyed":
+            return
+        channel = event.get("channel") or {}
+        uniqueid = channel.get("id")
+        self.prewarm(uniqueid)
+        linkedid = event.get("linkedid") or channel.get("linkedid")
+        if linkedid and linkedid != uniqueid:
+            self.prewarm(linkedid)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.cache),
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "coalesced": self.single_flight.coalesced,
+            "negative": self.negative,
+            "prewarmed": self.prewarmed,
+            "prewarm_pending": len(self._prewarm_tasks),
+        }
@@ -0,0 +1,87 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import datetime
+import json
+
+# CEL event type -> ARI event type
+CEL_EVENTS = {
+    "CHAN_START": "ChannelCreated",
+    "ANSWER": "ChannelStateChange",
+    "HANGUP": "ChannelHangupRequest",
+    "CHAN_END": "ChannelDestroyed",
+    "BRIDGE_ENTER": "ChannelEnteredBridge",
+    "BRIDGE_EXIT": "ChannelLeftBridge",
+}
+
+
+def ari_timestamp(value) -> str:
+    """CEL eventtime (datetime or string from database) in ARI format"""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.astimezone()
+        return f"{value:%Y-%m-%dT%H:%M:%S}.{value.microsecond // 1000:03d}{value:%z}"
+    return f"{value}"
+
+
+def cel_extra(row: dict) -> dict:
+    """CEL extra column is JSON for HANGUP, BRIDGE_ENTER... events"""
+    extra = row.get("extra")
+    if not extra:
+        return {}
+    try:
+        extra = json.loads(extra)
+    except (TypeError, ValueError):
+        return {}
+    return extra if isinstance(extra, dict) else {}
+
+
+def cel_channel(row: dict, state: str = "Down") -> dict:
+    """ARI Channel object from CEL row"""
+    return {
+        "id": row.get("uniqueid"),
+        "name": row.get("channame") or "",
+        "state": state,
+        "caller": {"name": row.get("cid_name") or "", "number": row.get("cid_num") or ""},
+        "connected": {"name": "", "number": ""},
+        "accountcode": row.get("accountcode") or "",
+        "dialplan": {
+            "context": row.get("context") or "",
+            "exten": row.get("exten") or "",
+            "priority": 1,
+            "app_name": row.get("appname") or "",
+            "app_data": row.get("appdata") or "",
+        },
+        "creationtime": ari_timestamp(row.get("eventtime")),
+        "language": "",
+    }
+
+
+def cel_row_to_event(row: dict) -> dict | None:
+    """Convert CEL row to ARI like event
+
+    Arguments:
+        row -- CEL table row
+
+    Returns:
+        ARI event with "synthesized": True or None if CEL event has no ARI analog
+    """
+    event_type = CEL_EVENTS.get(row.get("eventtype"))
+    if event_type is None:
+        return None
+    extra = cel_extra(row)
+    state = "Up" if row.get("eventtype") in ("ANSWER", "BRIDGE_ENTER", "BRIDGE_EXIT") else "Down"
+    event = {
+        "type": event_type,
+        "timestamp": ari_timestamp(row.get("eventtime")),
+        "channel": cel_channel(row, state),
+        "linkedid": row.get("linkedid"),
+        "synthesized": True,
+    }
+    if event_type in ("ChannelHangupRequest", "ChannelDestroyed"):
+        event["cause"] = extra.get("hangupcause", 0)
+        if event_type == "ChannelDestroyed":
+            event["cause_txt"] = ""
+    elif event_type in ("ChannelEnteredBridge", "ChannelLeftBridge"):
+        event["bridge"] = {"id": extra.get("bridge_id", ""), "channels": []}
+    return event
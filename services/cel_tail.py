@@ -0,0 +1,189 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import posixpath
+import time
+
+from schemas.config_schema import Config
+from services import metrics
+
+log = logging.getLogger("asterisk_agent.cel")
+log_events = logging.getLogger("asterisk_agent.cel.events")
+
+
+def json_row(row: dict) -> dict:
+    """Database row to JSON serializable dict (datetime, Decimal to str)"""
+    return {
+        key: value if value is None or isinstance(value, (str, int, float)) else f"{value}"
+        for key, value in row.items()
+    }
+
+
+class CelTail:
+    """Events source from Asterisk cel table, for PBX without ARI/AMI access.
+
+    New rows are read incrementally after high-water mark (eventtime, id of last
+    sent row) by eventtime index range, the mark is saved to file after every batch,
+    so tailing continues after restart without duplicates and gaps.
+    Poll interval is min while rows come and doubles up to max while idle.
+    Settings are read from state.config on every poll (config reload).
+    """
+
+    def __init__(self, state) -> None:
+        """
+        Arguments:
+            state -- app.state with config and connector_database
+        """
+        super().__init__()
+        self.state = state
+        # eventtime as database returns it (datetime or str for sqlite)
+        self.eventtime: datetime.datetime | str | None = None
+        self.cel_id = 0
+        self.interval = 0.0
+        self.last_poll_time = ""
+        self.rows_count = 0
+        self.error = ""
+
+    @property
+    def metrics(self) -> metrics.PbxMetrics:
+        return metrics.pbx_metrics(self.state.config.pbx_name)
+
+    def load_mark(self, path: str, dialect: str) -> bool:
+        """Read mark of state file, eventtime has type of the saved one, so
+        rows of the mark eventtime compare equal to it
+
+        Arguments:
+            path -- state file
+            dialect -- database dialect, for state files without eventtime type
+        """
+        try:
+            with open(path, encoding="utf-8") as file:
+                mark = json.load(file)
+            self.eventtime, self.cel_id = mark["eventtime"], int(mark["id"])
+            # sqlite returns text as stored, e.g. "...10:00:00.5" is not str() of datetime
+            if mark.get("datetime", dialect != "sqlite"):
+                # drivers with binary protocol (asyncpg) do not accept str for timestamp
+                self.eventtime = datetime.datetime.fromisoformat(self.eventtime)
+            return True
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError, TypeError) as exc:
+            log.error("CEL tail state file %s is broken, start from last event: %s", path, exc)
+            return False
+
+    @staticmethod
+    def write_mark(path: str, mark: dict):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(mark, file)
+        os.replace(tmp_path, path)
+
+    async def save_mark(self, path: str):
+        """Write mark to state file, file write does not block event loop"""
+        mark = {
+            # str() of datetime is read back by fromisoformat
+            "eventtime": f"{self.eventtime}",
+            "id": self.cel_id,
+            "datetime": isinstance(self.eventtime, datetime.datetime),
+        }
+        await asyncio.to_thread(self.write_mark, path, mark)
+
+    async def init_mark(self):
+        """Mark from state file, or last event in table (only new events are sent)"""
+        config: Config = self.state.config
+        if await asyncio.to_thread(self.load_mark, config.cel_tail_state_file, config.db_dialect):
+            return
+        rows = await self.state.connector_database.get_cel_last()
+        if rows:
+            self.eventtime, self.cel_id = rows[0]["eventtime"], rows[0]["id"]
+        else:
+            self.eventtime, self.cel_id = datetime.datetime(1970, 1, 1), 0
+        await self.save_mark(config.cel_tail_state_file)
+
+    async def send_webhook_event(self, payload: dict) -> bool:
+        """send CEL row to customer webhook url/cel
+
+        Arguments:
+            payload -- CEL row
+
+        Returns:
+            True if delivered
+        """
+        config: Config = self.state.config
+        return await self.state.webhook.send(
+            "cel", posixpath.join(f"{config.webhook_url}", "cel"), payload
+        )
+
+    async def poll(self) -> int:
+        """Read and send one batch of new rows
+
+        Returns:
+            rows count
+        """
+        config: Config = self.state.config
+        rows = await self.state.connector_database.get_cel_since(
+            self.eventtime, self.cel_id, config.cel_tail_batch
+        )
+        if not rows:
+            return 0
+        for row in rows:
+            event_type = row.get("eventtype")
+            self.metrics.cel_events_received[event_type].inc()
+            self.eventtime, self.cel_id = row["eventtime"], row["id"]
+            if event_type in config.cel_events_ignore or (
+                config.cel_events_used and event_type not in config.cel_events_used
+            ):
+                self.metrics.cel_events_filtered[event_type].inc()
+                continue
+            payload = json_row(row)
+            log_events.info("Received: %s", payload)
+            if await self.send_webhook_event(payload):
+                self.metrics.cel_events_delivered[event_type].inc()
+        await self.save_mark(config.cel_tail_state_file)
+        return len(rows)
+
+    async def run(self):
+        """Background task, poll cel table until cancelled"""
+        log.info("CEL tail start")
+        while True:
+            config: Config = self.state.config
+            try:
+                if self.eventtime is None:
+                    await self.init_mark()
+                    self.interval = config.cel_tail_interval_min
+                count = await self.poll()
+                self.last_poll_time = time.strftime("%Y-%m-%d %H:%M:%S")
+                self.rows_count += count
+                self.error = ""
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.exception("Unknown CEL tail error: %s", exc)
+                self.error = str(exc)
+                count = 0
+            if count >= config.cel_tail_batch:
+                # backlog, read next batch at once
+                continue
+            if count:
+                self.interval = config.cel_tail_interval_min
+            else:
+                self.interval = min(
+                    max(self.interval * 2, config.cel_tail_interval_min),
+                    config.cel_tail_interval_max,
+                )
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "eventtime": f"{self.eventtime}",
+            "id": self.cel_id,
+            "interval": self.interval,
+            "last_poll_time": self.last_poll_time,
+            "rows_count": self.rows_count,
+            "error": self.error,
+        }
@@ -0,0 +1,246 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import time
+
+# distinct interned values, then values are kept as is (exten may be any number)
+INTERN_MAX_SIZE = 10000
+# events the store is built from, received even when not in ari_events_used/ami_events_used
+ARI_EVENTS = (
+    "ChannelCreated",
+    "ChannelStateChange",
+    "ChannelEnteredBridge",
+    "ChannelLeftBridge",
+    "ChannelDestroyed",
+    "BridgeDestroyed",
+)
+AMI_EVENTS = ("Newchannel", "Newstate", "BridgeEnter", "BridgeLeave", "Hangup", "BridgeDestroy")
+
+
+class ChannelRecord:
+    """Tracked channel, only fields needed by CRM instead of whole event dict"""
+
+    __slots__ = (
+        "id",
+        "name",
+        "state",
+        "caller_number",
+        "caller_name",
+        "connected_number",
+        "connected_name",
+        "context",
+        "exten",
+        "linkedid",
+        "bridge",
+        "created",
+        "updated",
+    )
+
+    def __init__(self, uniqueid: str, now: float) -> None:
+        self.id = uniqueid
+        self.name = ""
+        self.state = ""
+        self.caller_number = ""
+        self.caller_name = ""
+        self.connected_number = ""
+        self.connected_name = ""
+        self.context = ""
+        self.exten = ""
+        self.linkedid = ""
+        self.bridge = ""
+        self.created = now
+        self.updated = now
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class BridgeRecord:
+    """Tracked bridge with ids of its channels"""
+
+    __slots__ = ("id", "bridge_type", "channels", "created")
+
+    def __init__(self, bridge_id: str, now: float) -> None:
+        self.id = bridge_id
+        self.bridge_type = ""
+        self.channels: list[str] = []
+        self.created = now
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "bridge_type": self.bridge_type,
+            "channels": list(self.channels),
+            "created": self.created,
+        }
+
+
+class ChannelStore:
+    """Alive channels and bridges of PBX built from ARI and AMI events.
+
+    Both streams update the same record (ARI channel id is AMI Uniqueid).
+    Records are slotted objects, repeated strings (state, context, exten,
+    caller name, bridge type) share one object, so a channel costs a few
+    hundred bytes instead of the whole nested event dict. Hangup removes the
+    channel, the oldest channels are evicted above max_size (hangup was lost
+    while disconnected), a bridge is forgotten when its last channel leaves.
+    """
+
+    def __init__(self, max_size: int = 100000) -> None:
+        self.max_size = max_size
+        self.channels: dict[str, ChannelRecord] = {}
+        self.bridges: dict[str, BridgeRecord] = {}
+        self.evicted = 0
+        self._strings: dict[str, str] = {}
+
+    def intern(self, value: str | None) -> str:
+        if not value:
+            return ""
+        interned = self._strings.get(value)
+        if interned is not None:
+            return interned
+        if len(self._strings) < INTERN_MAX_SIZE:
+            self._strings[value] = value
+        return value
+
+    def channel(self, uniqueid: str, now: float) -> ChannelRecord:
+        record = self.channels.get(uniqueid)
+        if record is None:
+            if len(self.channels) >= self.max_size:
+                oldest = next(iter(self.channels))
+                self.remove_channel(oldest)
+                self.evicted += 1
+            record = self.channels[uniqueid] = ChannelRecord(uniqueid, now)
+        record.updated = now
+        return record
+
+    def bridge(self, bridge_id: str, now: float) -> BridgeRecord:
+        record = self.bridges.get(bridge_id)
+        if record is None:
+            if len(self.bridges) >= self.max_size:
+                self.bridges.pop(next(iter(self.bridges)))
+                self.evicted += 1
+            record = self.bridges[bridge_id] = BridgeRecord(bridge_id, now)
+        return record
+
+    def remove_channel(self, uniqueid: str):
+        record = self.channels.pop(uniqueid, None)
+        if record and record.bridge:
+            self.leave_bridge(record)
+
+    def enter_bridge(self, record: ChannelRecord, bridge: BridgeRecord):
+        if record.bridge and record.bridge != bridge.id:
+            self.leave_bridge(record)
+        record.bridge = bridge.id
+        if record.id not in bridge.channels:
+            bridge.channels.append(record.id)
+
+    def leave_bridge(self, record: ChannelRecord):
+        bridge = self.bridges.get(record.bridge)
+        if bridge and record.id in bridge.channels:
+            bridge.channels.remove(record.id)
+            # BridgeDestroyed may be filtered out, last channel left is enough
+            if not bridge.channels:
+                del self.bridges[bridge.id]
+        record.bridge = ""
+
+    def on_ari_event(self, event: dict):
+        """Update state by ARI event"""
+        event_type = event.get("type")
+        now = time.time()
+        if event_type == "ChannelDestroyed":
+            self.remove_channel((event.get("channel") or {}).get("id"))
+            return
+        if event_type == "BridgeDestroyed":
+            self.bridges.pop((event.get("bridge") or {}).get("id"), None)
+            return
+        record = None
+        # Dial has caller and peer instead of channel
+        for name in ("channel", "caller", "peer"):
+            channel = event.get(name)
+            if channel and channel.get("id"):
+                record = self.update_ari_channel(channel, now)
+        bridge = event.get("bridge")
+        if not (bridge and bridge.get("id")):
+            return
+        bridge_record = self.bridge(bridge["id"], now)
+        bridge_record.bridge_type = self.intern(bridge.get("bridge_type"))
+        if record is None:
+            return
+        if event_type == "ChannelEnteredBridge":
+            self.enter_bridge(record, bridge_record)
+        elif event_type == "ChannelLeftBridge":
+            self.leave_bridge(record)
+
+    def update_ari_channel(self, channel: dict, now: float) -> ChannelRecord:
+        record = self.channel(channel["id"], now)
+        record.name = channel.get("name") or record.name
+        record.state = self.intern(channel.get("state")) or record.state
+        caller = channel.get("caller") or {}
+        record.caller_number = caller.get("number") or record.caller_number
+        record.caller_name = self.intern(caller.get("name")) or record.caller_name
+        connected = channel.get("connected") or {}
+        record.connected_number = connected.get("number") or record.connected_number
+        record.connected_name = self.intern(connected.get("name")) or record.connected_name
+        dialplan = channel.get("dialplan") or {}
+        record.context = self.intern(dialplan.get("context")) or record.context
+        record.exten = self.intern(dialplan.get("exten")) or record.exten
+        record.linkedid = channel.get("linkedid") or record.linkedid
+        return record
+
+    def on_ami_event(self, event: dict):
+        """Update state by AMI event"""
+        event_type = event.get("Event")
+        uniqueid = event.get("Uniqueid")
+        bridge_id = event.get("BridgeUniqueid")
+        now = time.time()
+        if event_type == "Hangup":
+            self.remove_channel(uniqueid)
+            return
+        if event_type == "BridgeDestroy":
+            self.bridges.pop(bridge_id, None)
+            return
+        record = None
+        if uniqueid and event.get("Channel"):
+            record = self.channel(uniqueid, now)
+            record.name = event["Channel"]
+            record.state = self.intern(event.get("ChannelStateDesc")) or record.state
+            record.caller_number = event.get("CallerIDNum") or record.caller_number
+            record.caller_name = self.intern(event.get("CallerIDName")) or record.caller_name
+            record.connected_number = event.get("ConnectedLineNum") or record.connected_number
+            record.connected_name = (
+                self.intern(event.get("ConnectedLineName")) or record.connected_name
+            )
+            record.context = self.intern(event.get("Context")) or record.context
+            record.exten = self.intern(event.get("Exten")) or record.exten
+            record.linkedid = event.get("Linkedid") or record.linkedid
+        if not bridge_id:
+            return
+        bridge_record = self.bridge(bridge_id, now)
+        bridge_record.bridge_type = (
+            self.intern(event.get("BridgeType")) or bridge_record.bridge_type
+        )
+        if record is None:
+            return
+        if event_type == "BridgeEnter":
+            self.enter_bridge(record, bridge_record)
+        elif event_type == "BridgeLeave":
+            self.leave_bridge(record)
+
+    def get(self, uniqueid: str) -> dict | None:
+        record = self.channels.get(uniqueid)
+        return record.as_dict() if record else None
+
+    def snapshot(self) -> dict:
+        return {
+            "channels": [record.as_dict() for record in self.channels.values()],
+            "bridges": [record.as_dict() for record in self.bridges.values()],
+        }
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "bridges": len(self.bridges),
+            "evicted": self.evicted,
+            "interned": len(self._strings),
+        }
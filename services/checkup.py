@@ -0,0 +1,209 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import datetime
+import logging
+import posixpath
+
+import httpx
+
+from const import VERSION
+from schemas.config_schema import Config
+
+log = logging.getLogger("asterisk_agent.checkup")
+
+
+class Checkup:
+    """Agent diagnostic.
+
+    Network probes (Asterisk database, ARI) run concurrently with per probe
+    timeout in background task every interval seconds, endpoints only read the
+    cached snapshot. So health checks of load balancer do not load Asterisk
+    database and do not wait for slow probes. Webhook probe posts to customer
+    server, it runs on refresh request only (or in background with
+    checkup_webhook_enable).
+    """
+
+    def __init__(self, state, interval: float = 30, timeout: float = 5) -> None:
+        """
+        Arguments:
+            state -- app.state with config, connector_database, ami, websocket_client
+            interval -- seconds between probes
+            timeout -- seconds for one probe
+        """
+        super().__init__()
+        self.state = state
+        self.interval = interval
+        self.timeout = timeout
+        # probe name -> (status, info)
+        self.snapshot: dict[str, tuple[str, dict]] = {}
+        self.updated_time = ""
+        self._lock = asyncio.Lock()
+
+    async def probe_db(self, info: dict):
+        """Asterisk Database, one row by index"""
+        config: Config = self.state.config
+        connector_database = self.state.connector_database
+        info["dialect"] = config.db_dialect
+        info["cdr_start_field"] = connector_database.cdr_start_field
+        info["missing_indexes"] = connector_database.missing_indexes()
+        query = connector_database.queries["get_cdr_uniqueid_or_linkedid"]
+        info["uniqueid_or_linkedid"] = "union" if "UNION" in query.sql else "or"
+        rows = await connector_database.get_cdr_last()
+        info["history_last_call"] = str(rows[0]) if len(rows) else str(rows)
+
+    async def probe_ari(self, info: dict):
+        """Asterisk ARI, request to asterisk version"""
+        config: Config = self.state.config
+        async with httpx.AsyncClient() as client:
+            res = await client.get(
+                posixpath.join(f"{config.ari_url}", "asterisk/info"),
+                params={"api_key": config.api_key},
+            )
+            res.raise_for_status()
+            info.update(res.json())
+
+    async def probe_webhook(self, info: dict):
+        """Webhook connect"""
+        config: Config = self.state.config
+        async with httpx.AsyncClient() as client:
+            res = await client.post(f"{config.webhook_url}")
+            info["status_code"] = res.status_code
+            if res.status_code != 200:
+                raise ValueError(f"status code {res.status_code}")
+
+    async def _run_probe(self, name: str, probe) -> tuple[str, str, dict]:
+        info = {}
+        try:
+            await asyncio.wait_for(probe(info), self.timeout)
+            return name, "ok", info
+        except asyncio.TimeoutError:
+            info["error"] = f"timeout {self.timeout} seconds"
+        except Exception as exc:
+            info["error"] = str(exc)
+        return name, "error", info
+
+    async def refresh(self, webhook: bool = False):
+        """Run network probes concurrently and save snapshot
+
+        Arguments:
+            webhook -- probe webhook too, the last result is kept otherwise
+        """
+        config: Config = self.state.config
+        probes = {"checkup_db": self.probe_db, "checkup_ari": self.probe_ari}
+        if webhook or config.checkup_webhook_enable:
+            probes["checkup_webhook_url"] = self.probe_webhook
+        async with self._lock:
+            results = await asyncio.gather(
+                *(self._run_probe(name, probe) for name, probe in probes.items())
+            )
+            self.snapshot = {
+                **self.snapshot,
+                **{name: (status, info) for name, status, info in results},
+            }
+            self.updated_time = str(datetime.datetime.now())
+            log.debug("Checkup refreshed %s", self.snapshot)
+
+    async def run(self):
+        """Background task, refresh snapshot every interval seconds"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as exc:
+                log.exception("Unknown checkup error: %s", exc)
+            await asyncio.sleep(self.interval)
+
+    def websocket(self) -> tuple[str, dict]:
+        """Websocket last message, in process state"""
+        websocket_client = getattr(self.state, "websocket_client", None)
+        if websocket_client is None:
+            return "error", {"error": "websocket client not started"}
+        info = {
+            "answer_last_message_time": websocket_client.answer_last_message_time,
+            "answer_last_message": websocket_client.answer_last_message,
+            "no_answer_last_message_time": websocket_client.no_answer_last_message_time,
+            "no_answer_last_message": websocket_client.no_answer_last_message,
+            "last_try_connected_time": websocket_client.last_try_connected_time,
+            "last_connected_time": websocket_client.last_connected_time,
+            "connected": websocket_client.connected,
+            "disconnected_time": websocket_client.disconnected_time,
+            "disconnected_reason": websocket_client.disconnected_reason,
+            "disconnect_count": websocket_client.disconnect_count,
+            "lanes": websocket_client.lanes.stats(),
+        }
+        return ("ok" if websocket_client.connected else "error"), info
+
+    def ami(self) -> tuple[str, dict]:
+        """Asterisk AMI, in process state"""
+        ami = self.state.ami
+        info = {
+            "connected_status": ami.connected,
+            "disconnect_count": ami.disconnect_count,
+        }
+        return ("ok" if ami.connected else "error"), info
+
+    def result(self) -> dict:
+        """Full diagnostic: cached network probes and current in process state"""
+        config: Config = self.state.config
+        probes = {
+            name: self.snapshot.get(name, ("error", {"error": "not checked yet"}))
+            for name in ("checkup_db", "checkup_ari")
+        }
+        probes["checkup_webhook_url"] = self.snapshot.get(
+            "checkup_webhook_url", ("unknown", {"error": "checked on refresh only"})
+        )
+        probes["checkup_websocket"] = self.websocket()
+        probes["checkup_ami"] = self.ami()
+        dedup = getattr(self.state, "dedup", None)
+        cel_tail = getattr(self.state, "cel_tail", None)
+        cdr_cache = getattr(self.state, "cdr_cache", None)
+        history_cache = getattr(self.state, "history_cache", None)
+        capture = getattr(self.state, "capture", None)
+        channels = getattr(self.state, "channels", None)
+        contacts = getattr(self.state, "contacts", None)
+        exports = getattr(self.state, "exports", None)
+        webhook = getattr(self.state, "webhook", None)
+
+        return {
+            "vesrion": VERSION,
+            "webhook_url": f"{config.webhook_url}",
+            "ari_events_ignore": config.ari_events_ignore,
+            "ari_events_used": config.ari_events_used,
+            "ami_events_ignore": config.ami_events_ignore,
+            "ami_events_used": config.ami_events_used,
+            "updated_time": self.updated_time,
+            "status": {name: status for name, (status, _) in probes.items()},
+            "info": {
+                **{name: info for name, (_, info) in probes.items()},
+                "dedup": dedup.stats() if dedup else "disabled",
+                "db_admission": self.state.connector_database.admission.stats(),
+                "cel_tail": cel_tail.stats() if config.cel_tail_enable else "disabled",
+                "cdr_cache": cdr_cache.stats() if config.cdr_cache_enable else "disabled",
+                "history_cache": (
+                    history_cache.stats() if config.history_cache_enable else "disabled"
+                ),
+                "capture": capture.stats() if capture else "disabled",
+                "channels": channels.stats() if channels else "disabled",
+                "contacts": contacts.stats() if contacts else "disabled",
+                "exports": exports.stats() if exports else {},
+                "webhook": webhook.stats() if webhook else {},
+            },
+        }
+
+    def ready(self) -> dict[str, str]:
+        """Readiness: database and enabled Asterisk interfaces are available
+
+        Returns:
+            probe name -> "ok" or "error", empty before first check
+        """
+        if not self.snapshot:
+            return {}
+        config: Config = self.state.config
+        status = {"checkup_db": self.snapshot["checkup_db"][0]}
+        if config.ari_enable:
+            status["checkup_ari"] = self.snapshot["checkup_ari"][0]
+            status["checkup_websocket"] = self.websocket()[0]
+        if config.ami_enable:
+            status["checkup_ami"] = self.ami()[0]
+        return status
@@ -0,0 +1,289 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import csv
+import io
+import json
+import logging
+import time
+from typing import AsyncIterator
+
+import aiofiles
+import httpx
+
+from schemas.config_schema import Config
+
+log = logging.getLogger("asterisk_agent")
+
+# shorter numbers are internal extensions, not prefixed by country code
+MIN_INTERNATIONAL_LENGTH = 8
+# ARI objects with caller/connected parties
+ARI_CHANNELS = ("channel", "caller", "peer")
+# AMI number fields
+AMI_NUMBERS = ("CallerIDNum", "ConnectedLineNum")
+# CDR number columns
+CDR_NUMBERS = ("src", "dst")
+
+
+class PhoneRules:
+    """Phone number normalization to E.164 by rules of one country.
+
+    +79111111111, 79111111111, 89111111111, 9111111111 and 810... (international
+    prefix) give +79111111111 for country_code 7, trunk_prefix 8, national_length
+    10. Other numbers (internal extensions) are digits only.
+    """
+
+    def __init__(
+        self,
+        country_code: str,
+        trunk_prefix: str,
+        national_length: int,
+        international_prefixes: list[str],
+    ) -> None:
+        self.country_code = country_code
+        self.trunk_prefix = trunk_prefix
+        self.national_length = national_length
+        # the longest first: 810 before 8
+        self.international_prefixes = sorted(international_prefixes, key=len, reverse=True)
+
+    @classmethod
+    def from_config(cls, config: Config) -> "PhoneRules":
+        return cls(
+            config.phone_country_code,
+            config.phone_trunk_prefix,
+            config.phone_national_length,
+            config.phone_international_prefixes,
+        )
+
+    def normalize(self, number: str, prefix: bool = False) -> str:
+        """
+        Arguments:
+            number -- number in any format: spaces, dashes, brackets are ignored
+            prefix -- number is a start of numbers, its length is not checked
+
+        Returns:
+            E.164 number or digits of not phone number
+        """
+        digits = "".join(char for char in number if char.isdigit())
+        if number.lstrip().startswith("+"):
+            return f"+{digits}"
+        for international in self.international_prefixes:
+            if digits.startswith(international) and (
+                prefix or len(digits) - len(international) >= MIN_INTERNATIONAL_LENGTH
+            ):
+                return f"+{digits[len(international):]}"
+        national = len(digits) - self.national_length
+        if self.trunk_prefix and digits.startswith(self.trunk_prefix):
+            if prefix or national == len(self.trunk_prefix):
+                return f"+{self.country_code}{digits[len(self.trunk_prefix):]}"
+        if national == len(self.country_code) and digits.startswith(self.country_code):
+            return f"+{digits}"
+        if national == 0:
+            return f"+{self.country_code}{digits}"
+        return digits
+
+
+class ContactIndex:
+    """Normalized number -> contact id, exact numbers in dict, number ranges
+    (company trunk, DID block) in dict per prefix length, the longest prefix wins"""
+
+    def __init__(self) -> None:
+        self.numbers: dict[str, str] = {}
+        self.prefixes: dict[str, str] = {}
+        # distinct lengths of prefixes, the longest first
+        self.prefix_lengths: list[int] = []
+
+    def add(self, number: str, contact_id: str, prefix: bool = False):
+        if prefix:
+            self.prefixes[number] = contact_id
+            self.prefix_lengths = sorted({*self.prefix_lengths, len(number)}, reverse=True)
+        else:
+            self.numbers[number] = contact_id
+
+    def lookup(self, number: str) -> str | None:
+        contact_id = self.numbers.get(number)
+        if contact_id is not None:
+            return contact_id
+        for length in self.prefix_lengths:
+            if length <= len(number):
+                contact_id = self.prefixes.get(number[:length])
+                if contact_id is not None:
+                    return contact_id
+        return None
+
+    def __len__(self) -> int:
+        return len(self.numbers) + len(self.prefixes)
+
+
+def parse_contacts(text: str) -> list[tuple[str, str]]:
+    """(number, id) of CSV with number and id (or contact_id) columns, or of JSON
+    [{"number", "id"}] or {"number": "id"}"""
+    stripped = text.lstrip()
+    if stripped.startswith("{"):
+        return [(f"{number}", f"{contact_id}") for number, contact_id in json.loads(text).items()]
+    if stripped.startswith("["):
+        items = json.loads(text)
+    else:
+        items = csv.DictReader(io.StringIO(text))
+    contacts = []
+    for item in items:
+        number = item.get("number")
+        contact_id = item.get("id", item.get("contact_id"))
+        if number and contact_id not in (None, ""):
+            contacts.append((f"{number}", f"{contact_id}"))
+    return contacts
+
+
+def build_index(contacts: list[tuple[str, str]], rules: PhoneRules) -> ContactIndex:
+    """Index of contacts, number ending with * is a prefix"""
+    index = ContactIndex()
+    for number, contact_id in contacts:
+        prefix = number.endswith("*")
+        normalized = rules.normalize(number.rstrip("*"), prefix=prefix)
+        if normalized:
+            index.add(normalized, contact_id, prefix=prefix)
+    return index
+
+
+class Contacts:
+    """CRM contacts of phone numbers, so CRM gets contact id with every event
+    instead of searching partner by number in any format.
+
+    Index is loaded from contacts_source (CSV/JSON file or URL) at start and
+    every contacts_refresh seconds, the new index replaces the old one when it
+    is built. Numbers of events and CDR rows get normalized number and contact
+    id fields next to them.
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.rules = PhoneRules.from_config(config)
+        self.index = ContactIndex()
+        self.loaded = 0.0
+        self.error = ""
+        self.lookups = 0
+        self.found = 0
+
+    def set_config(self, config: Config) -> bool:
+        """
+        Returns:
+            True if index must be loaded again (source or normalization rules changed)
+        """
+        rules = PhoneRules.from_config(config)
+        reload = config.contacts_source != self.config.contacts_source or (
+            vars(rules) != vars(self.rules)
+        )
+        self.config = config
+        self.rules = rules
+        return reload
+
+    async def read_source(self) -> str:
+        source = self.config.contacts_source
+        if source.startswith(("http://", "https://")):
+            # credentials are sent as auth, so they are not in error messages with url
+            url = httpx.URL(source)
+            auth = httpx.BasicAuth(url.username, url.password) if url.username else None
+            async with httpx.AsyncClient(auth=auth, timeout=self.config.contacts_timeout) as client:
+                res = await client.get(url.copy_with(userinfo=b""))
+                res.raise_for_status()
+                return res.text
+        async with aiofiles.open(source, encoding="utf-8-sig") as file:
+            return await file.read()
+
+    async def load(self):
+        """Read contacts_source and replace index
+
+        Raises:
+            Exception: source is not available or not valid, the old index is kept
+        """
+        started = time.monotonic()
+        text = await self.read_source()
+        contacts = await asyncio.to_thread(parse_contacts, text)
+        self.index = await asyncio.to_thread(build_index, contacts, self.rules)
+        self.loaded = time.time()
+        self.error = ""
+        log.info(
+            "Contacts loaded: %s numbers in %.3f seconds",
+            len(self.index),
+            time.monotonic() - started,
+        )
+
+    async def refresh(self):
+        """Load contacts, errors are only logged (the old index is kept)"""
+        try:
+            await self.load()
+        except Exception as exc:
+            log.exception("Contacts load error: %s", exc)
+            self.error = f"{exc!r}"
+
+    async def run(self):
+        """Load contacts every contacts_refresh seconds, until cancelled"""
+        while self.config.contacts_refresh > 0:
+            await asyncio.sleep(self.config.contacts_refresh)
+            await self.refresh()
+
+    def lookup(self, number: str) -> tuple[str, str | None]:
+        """
+        Returns:
+            normalized number, contact id or None
+        """
+        normalized = self.rules.normalize(number)
+        contact_id = self.index.lookup(normalized)
+        self.lookups += 1
+        if contact_id is not None:
+            self.found += 1
+        return normalized, contact_id
+
+    def enrich_ari(self, event: dict):
+        """Add normalized and contact_id to caller and connected of event channels"""
+        for name in ARI_CHANNELS:
+            channel = event.get(name)
+            if not channel:
+                continue
+            for party in (channel.get("caller"), channel.get("connected")):
+                if party and party.get("number"):
+                    party["normalized"], contact_id = self.lookup(party["number"])
+                    if contact_id is not None:
+                        party["contact_id"] = contact_id
+
+    def enrich_ami(self, event: dict) -> dict:
+        """Event copy with <field>Normalized and <field>ContactId of number fields
+        (received event is captured as is)"""
+        event = dict(event)
+        for field in AMI_NUMBERS:
+            number = event.get(field)
+            if number and number != "<unknown>":
+                event[f"{field}Normalized"], contact_id = self.lookup(number)
+                if contact_id is not None:
+                    event[f"{field}ContactId"] = contact_id
+        return event
+
+    def enrich_row(self, row: dict) -> dict:
+        """CDR row copy with src/dst _normalized and _contact_id columns
+        (cached rows are not changed)"""
+        row = dict(row)
+        for field in CDR_NUMBERS:
+            number = row.get(field)
+            if number:
+                row[f"{field}_normalized"], contact_id = self.lookup(f"{number}")
+                if contact_id is not None:
+                    row[f"{field}_contact_id"] = contact_id
+        return row
+
+    async def enrich_rows(self, rows: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        try:
+            async for row in rows:
+                yield self.enrich_row(row)
+        finally:
+            await rows.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "numbers": len(self.index.numbers),
+            "prefixes": len(self.index.prefixes),
+            "loaded": self.loaded,
+            "error": self.error,
+            "lookups": self.lookups,
+            "found": self.found,
+        }
@@ -1,9 +1,46 @@
 # Copyright 2024 Artem Shurshilov
 # Apache License Version 2.0
 
-from typing import Literal
+import asyncio
+import datetime
+import functools
+import time
+import zoneinfo
+from typing import AsyncIterator, Literal
 
 from schemas.config_schema import Config
+from services.admission import Admission
+from services.metrics import observe_query, observe_stream
+from services.queries import CREATE_INDEX, Dialect, Query, compile_queries, compile_schema_queries
+
+# methods with latency and rows metrics, counted in in_flight
+INSTRUMENTED_METHODS = (
+    "check_cdr_old",
+    "get_cdr_uniqueid",
+    "get_cdr_uniqueid_or_linkedid",
+    "get_cdr",
+    "get_cdr_last",
+    "get_cel",
+    "get_cel_since",
+    "get_cel_last",
+    "get_ring_groups",
+    "get_queues_config",
+    "get_findmefollow",
+)
+
+
+def track_in_flight(func):
+    """Count running queries of strategy, to close it when they are finished"""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        self.in_flight += 1
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+    return wrapper
 
 
 class DatabaseStrategy:
@@ -35,12 +72,184 @@ class DatabaseStrategy:
         answer = start + (duration - billsec)
     """
 
+    dialect: Dialect = "sqlite"
+
     def __init__(self, config: Config) -> None:
         self.config = config
         self.cdr_start_field: Literal["calldate", "start"] = "start"
+        self.in_flight = 0
+        # table kind (cdr, cel) -> name, columns, leading columns of indexes, rows estimate
+        self.schema: dict[str, dict] = {}
+        self.queries: dict[str, Query] = {}
+        self.admission = Admission(config)
+        self.compile()
+
+    def __init_subclass__(cls, **kwargs):
+        """Every strategy gets query metrics without code in each method"""
+        super().__init_subclass__(**kwargs)
+        for method in INSTRUMENTED_METHODS:
+            func = getattr(cls, method)
+            if getattr(func, "instrumented", False):
+                continue
+            func = observe_query(method, track_in_flight(func))
+            func.instrumented = True
+            setattr(cls, method, func)
+
+    def compile(self):
+        """Compile queries for dialect, cdr table, cdr start column and indexes"""
+        cdr_indexed = self.schema.get("cdr", {}).get("indexed", ())
+        self.queries = compile_queries(
+            self.dialect,
+            self.config.db_table_cdr_name,
+            self.cdr_start_field,
+            union_linkedid="uniqueid" in cdr_indexed and "linkedid" in cdr_indexed,
+            statement_timeout=self.config.db_statement_timeout,
+        )
+
+    async def fetch_query(self, query: Query, values: dict) -> list[dict]:
+        """Run compiled query
+
+        Arguments:
+            query -- compiled query
+            values -- query parameters
+
+        Returns:
+            rows as dicts
+        """
+        raise NotImplementedError
+
+    async def execute(self, sql: str):
+        """Run statement without result (DDL) in autocommit"""
+        raise NotImplementedError
+
+    async def fetch(self, name: str, **values) -> list[dict]:
+        """Run compiled query by name
+
+        Arguments:
+            name -- query name from services.queries.QUERIES
+            values -- query parameters
+
+        Returns:
+            rows as dicts
+
+        Raises:
+            OverloadError: no free slot of query class in db_queue_timeout seconds
+        """
+        async with self.admission.slot(self.admission.classify(values)):
+            return await self.fetch_query(self.queries[name], values)
+
+    async def stream(self, name: str, **values) -> AsyncIterator[dict]:
+        """Run compiled query and yield rows, strategies with server side cursors
+        override it to not keep all rows in memory
+
+        Arguments:
+            name -- query name from services.queries.QUERIES
+            values -- query parameters
+        """
+        for row in await self.fetch_query(self.queries[name], values):
+            yield row
+
+    async def admitted(self, lane: str, rows: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        """Hold slot of query class until rows iterator is finished or closed,
+        slot is taken on the first row
+
+        Raises:
+            OverloadError: no free slot of query class in db_queue_timeout seconds
+        """
+        async with self.admission.slot(lane):
+            async for row in rows:
+                yield row
+
+    async def track_stream(self, method: str, rows: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        """Metrics and in_flight of rows iterator"""
+        self.in_flight += 1
+        try:
+            async for row in observe_stream(self.config.pbx_name, method, rows):
+                yield row
+        finally:
+            self.in_flight -= 1
+
+    async def close(self):
+        """Close connections pool, strategies with pool override it"""
+
+    async def drain(self, timeout: float = 60):
+        """Wait for running queries and close (old strategy after config reload)"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        await self.close()
+
+    async def introspect_table(self, table: str) -> dict:
+        """Columns, indexes and estimated rows count of table
+
+        Returns:
+            {"table", "columns", "indexed" (leading columns of indexes), "rows"},
+            empty columns if table does not exist
+        """
+        queries = compile_schema_queries(self.dialect, table)
+        columns = await self.fetch_query(queries["schema_columns"], {"table": table})
+        info = {
+            "table": table,
+            "columns": [row["column_name"] for row in columns],
+            "indexed": [],
+            "rows": None,
+        }
+        if not columns:
+            return info
+        indexed = {row["column_name"] for row in columns if row["pk"] == 1}
+        indexes = await self.fetch_query(queries["schema_indexes"], {"table": table})
+        info["indexed"] = sorted(indexed | {row["column_name"] for row in indexes})
+        rows = await self.fetch_query(queries["schema_rows"], {"table": table})
+        if rows and rows[0]["rows"] is not None:
+            info["rows"] = int(rows[0]["rows"])
+        return info
 
     async def check_cdr_old(self):
-        """Check that Asterisk cdr have start column or not"""
+        """Schema introspection: check that Asterisk cdr have start column or not,
+        find indexes of cdr and cel tables, compile queries for them"""
+        self.schema = {
+            "cdr": await self.introspect_table(self.config.db_table_cdr_name),
+            "cel": await self.introspect_table("cel"),
+        }
+        if "calldate" in self.schema["cdr"]["columns"]:
+            self.cdr_start_field = "calldate"
+        self.compile()
+
+    def missing_indexes(self) -> list[dict]:
+        """Recommended indexes for history queries that table does not have
+
+        Returns:
+            [{"table", "column", "rows"}], rows is estimated table size
+        """
+        recommended = {"cdr": (self.cdr_start_field, "uniqueid", "linkedid"), "cel": ("eventtime",)}
+        missing = []
+        for kind, columns in recommended.items():
+            info = self.schema.get(kind)
+            if not info or not info["columns"]:
+                continue
+            for column in columns:
+                if column in info["columns"] and column not in info["indexed"]:
+                    missing.append({"table": info["table"], "column": column, "rows": info["rows"]})
+        return missing
+
+    async def create_indexes(self) -> list[str]:
+        """Create missing recommended indexes, then introspect schema again
+
+        Returns:
+            executed statements
+        """
+        statements = []
+        for index in self.missing_indexes():
+            sql = CREATE_INDEX[self.dialect].format(
+                name=f"asterisk_agent_{index['table']}_{index['column']}",
+                table=index["table"],
+                column=index["column"],
+            )
+            await self.execute(sql)
+            statements.append(sql)
+        await self.check_cdr_old()
+        return statements
 
     async def get_cdr_uniqueid(self, uniqueid):
         """Return calls history
@@ -48,6 +257,7 @@ class DatabaseStrategy:
         Arguments:
             uniqueid -- id of call in asterisk
         """
+        return await self.fetch("get_cdr_uniqueid", uniqueid=uniqueid)
 
     async def get_cdr_uniqueid_or_linkedid(self, uniqueid):
         """Return calls history
@@ -55,14 +265,35 @@ class DatabaseStrategy:
         Arguments:
             uniqueid -- id of call in asterisk
         """
+        return await self.fetch("get_cdr_uniqueid_or_linkedid", uniqueid=uniqueid)
 
-    async def get_cdr(self, start_date, end_date, uniqueid=None):
+    async def get_cdr(self, start_date, end_date):
         """Return calls history
 
         Arguments:
             start_date -- start date of calls
             end_date -- end date of calls
         """
+        return await self.fetch("get_cdr", start_date=start_date, end_date=end_date)
+
+    def iter_cdr(
+        self, start_date, end_date, ordered: bool = False, lane: str | None = None
+    ) -> AsyncIterator[dict]:
+        """Iterate calls history, the same rows as get_cdr
+
+        Arguments:
+            ordered -- rows in start time order (merge of several PBX)
+            lane -- query class, by range length when not set
+        """
+        name = "get_cdr_ordered" if ordered else "get_cdr"
+        values = {"start_date": start_date, "end_date": end_date}
+        rows = self.stream(name, **values)
+        rows = self.admitted(lane or self.admission.classify(values), rows)
+        return self.track_stream("iter_cdr", rows)
+
+    async def get_cdr_last(self):
+        """Return last call, index lookup instead of range scan"""
+        return await self.fetch("get_cdr_last")
 
     async def get_cel(self, start_date, end_date):
         """Return events history
@@ -71,122 +302,106 @@ class DatabaseStrategy:
             start_date -- start date
             end_date -- end date
         """
+        return await self.fetch("get_cel", start_date=start_date, end_date=end_date)
+
+    def iter_cel(
+        self, start_date, end_date, ordered: bool = False, lane: str | None = None
+    ) -> AsyncIterator[dict]:
+        """Iterate events history, the same rows as get_cel
+
+        Arguments:
+            ordered -- rows in (eventtime, id) order (merge of several PBX)
+            lane -- query class, by range length when not set
+        """
+        name = "get_cel_ordered" if ordered else "get_cel"
+        values = {"start_date": start_date, "end_date": end_date}
+        rows = self.stream(name, **values)
+        rows = self.admitted(lane or self.admission.classify(values), rows)
+        return self.track_stream("iter_cel", rows)
+
+    async def get_cel_since(self, eventtime, cel_id, limit: int = 1000) -> list[dict]:
+        """Return events after high-water mark, in (eventtime, id) order.
+        Range read by eventtime index, no full scan.
+
+        Arguments:
+            eventtime -- eventtime of last read event
+            cel_id -- id of last read event
+            limit -- max rows
+        """
+        return await self.fetch("get_cel_since", eventtime=eventtime, id=cel_id, limit=limit)
+
+    async def get_cel_last(self) -> list[dict]:
+        """Return last event, index lookup"""
+        return await self.fetch("get_cel_last")
 
     async def get_ring_groups(self):
         """Return ring groups"""
+        return await self.fetch("get_ring_groups")
 
     async def get_queues_config(self):
         """Return queues config"""
+        return await self.fetch("get_queues_config")
 
     async def get_findmefollow(self):
         """Return redrects"""
+        return await self.fetch("get_findmefollow")
 
 
 class SqliteStrategy(DatabaseStrategy):
-    async def check_cdr_old(self):
-        import aiosqlite
-
-        check_column = f"SELECT COUNT(*) AS CNTREC FROM pragma_table_info('{self.config.db_table_cdr_name}') WHERE name='calldate'"
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-
-            async with database.execute(check_column) as cursor:
-                async for row in cursor:
-                    self.cdr_start_field = "calldate"
-                    return
-
-    async def get_cdr_uniqueid(self, uniqueid):
-        import aiosqlite
-
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute(
-                f"SELECT * FROM {self.config.db_table_cdr_name} where uniqueid= %s;",
-                [uniqueid],
-            ) as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
-
-    async def get_cdr_uniqueid_or_linkedid(self, uniqueid):
-        import aiosqlite
-
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute(
-                f"SELECT * FROM {self.config.db_table_cdr_name} where uniqueid= %s or linkedid = %s;",
-                [uniqueid, uniqueid],
-            ) as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
-
-    async def get_cdr(self, start_date, end_date):
-        import aiosqlite
-
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute(
-                f"SELECT * FROM {self.config.db_table_cdr_name} where {self.cdr_start_field} >= %s and {self.cdr_start_field} <= %s limit 100000;",
-                [start_date, end_date],
-            ) as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
-
-    async def get_cel(self, start_date, end_date):
-        import aiosqlite
-
-        # host==path "/var/lib/asterisk/astdb.sqlite3"
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute(
-                f"SELECT * FROM cel where eventtime >= %s and eventtime <= %s limit 100000;",
-                [start_date, end_date],
-            ) as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
+    dialect = "sqlite"
 
-    async def get_ring_groups(self):
-        import aiosqlite
-
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute("select * from asterisk.ringgroups;") as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
-
-    async def get_queues_config(self):
-        import aiosqlite
-
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute("select * from asterisk.queues_config;") as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
-
-    async def get_findmefollow(self):
+    def __init__(self, config: Config) -> None:
+        super().__init__(config)
+        self.database = None
+        self._connect_lock = asyncio.Lock()
+        self._statement_started = 0.0
+
+    async def get_connection(self):
+        """One connection for strategy lifetime, so sqlite3 statement cache
+        keeps compiled queries prepared"""
         import aiosqlite
 
-        result = []
-        async with aiosqlite.connect(self.config.db_host) as database:
-            database.row_factory = aiosqlite.Row
-            async with database.execute("select * from asterisk.findmefollow;") as cursor:
-                async for row in cursor:
-                    result.append(row)
-        return result
+        if self.database is None:
+            async with self._connect_lock:
+                if self.database is None:
+                    # host==path "/var/lib/asterisk/astdb.sqlite3"
+                    database = await aiosqlite.connect(self.config.db_host)
+                    database.row_factory = aiosqlite.Row
+                    if self.config.db_statement_timeout:
+                        # sqlite has no statement timeout: start of statement is traced,
+                        # progress handler aborts it (OperationalError: interrupted)
+                        await database.set_trace_callback(self.statement_started)
+                        await database.set_progress_handler(self.statement_expired, 10000)
+                    self.database = database
+        return self.database
+
+    def statement_started(self, sql: str):
+        # called in sqlite thread, statements of the connection run one by one
+        self._statement_started = time.monotonic()
+
+    def statement_expired(self) -> bool:
+        return time.monotonic() - self._statement_started > self.config.db_statement_timeout
+
+    async def close(self):
+        if self.database is not None:
+            database, self.database = self.database, None
+            await database.close()
+
+    async def execute(self, sql: str):
+        database = await self.get_connection()
+        await database.execute(sql)
+        await database.commit()
+
+    async def fetch_query(self, query: Query, values: dict) -> list[dict]:
+        database = await self.get_connection()
+        async with database.execute(query.sql, query.args(values)) as cursor:
+            rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
 
 
 class MysqlStrategy(DatabaseStrategy):
+    dialect = "mysql"
+
     async def get_conn_cur(self):
         import aiomysql
 
@@ -201,164 +416,147 @@ class MysqlStrategy(DatabaseStrategy):
         cur: aiomysql.Cursor = await conn.cursor(aiomysql.DictCursor)
         return conn, cur
 
-    async def check_cdr_old(self):
-        conn, cur = await self.get_conn_cur()
-        check_column = f"SHOW COLUMNS FROM `{self.config.db_table_cdr_name}` LIKE 'calldate'"
-        await cur.execute(check_column)
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        if len(rows):
-            self.cdr_start_field = "calldate"
-            return
-
-    async def get_cdr_uniqueid(self, uniqueid):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM {self.config.db_table_cdr_name} where uniqueid = %s;",
-            (uniqueid),
-        )
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
-
-    async def get_cdr_uniqueid_or_linkedid(self, uniqueid):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM {self.config.db_table_cdr_name} where uniqueid = %s or linkedid = %s;",
-            (uniqueid, uniqueid),
-        )
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
-
-    async def get_cdr(self, start_date, end_date):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM {self.config.db_table_cdr_name} where {self.cdr_start_field} >= %s and {self.cdr_start_field} <= %s limit 100000;",
-            (start_date, end_date),
-        )
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
-
-    async def get_cel(self, start_date, end_date):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM cel where eventtime >= %s and eventtime <= %s limit 100000;",
-            (start_date, end_date),
-        )
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
-
-    async def get_ring_groups(self):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute("select * from asterisk.ringgroups;")
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
-
-    async def get_queues_config(self):
+    async def execute(self, sql: str):
         conn, cur = await self.get_conn_cur()
-        await cur.execute("select * from asterisk.queues_config;")
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
-
-    async def get_findmefollow(self):
+        try:
+            await cur.execute(sql)
+            await conn.commit()
+        finally:
+            await cur.close()
+            conn.close()
+
+    async def fetch_query(self, query: Query, values: dict) -> list[dict]:
+        # aiomysql has no server side prepared statements, only query text is cached
         conn, cur = await self.get_conn_cur()
-        await cur.execute("select * from asterisk.findmefollow;")
-        rows = await cur.fetchall()
-        await cur.close()
-        conn.close()
-        return rows
+        try:
+            await cur.execute(query.sql, query.args(values))
+            rows = await cur.fetchall()
+        finally:
+            await cur.close()
+            conn.close()
+        return list(rows)
 
 
 class PostgresqlStrategy(DatabaseStrategy):
+    dialect = "postgresql"
+
     async def get_conn_cur(self):
         import aiopg
 
         dsn = f"dbname={self.config.db_database} user={self.config.db_user} password={self.config.db_password} host={self.config.db_host} port={self.config.db_port}"
+        if self.config.db_statement_timeout:
+            dsn += f" options='-c statement_timeout={int(self.config.db_statement_timeout * 1000)}'"
         conn = await aiopg.connect(dsn)
         cur = await conn.cursor()
         return conn, cur
 
-    async def check_cdr_old(self):
+    async def execute(self, sql: str):
+        # aiopg connection is always in autocommit
         conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT column_name FROM information_schema.columns WHERE table_name='{self.config.db_table_cdr_name}' and column_name='calldate'"
-        )
-
-        rows = await cur.fetchall()
-        await conn.close()
-        if len(rows):
-            self.cdr_start_field = "calldate"
-            return
+        try:
+            await cur.execute(sql)
+        finally:
+            await conn.close()
 
-    async def get_cdr_uniqueid(self, uniqueid):
+    async def fetch_query(self, query: Query, values: dict) -> list[dict]:
+        # rows as dicts of column name like other dialects, aiopg cursor gives tuples
         conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM {self.config.db_table_cdr_name} where uniqueid = %s;",
-            (uniqueid),
-        )
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
+        try:
+            await cur.execute(query.sql, query.args(values))
+            rows = await cur.fetchall()
+            columns = [column.name for column in cur.description]
+        finally:
+            await conn.close()
+        return [dict(zip(columns, row)) for row in rows]
 
-    async def get_cdr_uniqueid_or_linkedid(self, uniqueid):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM {self.config.db_table_cdr_name} where uniqueid = %s or linkedid = %s;",
-            (uniqueid, uniqueid),
-        )
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
 
-    async def get_cdr(self, start_date, end_date):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM {self.config.db_table_cdr_name} where {self.cdr_start_field} >= %s and {self.cdr_start_field} <= %s limit 100000;",
-            (start_date, end_date),
-        )
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
+class AsyncpgStrategy(DatabaseStrategy):
+    """PostgreSQL by asyncpg: connections pool, binary protocol, statements are
+    prepared once per connection (asyncpg statement cache), history is read by
+    server side cursor in db_stream_prefetch rows batches."""
 
-    async def get_cel(self, start_date, end_date):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute(
-            f"SELECT * FROM cel where eventtime >= %s and eventtime <= %s limit 100000;",
-            (start_date, end_date),
-        )
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
+    dialect = "asyncpg"
 
-    async def get_ring_groups(self):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute("select * from asterisk.ringgroups;")
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
-
-    async def get_queues_config(self):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute("select * from asterisk.queues_config;")
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
-
-    async def get_findmefollow(self):
-        conn, cur = await self.get_conn_cur()
-        await cur.execute("select * from asterisk.findmefollow;")
-        rows = await cur.fetchall()
-        await conn.close()
-        return rows
+    def __init__(self, config: Config) -> None:
+        super().__init__(config)
+        self.pool = None
+        self._connect_lock = asyncio.Lock()
+        # session TimeZone of server, aware datetime parameters are converted to it
+        self.timezone: datetime.tzinfo = datetime.timezone.utc
+
+    async def get_pool(self):
+        import asyncpg
+
+        if self.pool is None:
+            async with self._connect_lock:
+                if self.pool is None:
+                    pool = await asyncpg.create_pool(
+                        host=self.config.db_host,
+                        port=self.config.db_port,
+                        user=self.config.db_user,
+                        password=self.config.db_password,
+                        database=self.config.db_database,
+                        min_size=self.config.db_pool_min_size,
+                        max_size=self.config.db_pool_max_size,
+                        server_settings=self.server_settings(),
+                    )
+                    async with pool.acquire() as connection:
+                        self.timezone = await self.server_timezone(connection)
+                    self.pool = pool
+        return self.pool
+
+    @staticmethod
+    async def server_timezone(connection) -> datetime.tzinfo:
+        """TimeZone reported by server, or its current UTC offset when the name
+        is not known to zoneinfo (POSIX style "<+03>-03")"""
+        name = connection.get_settings().TimeZone
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            seconds = await connection.fetchval("SELECT EXTRACT(TIMEZONE FROM now())::int")
+            return datetime.timezone(datetime.timedelta(seconds=seconds))
+
+    def server_settings(self) -> dict[str, str]:
+        if not self.config.db_statement_timeout:
+            return {}
+        return {"statement_timeout": f"{int(self.config.db_statement_timeout * 1000)}"}
+
+    async def close(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+
+    def args(self, query: Query, values: dict) -> list:
+        """asyncpg does not cast text, aware datetime to Asterisk timestamp (without
+        time zone) columns raises error. Aware datetime is converted to session
+        TimeZone and time zone is dropped, as PostgreSQL casts timestamptz
+        parameters of aiopg to timestamp."""
+        return [
+            (
+                value.astimezone(self.timezone).replace(tzinfo=None)
+                if isinstance(value, datetime.datetime) and value.tzinfo
+                else value
+            )
+            for value in query.args(values)
+        ]
+
+    async def execute(self, sql: str):
+        pool = await self.get_pool()
+        await pool.execute(sql)
+
+    async def fetch_query(self, query: Query, values: dict) -> list[dict]:
+        pool = await self.get_pool()
+        rows = await pool.fetch(query.sql, *self.args(query, values))
+        return [dict(row) for row in rows]
+
+    async def stream(self, name: str, **values) -> AsyncIterator[dict]:
+        query = self.queries[name]
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            # cursors live only inside transaction
+            async with connection.transaction(readonly=True):
+                statement = await connection.prepare(query.sql)
+                async for row in statement.cursor(
+                    *self.args(query, values), prefetch=self.config.db_stream_prefetch
+                ):
+                    yield dict(row)
@@ -0,0 +1,190 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import datetime
+import time
+
+# ARI event type or AMI event -> normalized kind of occurrence
+EVENT_KINDS = {
+    "ChannelCreated": "newchannel",
+    "Newchannel": "newchannel",
+    "ChannelDestroyed": "hangup",
+    "Hangup": "hangup",
+    "ChannelHangupRequest": "hangup_request",
+    "HangupRequest": "hangup_request",
+    "SoftHangupRequest": "hangup_request",
+    "ChannelStateChange": "newstate",
+    "Newstate": "newstate",
+    "ChannelEnteredBridge": "bridge_enter",
+    "BridgeEnter": "bridge_enter",
+    "ChannelLeftBridge": "bridge_leave",
+    "BridgeLeave": "bridge_leave",
+    "ChannelHold": "hold",
+    "Hold": "hold",
+    "ChannelUnhold": "unhold",
+    "Unhold": "unhold",
+    "ChannelCallerId": "callerid",
+    "NewCallerid": "callerid",
+    "ChannelConnectedLine": "connectedline",
+    "NewConnectedLine": "connectedline",
+    "ChannelDtmfReceived": "dtmf",
+    "DTMFEnd": "dtmf",
+    "Dial": "dial",
+    "DialBegin": "dial_begin",
+    "DialState": "dial_state",
+    "DialEnd": "dial_end",
+}
+# dialstatus of ARI Dial which ends dial (AMI DialEnd), others are AMI DialState
+DIAL_END_STATUSES = ("ANSWER", "BUSY", "NOANSWER", "CANCEL", "CONGESTION", "CHANUNAVAIL")
+# max difference of event times of one occurrence in ARI and AMI
+TIME_TOLERANCE = 1.0
+
+
+def event_key(source: str, payload: dict) -> tuple | None:
+    """Key of logical occurrence: (channel uniqueid, normalized kind)
+
+    Arguments:
+        source -- "ari" or "ami"
+        payload -- ARI or AMI event
+
+    Returns:
+        key or None if event can not be duplicated by other stream
+    """
+    if source == "ari":
+        event = payload.get("type")
+        kind = EVENT_KINDS.get(event)
+        if kind is None:
+            return None
+        if kind == "dial":
+            # ARI Dial: peer is dialed channel, empty dialstatus means begin
+            uniqueid = (payload.get("peer") or {}).get("id")
+            status = payload.get("dialstatus")
+            if not status:
+                kind = "dial_begin"
+            elif status in DIAL_END_STATUSES:
+                kind = "dial_end"
+            else:
+                kind = f"dial_state:{status}"
+        else:
+            uniqueid = (payload.get("channel") or {}).get("id")
+        if kind == "newstate":
+            kind = f"newstate:{(payload.get('channel') or {}).get('state')}"
+        elif kind == "dtmf":
+            kind = f"dtmf:{payload.get('digit')}"
+    else:
+        event = payload.get("Event")
+        kind = EVENT_KINDS.get(event)
+        if kind is None:
+            return None
+        if kind in ("dial_begin", "dial_state", "dial_end"):
+            uniqueid = payload.get("DestUniqueid")
+        else:
+            uniqueid = payload.get("Uniqueid")
+        if kind == "newstate":
+            kind = f"newstate:{payload.get('ChannelStateDesc')}"
+        elif kind == "dial_state":
+            kind = f"dial_state:{payload.get('DialStatus')}"
+        elif kind == "dtmf":
+            # ARI has received digits only
+            if payload.get("Direction") == "Sent":
+                return None
+            kind = f"dtmf:{payload.get('Digit')}"
+    if not uniqueid:
+        return None
+    return (uniqueid, kind)
+
+
+def event_time(source: str, payload: dict) -> float | None:
+    """Asterisk time of event: ARI timestamp, AMI Timestamp (timestampevents=yes)"""
+    try:
+        if source == "ari":
+            return datetime.datetime.fromisoformat(payload["timestamp"]).timestamp()
+        return float(payload["Timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class EventDeduplicator:
+    """Drop the same occurrence (hangup, new channel...) received from both
+    ARI and AMI streams, first arrived event wins.
+
+    Time-windowed hash map of two generations (time buckets): event times of
+    keys are added to the current one, looked up in both. Every window seconds
+    (or when current is full) the previous generation is dropped. So check is
+    O(1) and memory is bounded by max_size keys, key lives from window to
+    2*window seconds.
+
+    An event pairs with one not paired event of the other stream, so an
+    occurrence repeated on a channel (hold, the same digit) is delivered every
+    time. When both streams have event time, the times must be within
+    TIME_TOLERANCE: an old occurrence delivered by one stream only (filtered by
+    the other) is not paired with a new one.
+    """
+
+    def __init__(self, window: float = 5.0, max_size: int = 100000) -> None:
+        self.window = window
+        self.max_size = max_size
+        self.checked = 0
+        self.duplicates = {"ari": 0, "ami": 0}
+        self.rotations = 0
+        # (*key, source) -> event times not paired yet
+        self._current: dict[tuple, list[float | None]] = {}
+        self._previous: dict[tuple, list[float | None]] = {}
+        self._rotate_at = time.monotonic() + window
+
+    def is_duplicate(self, source: str, payload: dict) -> bool:
+        """Check event and remember it
+
+        Arguments:
+            source -- "ari" or "ami"
+            payload -- event
+
+        Returns:
+            True if the same occurrence was already received from other stream
+        """
+        key = event_key(source, payload)
+        if key is None:
+            return False
+        self.checked += 1
+
+        now = time.monotonic()
+        if now >= self._rotate_at or len(self._current) >= self.max_size // 2:
+            self._rotate(now)
+
+        # the same stream never sends the occurrence twice,
+        # so remember source to not drop events of one stream
+        stamp = event_time(source, payload)
+        other = (*key, "ami" if source == "ari" else "ari")
+        for generation in (self._previous, self._current):
+            stamps = generation.get(other)
+            if stamps and self._pair(stamps, stamp):
+                self.duplicates[source] += 1
+                return True
+        self._current.setdefault((*key, source), []).append(stamp)
+        return False
+
+    @staticmethod
+    def _pair(stamps: list[float | None], stamp: float | None) -> bool:
+        """Remove the oldest event time of the same occurrence"""
+        for index, other in enumerate(stamps):
+            if stamp is None or other is None or abs(stamp - other) <= TIME_TOLERANCE:
+                del stamps[index]
+                return True
+        return False
+
+    def _rotate(self, now: float):
+        self._previous = self._current
+        self._current = {}
+        self._rotate_at = now + self.window
+        self.rotations += 1
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "checked": self.checked,
+            "duplicates": sum(self.duplicates.values()),
+            "duplicates_ari": self.duplicates["ari"],
+            "duplicates_ami": self.duplicates["ami"],
+            "size": len(self._current) + len(self._previous),
+            "rotations": self.rotations,
+        }
@@ -0,0 +1,380 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import collections
+import csv
+import datetime
+import glob
+import gzip
+import importlib.util
+import io
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator
+
+from exceptions.exceptions import BusinessError, OverloadError
+from schemas.config_schema import Config
+from services.queries import HISTORY_LIMIT
+
+log = logging.getLogger("asterisk_agent")
+
+EXTENSIONS = {"csv": "csv.gz", "parquet": "parquet"}
+MEDIA_TYPES = {"csv": "application/gzip", "parquet": "application/vnd.apache.parquet"}
+# rows written to file at once
+CHUNK_ROWS = 10000
+
+
+class ExportJob:
+    """History export of time range to file"""
+
+    def __init__(
+        self,
+        job_id: str,
+        kind: str,
+        file_format: str,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+        path: str,
+    ) -> None:
+        self.id = job_id
+        self.kind = kind
+        self.format = file_format
+        self.start_date = start_date
+        self.end_date = end_date
+        self.path = path
+        self.status = "queued"
+        self.error = ""
+        # end of exported part of range
+        self.exported_to = start_date
+        self.rows = 0
+        self.size = 0
+        self.created = time.time()
+        self.finished = 0.0
+        self.task: asyncio.Task | None = None
+
+    @property
+    def progress(self) -> float:
+        total = (self.end_date - self.start_date).total_seconds()
+        if self.status == "done" or not total:
+            return 1.0 if self.status == "done" else 0.0
+        return min(1.0, (self.exported_to - self.start_date).total_seconds() / total)
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "format": self.format,
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat(),
+            "status": self.status,
+            "error": self.error,
+            "progress": round(self.progress, 4),
+            "rows": self.rows,
+            "size": self.size,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class CsvWriter:
+    """Gzip CSV, columns of the first rows"""
+
+    def __init__(self, path: str) -> None:
+        self.file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self.fields: list[str] | None = None
+
+    def write(self, rows: list[dict]):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, self.fields or list(rows[0]), extrasaction="ignore")
+        if self.fields is None:
+            self.fields = writer.fieldnames
+            writer.writeheader()
+        writer.writerows(rows)
+        self.file.write(buffer.getvalue())
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Parquet file, row group per written rows, schema of the first rows"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.writer = None
+
+    def write(self, rows: list[dict]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.writer is None:
+            table = pa.Table.from_pylist(rows)
+            # column without values in the first rows
+            schema = pa.schema(
+                [
+                    pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                    for field in table.schema
+                ]
+            )
+            self.writer = pq.ParquetWriter(self.path, schema, compression="zstd")
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ExportJobs:
+    """Background export of CDR/CEL history of PBX to compressed files.
+
+    Range is read by windows of export_window seconds in time order and
+    written by chunks of CHUNK_ROWS rows, so memory does not depend on window
+    size. A query returns no more than HISTORY_LIMIT rows, the rest of window
+    is read from time of the last row, so export has no rows limit. No more
+    than export_concurrency jobs run at once, the others wait in queue.
+    Finished files are kept export_keep seconds.
+    """
+
+    def __init__(self, state) -> None:
+        """
+        Arguments:
+            state -- app.state with config and connector_database
+        """
+        self.state = state
+        self.jobs: dict[str, ExportJob] = {}
+        self.running = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def config(self) -> Config:
+        return self.state.config
+
+    def submit(
+        self,
+        kind: str,
+        file_format: str,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+    ) -> ExportJob:
+        """Queue export job
+
+        Arguments:
+            kind -- cdr or cel
+            file_format -- csv (gzip) or parquet
+            start_date -- start of range
+            end_date -- end of range
+
+        Raises:
+            BusinessError: wrong range, parquet without pyarrow, too many jobs
+
+        Returns:
+            new job
+        """
+        if start_date >= end_date:
+            raise BusinessError("The start date cannot be greater than or equal to the end date")
+        if file_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            raise BusinessError("Parquet export requires pyarrow: pip install pyarrow")
+        self.cleanup()
+        if len(self.jobs) >= self.config.export_max_jobs:
+            raise BusinessError(
+                f"Too many export jobs ({len(self.jobs)}), delete finished jobs or wait"
+            )
+        job_id = uuid.uuid4().hex
+        name = f"{self.config.pbx_name}-{job_id}.{EXTENSIONS[file_format]}"
+        path = os.path.join(self.config.export_dir, name)
+        job = ExportJob(job_id, kind, file_format, start_date, end_date, path)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self.run(job), name=f"export:{job.id}")
+        return job
+
+    def get(self, job_id: str) -> ExportJob:
+        """
+        Raises:
+            BusinessError: unknown job
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise BusinessError(f"Export job {job_id} is not found")
+        return job
+
+    def delete(self, job_id: str):
+        """Cancel job and remove its file"""
+        job = self.get(job_id)
+        if job.task and not job.task.done():
+            job.task.cancel()
+        self.jobs.pop(job_id, None)
+        self.remove_file(job)
+
+    def remove_file(self, job: ExportJob):
+        for path in (job.path, f"{job.path}.part"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                log.warning("Export file %s is not removed: %r", path, exc)
+
+    def cleanup(self):
+        """Forget finished jobs and remove files older than export_keep"""
+        expired = time.time() - self.config.export_keep
+        for job in list(self.jobs.values()):
+            if job.finished and job.finished < expired:
+                self.jobs.pop(job.id, None)
+                self.remove_file(job)
+        # files of jobs before restart
+        pattern = os.path.join(self.config.export_dir, f"{self.config.pbx_name}-*")
+        known = {job.path for job in self.jobs.values()}
+        for path in glob.glob(pattern):
+            if path.removesuffix(".part") in known:
+                continue
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    async def run(self, job: ExportJob):
+        """Wait for free slot, export range, errors are saved in job"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.running < self.config.export_concurrency)
+            self.running += 1
+        job.status = "running"
+        log.info("Export %s %s %s - %s started", job.id, job.kind, job.start_date, job.end_date)
+        try:
+            await self.export(job)
+            job.status = "done"
+            log.info("Export %s done: %s rows, %s bytes", job.id, job.rows, job.size)
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as exc:
+            log.exception("Export %s error: %s", job.id, exc)
+            job.status = "error"
+            job.error = f"{exc!r}"
+            self.remove_file(job)
+        finally:
+            job.finished = time.time()
+            async with self._condition:
+                self.running -= 1
+                self._condition.notify_all()
+
+    async def export(self, job: ExportJob):
+        os.makedirs(os.path.dirname(job.path) or ".", exist_ok=True)
+        part = f"{job.path}.part"
+        writer = CsvWriter(part) if job.format == "csv" else ParquetWriter(part)
+        try:
+            async for rows in self.chunks(job):
+                # compression and disk write do not block event loop
+                await asyncio.to_thread(writer.write, rows)
+                job.rows += len(rows)
+                job.size = os.path.getsize(part)
+        finally:
+            await asyncio.to_thread(writer.close)
+        os.replace(part, job.path)
+        job.size = os.path.getsize(job.path)
+
+    async def chunks(self, job: ExportJob) -> AsyncIterator[list[dict]]:
+        """Rows of range by chunks in time order. Window is halved after a window
+        with HISTORY_LIMIT rows (it needs more than one query) and grows back
+        after windows with few rows"""
+        step = datetime.timedelta(seconds=self.config.export_window)
+        start = job.start_date
+        while start <= job.end_date:
+            end = min(start + step, job.end_date)
+            # bounds are inclusive, next window starts after this one
+            last = end if end == job.end_date else end - datetime.timedelta(microseconds=1)
+            rows = 0
+            chunks = self.window(job, start, last)
+            try:
+                async for chunk in chunks:
+                    rows += len(chunk)
+                    yield chunk
+            finally:
+                await chunks.aclose()
+            job.exported_to = end
+            if end == job.end_date:
+                break
+            start = end
+            if rows >= HISTORY_LIMIT:
+                step = max(step / 2, datetime.timedelta(seconds=1))
+            elif rows < HISTORY_LIMIT // 4:
+                step = min(step * 2, datetime.timedelta(seconds=self.config.export_window))
+
+    async def window(self, job: ExportJob, start, end) -> AsyncIterator[list[dict]]:
+        """Rows of window by chunks. After a query with HISTORY_LIMIT rows the next
+        one starts at time of its last row (the value as database returned it),
+        rows of that time already written are skipped"""
+        if job.kind == "cdr":
+            field = self.state.connector_database.cdr_start_field
+        else:
+            field = "eventtime"
+        # rows of start time written by previous query -> count
+        skip: collections.Counter = collections.Counter()
+        while True:
+            chunk = []
+            count = 0
+            # rows of time of the last row
+            tail_time = None
+            tail: collections.Counter = collections.Counter()
+            rows = self.fetch(job.kind, start, end)
+            try:
+                async for row in rows:
+                    count += 1
+                    key = tuple(row.values())
+                    if row[field] != tail_time:
+                        tail_time, tail = row[field], collections.Counter()
+                    tail[key] += 1
+                    if skip[key]:
+                        skip[key] -= 1
+                        continue
+                    chunk.append(row)
+                    if len(chunk) >= CHUNK_ROWS:
+                        yield chunk
+                        chunk = []
+            finally:
+                await rows.aclose()
+            if chunk:
+                yield chunk
+            if count < HISTORY_LIMIT:
+                return
+            if count == tail.total():
+                log.warning("Export %s: more than %s rows at %s", job.id, HISTORY_LIMIT, tail_time)
+                return
+            start, skip = tail_time, tail
+
+    async def fetch(self, kind: str, start, end) -> AsyncIterator[dict]:
+        """Rows of window, read in low priority lane of database queries, waits
+        while the lane is busy"""
+        while True:
+            connector_database = self.state.connector_database
+            iter_rows = (
+                connector_database.iter_cdr if kind == "cdr" else connector_database.iter_cel
+            )
+            rows = iter_rows(start, end, ordered=True, lane="bulk")
+            read = False
+            try:
+                async for row in rows:
+                    read = True
+                    yield row
+                return
+            except OverloadError as exc:
+                # slot is taken before the first row
+                if read:
+                    raise
+                await asyncio.sleep(exc.retry_after)
+            finally:
+                await rows.aclose()
+
+    def close(self):
+        for job in self.jobs.values():
+            if job.task and not job.task.done():
+                job.task.cancel()
+
+    def stats(self) -> dict:
+        statuses: dict[str, int] = {}
+        for job in self.jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"running": self.running, **statuses}
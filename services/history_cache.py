@@ -0,0 +1,300 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Literal
+
+from schemas.config_schema import Config
+from services.cache import SingleFlight
+from services.queries import HISTORY_LIMIT
+from services.streaming import encode_value
+
+log = logging.getLogger("asterisk_agent")
+
+DAY = datetime.timedelta(days=1)
+# inclusive end of range, as history queries compare start <= end_date
+DAY_END = DAY - datetime.timedelta(microseconds=1)
+
+
+def encode_rows(rows: list[dict]) -> bytes:
+    """Rows as gzip JSON, decoded rows give the same response body"""
+    data = json.dumps(rows, ensure_ascii=False, separators=(",", ":"), default=encode_value)
+    return gzip.compress(data.encode(), compresslevel=6)
+
+
+def decode_rows(data: bytes) -> list[dict]:
+    return json.loads(gzip.decompress(data))
+
+
+class HistoryCache:
+    """Day buckets cache of calls/events history ranges.
+
+    Rows of past days do not change, while reports ask the same yesterday and
+    last week again and again. A range is split into whole days and partial
+    edge days: the whole days closed history_cache_settle seconds ago (CDR row
+    is written when the call ends) are read from cache, a missing day is read
+    by one query and cached, the edges and not closed days are queried every
+    time. Pieces are stitched in time order. A day is kept as gzip JSON in
+    memory LRU of history_cache_size bytes and, with history_cache_dir, in
+    files of history_cache_disk_size bytes, so the cache survives restart.
+    Day boundaries are wall clock of the request time zone, as the database
+    compares its local times with the range, so days are cached per UTC offset.
+    """
+
+    def __init__(self, state) -> None:
+        """
+        Arguments:
+            state -- app.state with config and connector_database
+        """
+        self.state = state
+        self.days: OrderedDict[tuple, bytes] = OrderedDict()
+        self.size = 0
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_size = 0
+        self.single_flight = SingleFlight()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # days with HISTORY_LIMIT rows, result may be truncated
+        self.uncached = 0
+        self.set_config(state.config)
+
+    @property
+    def config(self) -> Config:
+        return self.state.config
+
+    def set_config(self, config: Config):
+        # files of another database are not read (and are removed as the oldest ones)
+        database = f"{config.db_dialect}|{config.db_host}|{config.db_port}|{config.db_database}"
+        self.fingerprint = hashlib.sha1(
+            f"{database}|{config.db_table_cdr_name}".encode()
+        ).hexdigest()[:12]
+        if not config.history_cache_enable:
+            self.clear()
+        self.trim()
+        self.load_disk(config)
+
+    def clear(self):
+        """Drop days in memory, database was changed"""
+        self.days.clear()
+        self.size = 0
+
+    def trim(self):
+        while self.days and self.size > self.config.history_cache_size:
+            _, data = self.days.popitem(last=False)
+            self.size -= len(data)
+
+    def load_disk(self, config: Config):
+        """Index of cached files, the least recently used first"""
+        self.disk.clear()
+        self.disk_size = 0
+        if not (config.history_cache_enable and config.history_cache_dir):
+            return
+        pattern = os.path.join(config.history_cache_dir, f"{config.pbx_name}-*.json.gz")
+        files = []
+        for path in glob.glob(pattern):
+            try:
+                files.append((os.path.getmtime(path), path, os.path.getsize(path)))
+            except OSError:
+                pass
+        for _, path, size in sorted(files):
+            self.disk[path] = size
+            self.disk_size += size
+
+    @staticmethod
+    def key(kind: str, start: datetime.datetime) -> tuple:
+        """Day of request time zone: the same date of another UTC offset has other rows"""
+        return kind, start.date(), start.utcoffset()
+
+    def path(self, kind: str, start: datetime.datetime) -> str:
+        # +0300, empty for naive start
+        offset = start.strftime("%z")
+        day = f"{start.date().isoformat()}{offset}"
+        name = f"{self.config.pbx_name}-{self.fingerprint}-{kind}-{day}.json.gz"
+        return os.path.join(self.config.history_cache_dir, name)
+
+    def closed_before(self, tzinfo) -> datetime.date:
+        """First day which is not closed yet, by agent local time and request time
+        zone (the earlier one), minus history_cache_settle"""
+        now = min(
+            datetime.datetime.now(),
+            datetime.datetime.now(tzinfo).replace(tzinfo=None),
+        )
+        return (now - datetime.timedelta(seconds=self.config.history_cache_settle)).date()
+
+    def split(self, start_date: datetime.datetime, end_date: datetime.datetime) -> list[tuple]:
+        """Range as pieces in time order, bounds are inclusive
+
+        Returns:
+            [("day" or "query", start, end)], one query when there are no closed days
+        """
+        tzinfo = start_date.tzinfo
+        end_date = end_date.astimezone(tzinfo)
+        closed_before = self.closed_before(tzinfo)
+        first = start_date.date()
+        if datetime.datetime.combine(first, datetime.time(), tzinfo=tzinfo) < start_date:
+            first += DAY
+        start = datetime.datetime.combine(first, datetime.time(), tzinfo=tzinfo)
+        days = []
+        while start.date() < closed_before and start + DAY_END <= end_date:
+            days.append(("day", start, start + DAY_END))
+            start += DAY
+        if not days:
+            return [("query", start_date, end_date)]
+        pieces = []
+        if start_date < days[0][1]:
+            pieces.append(("query", start_date, days[0][1] - datetime.timedelta(microseconds=1)))
+        pieces.extend(days)
+        if start <= end_date:
+            pieces.append(("query", start, end_date))
+        return pieces
+
+    def iter_rows(
+        self, kind: Literal["cdr", "cel"], start_date, end_date, ordered: bool = False
+    ) -> AsyncIterator[dict]:
+        """Rows of range, the same as connector_database iter_cdr/iter_cel
+
+        Arguments:
+            kind -- cdr or cel
+            ordered -- rows in time order, stitched rows are always ordered
+        """
+        pieces = self.split(start_date, end_date) if self.config.history_cache_enable else []
+        if not any(piece == "day" for piece, _, _ in pieces):
+            return self.query(kind, start_date, end_date, ordered)
+        return self.stitch(kind, pieces)
+
+    def iter_cdr(self, start_date, end_date, ordered: bool = False) -> AsyncIterator[dict]:
+        return self.iter_rows("cdr", start_date, end_date, ordered)
+
+    def iter_cel(self, start_date, end_date, ordered: bool = False) -> AsyncIterator[dict]:
+        return self.iter_rows("cel", start_date, end_date, ordered)
+
+    def query(self, kind: str, start_date, end_date, ordered: bool) -> AsyncIterator[dict]:
+        connector_database = self.state.connector_database
+        iter_rows = connector_database.iter_cdr if kind == "cdr" else connector_database.iter_cel
+        return iter_rows(start_date, end_date, ordered=ordered)
+
+    async def stitch(self, kind: str, pieces: list[tuple]) -> AsyncIterator[dict]:
+        """Rows of pieces in order, no more than HISTORY_LIMIT as of one query"""
+        left = HISTORY_LIMIT
+        for piece, start, end in pieces:
+            if piece == "day":
+                rows = await self.day(kind, start, end)
+                for row in rows[:left]:
+                    yield row
+                left -= min(left, len(rows))
+            else:
+                rows = self.query(kind, start, end, ordered=True)
+                try:
+                    async for row in rows:
+                        yield row
+                        left -= 1
+                        if not left:
+                            break
+                finally:
+                    await rows.aclose()
+            if not left:
+                return
+
+    async def day(self, kind: str, start: datetime.datetime, end: datetime.datetime) -> list:
+        """Rows of closed day: memory, file or query (shared by concurrent callers)"""
+        key = self.key(kind, start)
+        data = self.days.get(key)
+        if data is not None:
+            self.days.move_to_end(key)
+            self.hits += 1
+            return await asyncio.to_thread(decode_rows, data)
+        return await self.single_flight.do(key, lambda: self.load(kind, start, end))
+
+    async def load(self, kind: str, start: datetime.datetime, end: datetime.datetime) -> list:
+        key = self.key(kind, start)
+        path = self.path(kind, start)
+        if path in self.disk:
+            try:
+                data = await asyncio.to_thread(self.read_file, path)
+                rows = await asyncio.to_thread(decode_rows, data)
+            except (OSError, EOFError, ValueError) as exc:
+                log.warning("History cache file %s is not read: %r", path, exc)
+                self.forget_file(path)
+            else:
+                self.disk.move_to_end(path)
+                self.disk_hits += 1
+                self.put(key, data)
+                return rows
+        self.misses += 1
+        rows = [row async for row in self.query(kind, start, end, ordered=True)]
+        if len(rows) >= HISTORY_LIMIT:
+            self.uncached += 1
+            return rows
+        data = await asyncio.to_thread(encode_rows, rows)
+        self.put(key, data)
+        if self.config.history_cache_dir:
+            try:
+                await asyncio.to_thread(self.write_file, path, data)
+            except OSError as exc:
+                log.warning("History cache file %s is not written: %r", path, exc)
+            else:
+                self.disk[path] = len(data)
+                self.disk_size += len(data)
+                self.trim_disk()
+        return rows
+
+    def put(self, key: tuple, data: bytes):
+        if not self.config.history_cache_enable or len(data) > self.config.history_cache_size:
+            return
+        old = self.days.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.days[key] = data
+        self.size += len(data)
+        self.trim()
+
+    @staticmethod
+    def read_file(path: str) -> bytes:
+        with open(path, "rb") as file:
+            data = file.read()
+        # mtime is recency of use after restart
+        os.utime(path)
+        return data
+
+    @staticmethod
+    def write_file(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        part = f"{path}.part"
+        with open(part, "wb") as file:
+            file.write(data)
+        os.replace(part, path)
+
+    def forget_file(self, path: str):
+        size = self.disk.pop(path, None)
+        if size is not None:
+            self.disk_size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def trim_disk(self):
+        while self.disk and self.disk_size > self.config.history_cache_disk_size:
+            self.forget_file(next(iter(self.disk)))
+
+    def stats(self) -> dict:
+        return {
+            "days": len(self.days),
+            "size": self.size,
+            "disk_days": len(self.disk),
+            "disk_size": self.disk_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.single_flight.coalesced,
+            "uncached": self.uncached,
+        }
@@ -0,0 +1,93 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+log = logging.getLogger("asterisk_agent")
+
+
+class EventLanes:
+    """Priority lanes of webhook delivery.
+
+    Every lane has own queues and workers, so events of a latency critical lane
+    (ringing, answer) are not waiting behind backlog of bulk events. Event goes
+    to lane of its type, other types to the last lane. In a lane events are
+    spread over workers by key (channel id), so events of one channel are
+    delivered in order. Workers start on first event.
+    """
+
+    def __init__(
+        self,
+        lanes: dict[str, int],
+        lane_events: dict[str, str],
+        size: int,
+        deliver: Callable[[str, dict], Awaitable],
+    ) -> None:
+        """
+        Arguments:
+            lanes -- lane name -> workers, in priority order
+            lane_events -- event type -> lane name
+            size -- queued events of lane, then put waits (backpressure)
+            deliver -- coroutine function (lane, event) of worker
+        """
+        self.lane_events = lane_events
+        self.default_lane = list(lanes)[-1]
+        self.deliver = deliver
+        self.queues: dict[str, list[asyncio.Queue]] = {
+            lane: [asyncio.Queue(max(1, size // workers)) for _ in range(workers)]
+            for lane, workers in lanes.items()
+        }
+        self.priorities = {lane: index for index, lane in enumerate(self.queues)}
+        self.tasks: list[asyncio.Task] = []
+
+    def priority(self, lane: str) -> int:
+        """Index of lane, 0 is the most latency critical"""
+        return self.priorities[lane]
+
+    def lane(self, event_type: str) -> str:
+        lane = self.lane_events.get(event_type, self.default_lane)
+        return lane if lane in self.queues else self.default_lane
+
+    async def put(self, event_type: str, key: str, event: dict):
+        """Queue event to its lane, waits while the worker queue is full"""
+        if not self.tasks:
+            self.start()
+        queues = self.queues[self.lane(event_type)]
+        await queues[hash(key) % len(queues)].put(event)
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self._worker(lane, queue))
+            for lane, queues in self.queues.items()
+            for queue in queues
+        ]
+
+    async def _worker(self, lane: str, queue: asyncio.Queue):
+        while True:
+            event = await queue.get()
+            try:
+                await self.deliver(lane, event)
+            except Exception as exc:
+                log.exception("Unknown event lane %s error: %s", lane, exc)
+            finally:
+                queue.task_done()
+
+    async def join(self):
+        """Wait until queued events are delivered"""
+        for queues in self.queues.values():
+            for queue in queues:
+                await queue.join()
+
+    def close(self):
+        """Stop workers, queued events are dropped"""
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def stats(self) -> dict:
+        return {
+            lane: {"workers": len(queues), "queued": sum(queue.qsize() for queue in queues)}
+            for lane, queues in self.queues.items()
+        }
@@ -0,0 +1,425 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import logging
+
+from pydantic import ValidationError
+from starlette.datastructures import State
+
+from dependencies.db import get_db_connector
+from exceptions.exceptions import BusinessError
+from schemas.config_schema import Config
+from services.ami import Ami
+from services.ari import Ari
+from services.capture import EventCapture, create_capture
+from services.cdr_cache import CdrCache
+from services.cel_tail import CelTail
+from services.channels import ChannelStore
+from services.checkup import Checkup
+from services.contacts import Contacts
+from services.dedup import EventDeduplicator
+from services.export import ExportJobs
+from services.history_cache import HistoryCache
+from services.logger import setup_logging
+from services.recovery import GapRecovery
+from services.webhook import WebhookSender
+from services.websocket import WebsocketEvents
+
+log = logging.getLogger("asterisk_agent")
+
+# settings, change of which requires new connection (others are applied on the fly)
+DB_FIELDS = (
+    "db_host",
+    "db_port",
+    "db_database",
+    "db_user",
+    "db_password",
+    "db_dialect",
+    "db_table_cdr_name",
+    "db_check_cdr_enable",
+    "db_pool_min_size",
+    "db_pool_max_size",
+    "db_stream_prefetch",
+    "db_statement_timeout",
+)
+ARI_CONNECTION_FIELDS = (
+    "ari_enable",
+    "ari_url",
+    "ari_wss",
+    "ari_login",
+    "ari_password",
+    "ari_ping_interval",
+    "ari_ping_timeout",
+    "ari_lanes",
+    "ari_lane_size",
+)
+CONTACTS_FIELDS = ("contacts_source", "contacts_refresh")
+AMI_CONNECTION_FIELDS = ("ami_enable", "ami_host", "ami_port", "ami_login", "ami_password")
+LOG_FIELDS = (
+    "log_level",
+    "log_levels",
+    "log_json",
+    "log_file",
+    "log_events_rate",
+    "log_events_burst",
+    "log_events_sample",
+)
+DEDUP_FIELDS = ("dedup_enable", "dedup_window", "dedup_max_size", "ari_enable", "ami_enable")
+CAPTURE_FIELDS = (
+    "capture_enable",
+    "capture_dir",
+    "capture_file_size",
+    "capture_files",
+    "pbx_name",
+)
+
+_reload_lock = asyncio.Lock()
+
+
+def create_channels(config: Config) -> ChannelStore | None:
+    if config.channels_enable:
+        return ChannelStore(max_size=config.channels_max_size)
+    return None
+
+
+async def create_contacts(config: Config) -> Contacts | None:
+    """Contacts loaded before events are received"""
+    if not config.contacts_enable:
+        return None
+    contacts = Contacts(config)
+    await contacts.refresh()
+    return contacts
+
+
+def create_dedup(config: Config) -> EventDeduplicator | None:
+    """The same occurrence comes from both ARI and AMI, send it to webhook once"""
+    if config.dedup_enable and config.ari_enable and config.ami_enable:
+        return EventDeduplicator(window=config.dedup_window, max_size=config.dedup_max_size)
+    return None
+
+
+def create_ami(
+    config: Config,
+    webhook: WebhookSender,
+    dedup: EventDeduplicator | None,
+    capture: EventCapture | None = None,
+    channels: ChannelStore | None = None,
+    contacts: Contacts | None = None,
+) -> Ami:
+    return Ami(
+        ami_config=config.ami_config,
+        webhook=webhook,
+        webhook_url=str(config.webhook_url),
+        dedup=dedup,
+        pbx=config.pbx_name,
+        capture=capture,
+        channels=channels,
+        contacts=contacts,
+    )
+
+
+def create_websocket_client(
+    config: Config,
+    webhook: WebhookSender,
+    dedup: EventDeduplicator | None,
+    recovery: GapRecovery | None = None,
+    cdr_cache: CdrCache | None = None,
+    capture: EventCapture | None = None,
+    channels: ChannelStore | None = None,
+    contacts: Contacts | None = None,
+) -> WebsocketEvents:
+    return WebsocketEvents(
+        ari_config=config.ari_config,
+        api_key=config.api_key,
+        webhook=webhook,
+        webhook_url=f"{config.webhook_url}",
+        dedup=dedup,
+        recovery=recovery,
+        cdr_cache=cdr_cache,
+        pbx=config.pbx_name,
+        capture=capture,
+        channels=channels,
+        contacts=contacts,
+    )
+
+
+async def create_db_connector(config: Config):
+    connector_database = get_db_connector(config)
+    if config.db_check_cdr_enable:
+        log.info("start check cdr version...")
+        try:
+            await connector_database.check_cdr_old()
+        except Exception as exc:
+            log.exception("Unknown check_cdr_old error: %s", exc)
+        log.info("end check cdr version")
+    return connector_database
+
+
+async def init_pbx(state, config: Config):
+    """Create objects of one PBX on state (app.state for main PBX)
+
+    Arguments:
+        state -- app.state or State of PBX from pbx_list
+        config -- config of the PBX
+    """
+    dedup = create_dedup(config)
+    state.background_tasks = {}
+    state.config = config
+    state.capture = create_capture(config)
+    state.webhook = WebhookSender(config)
+    state.channels = create_channels(config)
+    state.contacts = await create_contacts(config)
+    state.ari = Ari(api_key=config.api_key, ari_url=str(config.ari_url))
+    state.ami = create_ami(
+        config, state.webhook, dedup, state.capture, state.channels, state.contacts
+    )
+    state.dedup = dedup
+    state.websocket_client = None
+    state.connector_database = await create_db_connector(config)
+    state.cel_tail = CelTail(state)
+    state.cdr_cache = CdrCache(state)
+    state.history_cache = HistoryCache(state)
+    state.exports = ExportJobs(state)
+    state.checkup = Checkup(state, interval=config.checkup_interval, timeout=config.checkup_timeout)
+
+
+def start_pbx(state):
+    """Start background tasks of PBX"""
+    start_task(state, "checkup", state.checkup.run())
+    start_contacts(state)
+    start_ami(state)
+    start_ari(state)
+    start_cel_tail(state)
+
+
+async def stop_pbx(state):
+    """Cancel background tasks of PBX and close its database connections"""
+    for task in list(state.background_tasks.values()):
+        task.cancel()
+    state.exports.close()
+    await state.connector_database.close()
+    await state.webhook.close()
+    if state.capture:
+        state.capture.close()
+
+
+def start_task(state, name: str, coro) -> asyncio.Task:
+    """Start background task of PBX, previous task with the name is cancelled"""
+    stop_task(state, name)
+    task = asyncio.create_task(coro, name=f"{state.config.pbx_name}:{name}")
+    state.background_tasks[name] = task
+
+    def done(_):
+        if state.background_tasks.get(name) is task:
+            del state.background_tasks[name]
+
+    task.add_done_callback(done)
+    return task
+
+
+def stop_task(state, name: str):
+    task = state.background_tasks.pop(name, None)
+    if task:
+        task.cancel()
+
+
+def start_ami(state):
+    if state.config.ami_enable:
+        start_task(state, "ami", state.ami.start_catch_events())
+    else:
+        stop_task(state, "ami")
+
+
+def start_ari(state):
+    if state.config.ari_enable:
+        state.websocket_client = create_websocket_client(
+            state.config,
+            state.webhook,
+            state.dedup,
+            GapRecovery(state),
+            state.cdr_cache,
+            state.capture,
+            state.channels,
+            state.contacts,
+        )
+        start_task(state, "ari", state.websocket_client.run())
+    else:
+        stop_task(state, "ari")
+        state.websocket_client = None
+
+
+def start_contacts(state):
+    """Refresh contacts in background"""
+    if state.contacts:
+        start_task(state, "contacts", state.contacts.run())
+    else:
+        stop_task(state, "contacts")
+
+
+def start_cel_tail(state):
+    if state.config.cel_tail_enable:
+        if "cel_tail" not in state.background_tasks:
+            start_task(state, "cel_tail", state.cel_tail.run())
+    else:
+        stop_task(state, "cel_tail")
+
+
+async def reload_pbx(state, new: Config) -> list[str]:
+    """Apply new config of one PBX.
+
+    New state is prepared first, then swapped on state without awaits between
+    assignments, so requests see either old or new state. ARI websocket and AMI
+    session are kept when their connection settings are unchanged, old database
+    strategy is closed after running queries finish.
+
+    Returns:
+        names of changed settings
+    """
+    old: Config = state.config
+    changed = [name for name in Config.model_fields if getattr(old, name) != getattr(new, name)]
+    if not changed:
+        return changed
+
+    def is_changed(fields) -> bool:
+        return any(name in changed for name in fields)
+
+    # prepare
+    connector_database = None
+    if is_changed(DB_FIELDS):
+        connector_database = await create_db_connector(new)
+    dedup = create_dedup(new) if is_changed(DEDUP_FIELDS) else state.dedup
+    capture = create_capture(new) if is_changed(CAPTURE_FIELDS) else state.capture
+    channels = create_channels(new) if "channels_enable" in changed else state.channels
+    if channels:
+        channels.max_size = new.channels_max_size
+    contacts = state.contacts
+    if "contacts_enable" in changed:
+        contacts = await create_contacts(new)
+    elif contacts and contacts.set_config(new):
+        await contacts.refresh()
+    restart_contacts = contacts is not state.contacts or is_changed(CONTACTS_FIELDS)
+    restart_ami = is_changed(AMI_CONNECTION_FIELDS) or "pbx_name" in changed
+    restart_ari = (
+        is_changed(ARI_CONNECTION_FIELDS)
+        or is_changed(("ari_subscribe_all",))
+        or "pbx_name" in changed
+    )
+
+    # swap
+    state.config = new
+    state.ari = Ari(api_key=new.api_key, ari_url=str(new.ari_url))
+    state.dedup = dedup
+    state.channels = channels
+    state.contacts = contacts
+    old_capture = None
+    if capture is not state.capture:
+        old_capture = state.capture
+        state.capture = capture
+    old_connector_database = None
+    if connector_database:
+        old_connector_database = state.connector_database
+        state.connector_database = connector_database
+        state.cdr_cache.clear()
+        state.history_cache.clear()
+    state.cdr_cache.set_config(new)
+    state.history_cache.set_config(new)
+    state.connector_database.admission.set_config(new)
+    state.webhook.set_config(new)
+    state.checkup.interval = new.checkup_interval
+    state.checkup.timeout = new.checkup_timeout
+
+    if restart_ami:
+        state.ami = create_ami(new, state.webhook, dedup, capture, channels, contacts)
+        start_ami(state)
+    if restart_ari:
+        start_ari(state)
+    if "cel_tail_state_file" in changed:
+        state.cel_tail = CelTail(state)
+        stop_task(state, "cel_tail")
+    start_cel_tail(state)
+    if restart_contacts:
+        start_contacts(state)
+
+    # apply on alive connections
+    if old_capture:
+        old_capture.close()
+    if old_connector_database:
+        start_task(state, f"db_drain_{id(old_connector_database)}", old_connector_database.drain())
+    if not restart_ami:
+        state.ami.capture = capture
+        state.ami.channels = channels
+        state.ami.contacts = contacts
+        await state.ami.set_config(new.ami_config, str(new.webhook_url), dedup)
+    websocket_client: WebsocketEvents | None = state.websocket_client
+    if not restart_ari and websocket_client:
+        websocket_client.capture = capture
+        websocket_client.channels = channels
+        websocket_client.contacts = contacts
+        try:
+            reconnect = await websocket_client.set_config(
+                new.ari_config, f"{new.webhook_url}", dedup
+            )
+        except Exception as exc:
+            log.exception("ARI subscribe error after config reload: %s", exc)
+            reconnect = True
+        if reconnect:
+            start_task(state, "ari", websocket_client.run())
+
+    return changed
+
+
+async def reload_config(app) -> list[str]:
+    """Read config again and apply it to every PBX without restart.
+    PBX added to pbx_list are started, removed are stopped.
+
+    Raises:
+        BusinessError: new config is not valid, old config is kept
+
+    Returns:
+        names of changed settings, "name:setting" for PBX from pbx_list
+    """
+    async with _reload_lock:
+        try:
+            new = Config()  # type: ignore
+            configs = new.pbx_configs()
+        except ValidationError as exc:
+            raise BusinessError(f"Config is not valid, not applied: {exc}") from exc
+
+        if any(getattr(app.state.config, name) != getattr(new, name) for name in LOG_FIELDS):
+            setup_logging(new)
+
+        changed = []
+        pbx = {new.pbx_name: app.state}
+        for name, config in configs.items():
+            state = app.state if config is new else app.state.pbx.get(name)
+            if state is None:
+                state = State()
+                await init_pbx(state, config)
+                start_pbx(state)
+                changed.append(f"{name}:pbx_list")
+            else:
+                changed.extend(
+                    setting if config is new else f"{name}:{setting}"
+                    for setting in await reload_pbx(state, config)
+                )
+            pbx[name] = state
+        for name, state in app.state.pbx.items():
+            if state is not app.state and pbx.get(name) is not state:
+                await stop_pbx(state)
+                changed.append(f"{name}:pbx_list")
+        app.state.pbx = pbx
+
+        if changed:
+            log.info("Config reload, changed: %s", changed)
+        return changed
+
+
+async def reload_config_signal(app):
+    """SIGHUP handler, errors only logged"""
+    try:
+        await reload_config(app)
+    except BusinessError as exc:
+        log.error(exc.detail)
+    except Exception as exc:
+        log.exception("Unknown config reload error: %s", exc)
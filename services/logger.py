@@ -0,0 +1,169 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import datetime
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from schemas.config_schema import Config
+
+# loggers of every ARI/AMI event, rate limited
+EVENTS_LOGGERS = (
+    "asterisk_agent.ari.events",
+    "asterisk_agent.ami.events",
+    "asterisk_agent.cel.events",
+)
+# attributes of every LogRecord, other attributes are extra
+RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+_listener: QueueListener | None = None
+# logger name -> its level before log_levels, restored when it is removed from log_levels
+_default_levels: dict[str, int] = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, extra fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Sampling and token bucket rate limit per message template, so event storms
+    can not flood log. The next passed record gets "suppressed" count."""
+
+    def __init__(self, rate: float = 20, burst: int = 100, sample: int = 1) -> None:
+        """
+        Arguments:
+            rate -- records per second of one template
+            burst -- records allowed at once
+            sample -- pass only every sample-th record
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = max(1, sample)
+        # template -> [tokens, last time, suppressed, seen]
+        self._buckets: dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        bucket = self._buckets.get(record.msg)
+        now = time.monotonic()
+        if bucket is None:
+            bucket = self._buckets[record.msg] = [self.burst, now, 0, 0]
+
+        bucket[3] += 1
+        if bucket[3] % self.sample:
+            bucket[2] += 1
+            return False
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler that does not format message in event loop thread.
+    Message is formatted by listener thread, so log call only puts record to queue.
+    Arguments of log calls must not be changed after the call.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # traceback keeps frames alive, format it now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(config: Config) -> QueueListener:
+    """Log to file and stdout from background thread.
+    Can be called again (config reload), previous listener is stopped.
+    """
+    global _listener
+
+    if config.log_json:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%H:%M:%S")
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if config.log_file:
+        handlers.append(
+            RotatingFileHandler(
+                filename=config.log_file,
+                mode="a",
+                maxBytes=5 * 1024 * 1024,
+                backupCount=2,
+                encoding=None,
+            )
+        )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(config.log_level)
+
+    for name in set(_default_levels) - set(config.log_levels):
+        logging.getLogger(name).setLevel(_default_levels.pop(name))
+    for name, level in config.log_levels.items():
+        logger = logging.getLogger(name)
+        _default_levels.setdefault(name, logger.level)
+        logger.setLevel(level)
+    for name in EVENTS_LOGGERS:
+        logger = logging.getLogger(name)
+        for log_filter in logger.filters[:]:
+            logger.removeFilter(log_filter)
+        logger.addFilter(
+            RateLimitFilter(
+                rate=config.log_events_rate,
+                burst=config.log_events_burst,
+                sample=config.log_events_sample,
+            )
+        )
+
+    stop_logging()
+    listener.start()
+    _listener = listener
+    return listener
+
+
+def stop_logging():
+    """Flush queue and stop listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,225 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import functools
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+EVENTS_RECEIVED = Counter(
+    "asterisk_agent_events_received_total",
+    "Events received from Asterisk",
+    ["pbx", "source", "type"],
+)
+EVENTS_FILTERED = Counter(
+    "asterisk_agent_events_filtered_total",
+    "Events not sent to webhook (ignored, not used, duplicate)",
+    ["pbx", "source", "type"],
+)
+EVENTS_DELIVERED = Counter(
+    "asterisk_agent_events_delivered_total",
+    "Events delivered to webhook",
+    ["pbx", "source", "type"],
+)
+WEBHOOK_LATENCY = Histogram(
+    "asterisk_agent_webhook_latency_seconds",
+    "Webhook request latency",
+    ["pbx", "source"],
+    buckets=LATENCY_BUCKETS,
+)
+WEBHOOK_RESPONSES = Counter(
+    "asterisk_agent_webhook_responses_total",
+    "Webhook responses by status code (error - no response)",
+    ["pbx", "source", "status"],
+)
+WEBHOOK_QUEUE_DEPTH = Gauge(
+    "asterisk_agent_webhook_queue_depth",
+    "Events waiting for webhook delivery",
+    ["pbx", "source"],
+)
+EVENT_DELIVERY = Histogram(
+    "asterisk_agent_event_delivery_seconds",
+    "Time from Asterisk event timestamp to webhook answer, per delivery lane",
+    ["pbx", "source", "lane"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_LATENCY = Histogram(
+    "asterisk_agent_db_query_seconds",
+    "Database query latency per DatabaseStrategy method",
+    ["pbx", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_ROWS = Histogram(
+    "asterisk_agent_db_query_rows",
+    "Rows returned per DatabaseStrategy method",
+    ["pbx", "method"],
+    buckets=ROWS_BUCKETS,
+)
+DB_QUEUE_WAIT = Histogram(
+    "asterisk_agent_db_queue_wait_seconds",
+    "Time a database query waited for admission, per query class",
+    ["pbx", "lane"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_REJECTED = Counter(
+    "asterisk_agent_db_rejected_total",
+    "Database queries rejected after db_queue_timeout (HTTP 503)",
+    ["pbx", "lane"],
+)
+RECORDING_BYTES = Counter(
+    "asterisk_agent_recording_bytes_total", "Call recordings bytes served", ["pbx", "source"]
+)
+HTTP_LATENCY = Histogram(
+    "asterisk_agent_http_request_seconds",
+    "HTTP request latency per route",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class BoundLabels:
+    """Cache of metric children bound to labels.
+    metric.labels() validates and builds label tuple on every call, here the
+    child is created once and then found by one dict lookup without allocations.
+
+    EVENTS_RECEIVED_ARI = BoundLabels(EVENTS_RECEIVED, "default", "ari")
+    EVENTS_RECEIVED_ARI["ChannelDestroyed"].inc()
+    """
+
+    __slots__ = ("metric", "prefix", "children")
+
+    def __init__(self, metric, *prefix: str) -> None:
+        self.metric = metric
+        self.prefix = prefix
+        self.children = {}
+
+    def __getitem__(self, key):
+        child = self.children.get(key)
+        if child is None:
+            labels = key if isinstance(key, tuple) else (key,)
+            child = self.children[key] = self.metric.labels(*self.prefix, *labels)
+        return child
+
+
+WEBHOOK_SOURCES = ("ari", "ami", "cel")
+
+
+class PbxMetrics:
+    """Metric children of one PBX (pbx label), bound once per PBX name
+
+    metrics.pbx_metrics("default").ari_events_received["ChannelDestroyed"].inc()
+    """
+
+    def __init__(self, pbx: str) -> None:
+        self.pbx = pbx
+        self.ari_events_received = BoundLabels(EVENTS_RECEIVED, pbx, "ari")
+        self.ari_events_filtered = BoundLabels(EVENTS_FILTERED, pbx, "ari")
+        self.ari_events_delivered = BoundLabels(EVENTS_DELIVERED, pbx, "ari")
+        self.ami_events_received = BoundLabels(EVENTS_RECEIVED, pbx, "ami")
+        self.ami_events_filtered = BoundLabels(EVENTS_FILTERED, pbx, "ami")
+        self.ami_events_delivered = BoundLabels(EVENTS_DELIVERED, pbx, "ami")
+        self.cel_events_received = BoundLabels(EVENTS_RECEIVED, pbx, "cel")
+        self.cel_events_filtered = BoundLabels(EVENTS_FILTERED, pbx, "cel")
+        self.cel_events_delivered = BoundLabels(EVENTS_DELIVERED, pbx, "cel")
+        self.webhook_status = {
+            source: BoundLabels(WEBHOOK_RESPONSES, pbx, source) for source in WEBHOOK_SOURCES
+        }
+        self.webhook_latency = {
+            source: WEBHOOK_LATENCY.labels(pbx, source) for source in WEBHOOK_SOURCES
+        }
+        self.webhook_queue_depth = {
+            source: WEBHOOK_QUEUE_DEPTH.labels(pbx, source) for source in WEBHOOK_SOURCES
+        }
+        self.ari_event_delivery = BoundLabels(EVENT_DELIVERY, pbx, "ari")
+        self.db_latency = BoundLabels(DB_LATENCY, pbx)
+        self.db_rows = BoundLabels(DB_ROWS, pbx)
+        self.db_queue_wait = BoundLabels(DB_QUEUE_WAIT, pbx)
+        self.db_rejected = BoundLabels(DB_REJECTED, pbx)
+        self.recording_bytes_ari = RECORDING_BYTES.labels(pbx, "ari")
+        self.recording_bytes_file = RECORDING_BYTES.labels(pbx, "file")
+
+    def observe_webhook(self, source: str, started: float, status: int | str):
+        """Record webhook latency from started (time.perf_counter) and status"""
+        self.webhook_latency[source].observe(time.perf_counter() - started)
+        self.webhook_status[source][status].inc()
+
+
+_PBX_METRICS: dict[str, PbxMetrics] = {}
+
+
+def pbx_metrics(pbx: str) -> PbxMetrics:
+    """Metrics of PBX by name, created on first use"""
+    metrics = _PBX_METRICS.get(pbx)
+    if metrics is None:
+        metrics = _PBX_METRICS[pbx] = PbxMetrics(pbx)
+    return metrics
+
+
+HTTP_LATENCY_ROUTE = BoundLabels(HTTP_LATENCY)
+
+
+def observe_query(method: str, func):
+    """Wrap DatabaseStrategy coroutine method to record latency and rows count,
+    pbx label is from strategy config"""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        metrics = pbx_metrics(self.config.pbx_name)
+        started = time.perf_counter()
+        try:
+            result = await func(self, *args, **kwargs)
+        finally:
+            metrics.db_latency[method].observe(time.perf_counter() - started)
+        if isinstance(result, (list, tuple)):
+            metrics.db_rows[method].observe(len(result))
+        return result
+
+    return wrapper
+
+
+async def observe_stream(pbx: str, method: str, rows):
+    """Wrap DatabaseStrategy rows iterator to record latency (until the last row)
+    and rows count"""
+    metrics = pbx_metrics(pbx)
+    started = time.perf_counter()
+    count = 0
+    try:
+        async for row in rows:
+            count += 1
+            yield row
+    finally:
+        metrics.db_latency[method].observe(time.perf_counter() - started)
+        metrics.db_rows[method].observe(count)
+
+
+class MetricsMiddleware:
+    """ASGI middleware, HTTP request latency per route template (not raw path,
+    to keep labels cardinality low)"""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_LATENCY_ROUTE[(path, scope["method"], status)].observe(
+                time.perf_counter() - started
+            )
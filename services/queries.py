@@ -0,0 +1,205 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import re
+from operator import itemgetter
+from typing import Literal
+
+Dialect = Literal["sqlite", "mysql", "postgresql", "asyncpg"]
+
+# rows of one history query, export jobs split time range by it
+HISTORY_LIMIT = 100000
+
+# query name -> SQL with :named parameters and {cdr} (cdr table), {start} (cdr start
+# column, calldate or start) identifiers. A new query is added here once for all dialects.
+QUERIES = {
+    "get_cdr_uniqueid": "SELECT * FROM {cdr} WHERE uniqueid = :uniqueid",
+    "get_cdr_uniqueid_or_linkedid": (
+        "SELECT * FROM {cdr} WHERE uniqueid = :uniqueid OR linkedid = :uniqueid"
+    ),
+    "get_cdr": (
+        "SELECT * FROM {cdr} WHERE {start} >= :start_date AND {start} <= :end_date "
+        f"LIMIT {HISTORY_LIMIT}"
+    ),
+    "get_cdr_ordered": (
+        "SELECT * FROM {cdr} WHERE {start} >= :start_date AND {start} <= :end_date "
+        f"ORDER BY {{start}} LIMIT {HISTORY_LIMIT}"
+    ),
+    "get_cdr_last": "SELECT * FROM {cdr} ORDER BY {start} DESC LIMIT 1",
+    "get_cel": (
+        "SELECT * FROM cel WHERE eventtime >= :start_date AND eventtime <= :end_date "
+        f"LIMIT {HISTORY_LIMIT}"
+    ),
+    "get_cel_ordered": (
+        "SELECT * FROM cel WHERE eventtime >= :start_date AND eventtime <= :end_date "
+        f"ORDER BY eventtime, id LIMIT {HISTORY_LIMIT}"
+    ),
+    "get_cel_since": (
+        "SELECT * FROM cel WHERE eventtime >= :eventtime AND (eventtime > :eventtime OR id > :id) "
+        "ORDER BY eventtime, id LIMIT :limit"
+    ),
+    "get_cel_last": "SELECT * FROM cel ORDER BY eventtime DESC, id DESC LIMIT 1",
+    "get_ring_groups": "SELECT * FROM asterisk.ringgroups",
+    "get_queues_config": "SELECT * FROM asterisk.queues_config",
+    "get_findmefollow": "SELECT * FROM asterisk.findmefollow",
+}
+# the same result as "get_cdr_uniqueid_or_linkedid" by two index lookups instead of
+# full scan by OR, used when uniqueid and linkedid are both indexed
+CDR_UNIQUEID_OR_LINKEDID_UNION = (
+    "SELECT * FROM {cdr} WHERE uniqueid = :uniqueid "
+    "UNION ALL SELECT * FROM {cdr} WHERE linkedid = :uniqueid AND uniqueid <> :uniqueid"
+)
+
+# schema introspection per dialect: columns (column_name, pk), leading column of every
+# index (index_name, column_name) and estimated rows count (rows) of :table
+SCHEMA_QUERIES = {
+    "sqlite": {
+        "schema_columns": "SELECT name AS column_name, pk FROM pragma_table_info(:table)",
+        "schema_indexes": (
+            "SELECT il.name AS index_name, ii.name AS column_name "
+            "FROM pragma_index_list(:table) AS il, pragma_index_info(il.name) AS ii "
+            "WHERE ii.seqno = 0"
+        ),
+        # without statistics, rowid of last row
+        "schema_rows": "SELECT MAX(rowid) AS rows FROM {table}",
+    },
+    "mysql": {
+        "schema_columns": (
+            "SELECT COLUMN_NAME AS column_name, 0 AS pk FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+        ),
+        "schema_indexes": (
+            "SELECT INDEX_NAME AS index_name, COLUMN_NAME AS column_name "
+            "FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND SEQ_IN_INDEX = 1"
+        ),
+        "schema_rows": (
+            "SELECT TABLE_ROWS AS `rows` FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+        ),
+    },
+    "postgresql": {
+        "schema_columns": (
+            "SELECT column_name, 0 AS pk FROM information_schema.columns "
+            "WHERE table_name = :table AND table_schema = current_schema()"
+        ),
+        "schema_indexes": (
+            "SELECT i.relname AS index_name, a.attname AS column_name "
+            "FROM pg_index x JOIN pg_class t ON t.oid = x.indrelid "
+            "JOIN pg_class i ON i.oid = x.indexrelid "
+            "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0] "
+            "WHERE t.relname = :table AND t.relnamespace = current_schema()::regnamespace"
+        ),
+        "schema_rows": (
+            "SELECT CAST(reltuples AS BIGINT) AS rows FROM pg_class "
+            "WHERE relname = :table AND relnamespace = current_schema()::regnamespace"
+        ),
+    },
+}
+SCHEMA_QUERIES["asyncpg"] = SCHEMA_QUERIES["postgresql"]
+
+# index creation without long write locks where dialect allows it
+CREATE_INDEX = {
+    "sqlite": "CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})",
+    "mysql": "CREATE INDEX {name} ON {table} ({column}) ALGORITHM=INPLACE LOCK=NONE",
+    "postgresql": "CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})",
+    "asyncpg": "CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})",
+}
+
+PARAM_RE = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+class Query:
+    """Query compiled for one dialect: SQL text with driver placeholders and
+    order of parameters. Built once, on request only arguments tuple is made."""
+
+    __slots__ = ("name", "sql", "params", "_getter")
+
+    def __init__(self, name: str, sql: str, params: tuple[str, ...]) -> None:
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self._getter = itemgetter(*params) if params else None
+
+    def args(self, values: dict) -> tuple:
+        """Arguments in placeholders order
+
+        Raises:
+            KeyError: parameter value is missing
+        """
+        if self._getter is None:
+            return ()
+        if len(self.params) == 1:
+            return (self._getter(values),)
+        return self._getter(values)
+
+    def __repr__(self) -> str:
+        return f"Query({self.name!r}, {self.sql!r}, {self.params!r})"
+
+
+def compile_query(name: str, template: str, dialect: Dialect, **identifiers: str) -> Query:
+    """Compile SQL template for dialect
+
+    Arguments:
+        name -- query name
+        template -- SQL with :named parameters and {identifier} fields
+        dialect -- sqlite (?), mysql and postgresql (%s), asyncpg ($1, $2...)
+        identifiers -- values of {identifier} fields (table and column names from config)
+
+    Returns:
+        compiled query
+    """
+    sql = template.format(**identifiers)
+    params: list[str] = []
+
+    def placeholder(match: re.Match) -> str:
+        param = match.group(1)
+        if dialect == "asyncpg":
+            # numbered placeholder, the same parameter is passed once
+            if param not in params:
+                params.append(param)
+            return f"${params.index(param) + 1}"
+        params.append(param)
+        return "?" if dialect == "sqlite" else "%s"
+
+    sql = PARAM_RE.sub(placeholder, sql)
+    return Query(name, sql, tuple(params))
+
+
+def compile_queries(
+    dialect: Dialect,
+    cdr_table: str,
+    cdr_start_field: str,
+    union_linkedid: bool = False,
+    statement_timeout: float = 0,
+) -> dict[str, Query]:
+    """Compile all QUERIES for dialect and cdr table
+
+    Arguments:
+        union_linkedid -- uniqueid or linkedid lookup by UNION of two index lookups
+        statement_timeout -- seconds, mysql MAX_EXECUTION_TIME optimizer hint (other
+            dialects set it for connection, MariaDB ignores the hint)
+
+    Returns:
+        query name -> compiled query
+    """
+    templates = dict(QUERIES)
+    if union_linkedid:
+        templates["get_cdr_uniqueid_or_linkedid"] = CDR_UNIQUEID_OR_LINKEDID_UNION
+    if dialect == "mysql" and statement_timeout:
+        hint = f"SELECT /*+ MAX_EXECUTION_TIME({int(statement_timeout * 1000)}) */ "
+        templates = {
+            name: hint + template.removeprefix("SELECT ") for name, template in templates.items()
+        }
+    return {
+        name: compile_query(name, template, dialect, cdr=cdr_table, start=cdr_start_field)
+        for name, template in templates.items()
+    }
+
+
+def compile_schema_queries(dialect: Dialect, table: str) -> dict[str, Query]:
+    """Compile SCHEMA_QUERIES of dialect for table"""
+    return {
+        name: compile_query(name, template.replace("{table}", table), dialect)
+        for name, template in SCHEMA_QUERIES[dialect].items()
+    }
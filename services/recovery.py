@@ -0,0 +1,149 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import datetime
+import logging
+import posixpath
+
+import httpx
+
+from schemas.config_schema import Config
+from services.cel import CEL_EVENTS, cel_extra, cel_row_to_event
+
+log = logging.getLogger("asterisk_agent.ari")
+
+ARI_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
+
+
+def ari_time(value: str) -> datetime.datetime | None:
+    """ARI timestamp "2024-05-11T16:04:53.044+0300" to local naive datetime"""
+    try:
+        return datetime.datetime.strptime(value, ARI_TIME_FORMAT).astimezone().replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+class GapRecovery:
+    """Events lost while ARI websocket was disconnected.
+
+    CEL rows of the outage window are converted to ARI like events, channels and
+    bridges that are alive now in Asterisk fill what CEL does not have (CEL
+    disabled, bridges). Synthesized events have "synthesized": True and are sent
+    through the usual filters and deduplication, so events already delivered by
+    AMI are not sent twice.
+    """
+
+    def __init__(self, state) -> None:
+        """
+        Arguments:
+            state -- app.state with config and connector_database
+        """
+        super().__init__()
+        self.state = state
+
+    async def ari_state(self) -> tuple[dict[str, dict], list[dict]]:
+        """Alive channels (id -> Channel) and bridges from ARI"""
+        config: Config = self.state.config
+        async with httpx.AsyncClient() as client:
+            res = await client.get(
+                posixpath.join(f"{config.ari_url}", "channels"),
+                params={"api_key": config.api_key},
+            )
+            res.raise_for_status()
+            channels = {channel["id"]: channel for channel in res.json()}
+            res = await client.get(
+                posixpath.join(f"{config.ari_url}", "bridges"),
+                params={"api_key": config.api_key},
+            )
+            res.raise_for_status()
+            return channels, res.json()
+
+    async def cel_rows(self, start: datetime.datetime, end: datetime.datetime) -> list[dict]:
+        rows = await self.state.connector_database.get_cel(start, end)
+        rows = [dict(row) for row in rows]
+        rows.sort(key=lambda row: (f"{row.get('eventtime')}", row.get("id") or 0))
+        return rows
+
+    async def events(self, start: datetime.datetime, end: datetime.datetime) -> list[dict]:
+        """Synthesize events of the outage window
+
+        Arguments:
+            start -- disconnect time, local
+            end -- reconnect time, local
+
+        Returns:
+            ARI like events: from CEL in time order, then from alive channels
+        """
+        events = []
+        # (uniqueid, event type) already synthesized from CEL
+        seen = set()
+        # uniqueid -> hangup cause, CHAN_END has no cause but HANGUP before it has
+        causes = {}
+
+        try:
+            rows = await self.cel_rows(start, end)
+        except Exception as exc:
+            log.exception("Gap recovery CEL error: %s", exc)
+            rows = []
+        for row in rows:
+            if row.get("eventtype") not in CEL_EVENTS:
+                continue
+            event = cel_row_to_event(row)
+            uniqueid = row.get("uniqueid")
+            if row.get("eventtype") == "HANGUP":
+                causes[uniqueid] = cel_extra(row).get("hangupcause", 0)
+            elif event["type"] == "ChannelDestroyed" and not event["cause"]:
+                event["cause"] = causes.get(uniqueid, 0)
+            seen.add((uniqueid, event["type"]))
+            events.append(event)
+
+        try:
+            channels, bridges = await self.ari_state()
+        except Exception as exc:
+            log.exception("Gap recovery ARI error: %s", exc)
+            channels, bridges = {}, []
+
+        def created_in_gap(channel: dict) -> bool:
+            created = ari_time(channel.get("creationtime"))
+            return created is not None and start <= created <= end
+
+        for channel in channels.values():
+            if not created_in_gap(channel):
+                continue
+            if (channel["id"], "ChannelCreated") not in seen:
+                events.append(
+                    {
+                        "type": "ChannelCreated",
+                        "timestamp": channel["creationtime"],
+                        "channel": {**channel, "state": "Down"},
+                        "synthesized": True,
+                    }
+                )
+            if channel.get("state") == "Up" and (channel["id"], "ChannelStateChange") not in seen:
+                events.append(
+                    {
+                        "type": "ChannelStateChange",
+                        "timestamp": channel["creationtime"],
+                        "channel": channel,
+                        "synthesized": True,
+                    }
+                )
+        for bridge in bridges:
+            for channel_id in bridge.get("channels", []):
+                channel = channels.get(channel_id)
+                if channel is None or not created_in_gap(channel):
+                    continue
+                if (channel_id, "ChannelEnteredBridge") in seen:
+                    continue
+                events.append(
+                    {
+                        "type": "ChannelEnteredBridge",
+                        "timestamp": channel["creationtime"],
+                        "channel": channel,
+                        "bridge": bridge,
+                        "synthesized": True,
+                    }
+                )
+
+        log.info("Gap recovery %s - %s: %s events", start, end, len(events))
+        return events
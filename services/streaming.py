@@ -0,0 +1,171 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import json
+import os
+import urllib.parse
+from typing import AsyncIterator
+
+import aiofiles
+from fastapi import Response
+from fastapi.encoders import ENCODERS_BY_TYPE, jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.status import (
+    HTTP_200_OK,
+    HTTP_206_PARTIAL_CONTENT,
+    HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+)
+
+# rows in one written chunk
+CHUNK_ROWS = 500
+# bytes of file read at once
+FILE_CHUNK_SIZE = 256 * 1024
+
+
+def encode_value(value):
+    """JSON of not serializable value (datetime, Decimal...) the same as
+    jsonable_encoder, rows of plain values are not walked by jsonable_encoder"""
+    encoder = ENCODERS_BY_TYPE.get(type(value))
+    return encoder(value) if encoder else jsonable_encoder(value)
+
+
+def dumps(row: dict) -> str:
+    """The same JSON as FastAPI JSONResponse"""
+    return json.dumps(row, ensure_ascii=False, separators=(",", ":"), default=encode_value)
+
+
+async def json_array_response(rows: AsyncIterator[dict]) -> StreamingResponse:
+    """JSON array response written while rows are read from database,
+    so big history is not kept in memory.
+
+    The first row is read before response starts, so connection and query errors
+    are returned as usual error responses, not as broken body.
+    """
+    rows = aiter(rows)
+    try:
+        first = await anext(rows)
+    except StopAsyncIteration:
+        first = None
+
+    async def body():
+        if first is None:
+            yield "[]"
+            return
+        chunk = ["[", dumps(first)]
+        try:
+            async for row in rows:
+                chunk.append(",")
+                chunk.append(dumps(row))
+                if len(chunk) >= CHUNK_ROWS * 2:
+                    yield "".join(chunk)
+                    chunk = []
+        finally:
+            # client is gone: release database connection now, not on garbage collection
+            await rows.aclose()
+        chunk.append("]")
+        yield "".join(chunk)
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
+def ndjson_response(rows: AsyncIterator[dict]) -> StreamingResponse:
+    """NDJSON response (one JSON object per line) written while rows are read,
+    for merged history of several sources where error of one source is a line too"""
+
+    async def body():
+        chunk = []
+        try:
+            async for row in rows:
+                chunk.append(dumps(row))
+                chunk.append("\n")
+                if len(chunk) >= CHUNK_ROWS * 2:
+                    yield "".join(chunk)
+                    chunk = []
+        finally:
+            await rows.aclose()
+        yield "".join(chunk)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """First range of Range header "bytes=start-end", "bytes=start-" or "bytes=-suffix"
+
+    Returns:
+        (start, end) inclusive, None for whole file
+
+    Raises:
+        ValueError: range is not satisfiable
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    first = header[len("bytes=") :].split(",", 1)[0].strip()
+    start_text, _, end_text = first.partition("-")
+    if not start_text:
+        suffix = int(end_text)
+        if suffix <= 0:
+            raise ValueError(header)
+        return max(0, size - suffix), size - 1
+    start = int(start_text)
+    end = min(int(end_text), size - 1) if end_text else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def file_range_response(
+    path: str,
+    filename: str,
+    media_type: str,
+    etag: str,
+    range_header: str | None = None,
+    if_range: str | None = None,
+) -> Response:
+    """File response with Range support, so broken download is resumed.
+    If-Range with other etag (file was changed) gets the whole file.
+
+    Arguments:
+        path -- file path
+        filename -- download file name
+        media_type -- content type
+        etag -- file version, without quotes
+        range_header -- Range request header
+        if_range -- If-Range request header
+    """
+    size = os.path.getsize(path)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{etag}"',
+        "Content-Disposition": f"attachment; filename={urllib.parse.quote(filename)}",
+    }
+    if if_range and if_range != headers["ETag"]:
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        return Response(
+            status_code=HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{size}"},
+        )
+    status_code = HTTP_200_OK
+    start, end = 0, size - 1
+    if byte_range:
+        start, end = byte_range
+        status_code = HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = f"{end - start + 1}"
+
+    async def body():
+        async with aiofiles.open(path, "rb") as file:
+            await file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await file.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return StreamingResponse(
+        body(), status_code=status_code, headers=headers, media_type=media_type
+    )
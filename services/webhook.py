@@ -0,0 +1,372 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+
+import httpx
+
+from schemas.config_schema import Config
+from services import metrics
+
+log = logging.getLogger("asterisk_agent")
+
+
+class TokenBucket:
+    """Requests rate limit: rate tokens per second, up to burst at once.
+    Tokens are reserved in call order, so waiting callers are served fairly.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        Arguments:
+            rate -- tokens per second, 0 - unlimited
+            burst -- bucket size
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take token
+
+        Returns:
+            seconds to wait before the token is available
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class AdaptiveLimit:
+    """Concurrency limit by AIMD: grows by 1/limit on every fast success, halves
+    on error or latency above target (once per latency target, not for every
+    request of the same slow period).
+
+    Waiting requests get free slots by priority (lower first), then in FIFO
+    order, so events of a latency critical lane are not queued behind bulk ones.
+
+    async with limit.slot(priority):
+        ...
+    limit.record(latency, ok)
+    """
+
+    def __init__(self, minimum: int, maximum: int, latency_target: float) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.limit = float(minimum)
+        self.in_flight = 0
+        self.decreased = 0.0
+        # heap of (priority, order, future)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority: int = 0):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            # released slot is passed to the future (in_flight is already counted)
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        """Pass free slots to waiting requests (after release or limit increase)"""
+        while self._waiters and self.in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                self.in_flight += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = 0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record(self, latency: float, ok: bool):
+        if ok and latency <= self.latency_target:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.wake()
+            return
+        now = time.monotonic()
+        if now - self.decreased >= self.latency_target:
+            self.decreased = now
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+class CircuitBreaker:
+    """Stop sending to failing target.
+
+    closed -- requests pass, opens when error rate of last window seconds
+        reaches error_rate (at least min_requests requests)
+    open -- requests are short-circuited for open_seconds
+    half_open -- one probe request passes, success closes, error opens again
+    """
+
+    def __init__(
+        self, error_rate: float, min_requests: int, window: float, open_seconds: float
+    ) -> None:
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.opened = 0.0
+        self.probing = False
+        self.opened_count = 0
+        # (time, ok) of requests in window
+        self.results: collections.deque[tuple[float, bool]] = collections.deque()
+
+    def retry_in(self) -> float:
+        """Seconds until half-open probe is allowed"""
+        if self.state != "open":
+            return 0
+        return max(0.0, self.opened + self.open_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "open" and not self.retry_in():
+            self.state = "half_open"
+            self.probing = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == "half_open":
+            self.probing = False
+            if ok:
+                self.state = "closed"
+                self.results.clear()
+            else:
+                self._open(now)
+            return
+        if self.state == "open":
+            # response of request sent before circuit was opened
+            return
+        self.results.append((now, ok))
+        while self.results and self.results[0][0] < now - self.window:
+            self.results.popleft()
+        if len(self.results) >= self.min_requests and self.errors() >= self.error_rate:
+            self._open(now)
+
+    def errors(self) -> float:
+        """Error rate of window"""
+        if not self.results:
+            return 0.0
+        return sum(not ok for _, ok in self.results) / len(self.results)
+
+    def _open(self, now: float):
+        self.state = "open"
+        self.opened = now
+        self.opened_count += 1
+        log.warning("Webhook circuit breaker is open for %s seconds", self.open_seconds)
+
+
+class WebhookTarget:
+    """Delivery state of one webhook server (scheme://host:port)"""
+
+    def __init__(self, origin: str, config: Config) -> None:
+        self.origin = origin
+        self.bucket = TokenBucket(config.webhook_rate, config.webhook_burst)
+        self.limit = AdaptiveLimit(
+            config.webhook_concurrency_min,
+            config.webhook_concurrency_max,
+            config.webhook_latency_target,
+        )
+        self.breaker = CircuitBreaker(
+            config.webhook_breaker_error_rate,
+            config.webhook_breaker_min_requests,
+            config.webhook_breaker_window,
+            config.webhook_breaker_open,
+        )
+        # events short-circuited while circuit is open, sent in order after it closes
+        self.outbox: collections.deque[tuple[str, str, dict]] = collections.deque()
+        self.outbox_size = config.webhook_outbox_size
+        self.drain_task: asyncio.Task | None = None
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def set_config(self, config: Config):
+        self.bucket.rate = config.webhook_rate
+        self.bucket.burst = config.webhook_burst
+        self.limit.minimum = config.webhook_concurrency_min
+        self.limit.maximum = config.webhook_concurrency_max
+        self.limit.latency_target = config.webhook_latency_target
+        self.limit.limit = min(max(self.limit.limit, self.limit.minimum), self.limit.maximum)
+        self.limit.wake()
+        self.breaker.error_rate = config.webhook_breaker_error_rate
+        self.breaker.min_requests = config.webhook_breaker_min_requests
+        self.breaker.window = config.webhook_breaker_window
+        self.breaker.open_seconds = config.webhook_breaker_open
+        self.outbox_size = config.webhook_outbox_size
+
+    def stats(self) -> dict:
+        return {
+            "circuit": self.breaker.state,
+            "error_rate": round(self.breaker.errors(), 3),
+            "circuit_opened_count": self.breaker.opened_count,
+            "concurrency_limit": int(self.limit.limit),
+            "in_flight": self.limit.in_flight,
+            "outbox": len(self.outbox),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+class WebhookSender:
+    """Webhook delivery of PBX events with one connection pool.
+
+    Per target: token bucket rate limit, AIMD concurrency limit and circuit
+    breaker. While circuit is open (or its outbox is not empty, to keep order)
+    events are put to bounded outbox instead of waiting for timeout, outbox is
+    sent after half-open probe succeeds, the oldest events are dropped when it
+    is full.
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.metrics = metrics.pbx_metrics(config.pbx_name)
+        self.client = httpx.AsyncClient(
+            timeout=config.webhook_timeout,
+            limits=httpx.Limits(max_connections=config.webhook_concurrency_max),
+        )
+        self.targets: dict[str, WebhookTarget] = {}
+
+    def set_config(self, config: Config):
+        """Apply changed webhook settings (config reload), connections are kept"""
+        self.config = config
+        self.metrics = metrics.pbx_metrics(config.pbx_name)
+        self.client.timeout = httpx.Timeout(config.webhook_timeout)
+        for target in self.targets.values():
+            target.set_config(config)
+
+    def target(self, url: str) -> WebhookTarget:
+        parsed = httpx.URL(url)
+        origin = f"{parsed.scheme}://{parsed.netloc.decode('ascii')}"
+        target = self.targets.get(origin)
+        if target is None:
+            target = self.targets[origin] = WebhookTarget(origin, self.config)
+        return target
+
+    async def send(self, source: str, url: str, payload: dict, priority: int = 0) -> bool:
+        """Send event to webhook
+
+        Arguments:
+            source -- ari, ami or cel (metrics label)
+            url -- webhook url
+            payload -- event
+            priority -- concurrency slots are given to lower priority first
+
+        Returns:
+            True if delivered now, False if failed or put to outbox
+        """
+        target = self.target(url)
+        if target.outbox or not target.breaker.allow():
+            self._enqueue(target, source, url, payload)
+            return False
+        delivered = await self._post(target, source, url, payload, priority)
+        if not delivered and target.breaker.state != "closed":
+            # this error opened circuit, send the event after it closes
+            self._enqueue(target, source, url, payload)
+        return delivered
+
+    async def _post(
+        self, target: WebhookTarget, source: str, url: str, payload: dict, priority: int = 0
+    ) -> bool:
+        started = time.perf_counter()
+        status = "error"
+        queue_depth = self.metrics.webhook_queue_depth[source]
+        queue_depth.inc()
+        try:
+            await target.bucket.acquire()
+            async with target.limit.slot(priority):
+                started = time.perf_counter()
+                try:
+                    res = await self.client.post(
+                        url,
+                        json=payload,
+                        headers={"Authorization": f"Basic {self.config.api_key_base64}"},
+                    )
+                    status = res.status_code
+                    res.raise_for_status()
+                    delivered = True
+                except Exception as exc:
+                    log.exception("Unknown send_webhook_event error: %s", exc)
+                    delivered = False
+                latency = time.perf_counter() - started
+                target.limit.record(latency, delivered)
+            target.breaker.record(delivered)
+            if delivered:
+                target.delivered += 1
+            else:
+                target.failed += 1
+            return delivered
+        finally:
+            queue_depth.dec()
+            self.metrics.observe_webhook(source, started, status)
+
+    def _enqueue(self, target: WebhookTarget, source: str, url: str, payload: dict):
+        if len(target.outbox) >= target.outbox_size:
+            dropped_source, _, _ = target.outbox.popleft()
+            self.metrics.webhook_queue_depth[dropped_source].dec()
+            target.dropped += 1
+        target.outbox.append((source, url, payload))
+        self.metrics.webhook_queue_depth[source].inc()
+        if target.drain_task is None or target.drain_task.done():
+            target.drain_task = asyncio.create_task(self._drain(target))
+
+    async def _drain(self, target: WebhookTarget):
+        """Send outbox in order: wait for half-open probe, then the rest"""
+        while target.outbox:
+            if not target.breaker.allow():
+                await asyncio.sleep(max(target.breaker.retry_in(), 0.01))
+                continue
+            source, url, payload = target.outbox[0]
+            delivered = await self._post(target, source, url, payload)
+            # error with closed circuit is not a server outage (bad event), skip it
+            if delivered or target.breaker.state == "closed":
+                target.outbox.popleft()
+                self.metrics.webhook_queue_depth[source].dec()
+
+    async def close(self):
+        for target in self.targets.values():
+            if target.drain_task:
+                target.drain_task.cancel()
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {origin: target.stats() for origin, target in self.targets.items()}
@@ -5,13 +5,75 @@ import asyncio
 import datetime
 import json
 import logging
+import posixpath
+import random
+import time
 
 import httpx
 import websockets
 
 from schemas.config_schema import AriConfig
+from services import metrics
+from services.capture import EventCapture
+from services.cdr_cache import ARI_EVENTS as CDR_CACHE_EVENTS
+from services.cdr_cache import CdrCache
+from services.channels import ARI_EVENTS as CHANNELS_EVENTS
+from services.channels import ChannelStore
+from services.contacts import Contacts
+from services.dedup import EventDeduplicator
+from services.lanes import EventLanes
+from services.recovery import GapRecovery
+from services.webhook import WebhookSender
 
-log = logging.getLogger("asterisk_agent")
+log = logging.getLogger("asterisk_agent.ari")
+log_events = logging.getLogger("asterisk_agent.ari.events")
+
+ARI_APPLICATION = "AsteriskAgentPython"
+
+# ARI event source (topic) that publishes each event type.
+# Asterisk does not serialize events for topics the application is not subscribed to,
+# so subscribing only to the needed sources saves websocket bandwidth and parse CPU.
+ARI_EVENT_SOURCES_ALL = ("channel:", "bridge:", "endpoint:", "deviceState:")
+ARI_EVENT_SOURCES = {
+    "StasisStart": ("channel:",),
+    "StasisEnd": ("channel:",),
+    "Dial": ("channel:",),
+    "RecordingStarted": ("channel:", "bridge:"),
+    "RecordingFinished": ("channel:", "bridge:"),
+    "RecordingFailed": ("channel:", "bridge:"),
+    "PlaybackStarted": ("channel:", "bridge:"),
+    "PlaybackContinuing": ("channel:", "bridge:"),
+    "PlaybackFinished": ("channel:", "bridge:"),
+    "EndpointStateChange": ("endpoint:",),
+    "PeerStatusChange": ("endpoint:",),
+    "ContactStatusChange": ("endpoint:",),
+    "TextMessageReceived": ("endpoint:",),
+    "DeviceStateChanged": ("deviceState:",),
+}
+
+
+def ari_event_sources(events_used: list[str]) -> set[str]:
+    """Return ARI event sources needed to receive events_used
+
+    Arguments:
+        events_used -- ARI event types
+
+    Returns:
+        set of eventSource for applications/{app}/subscription,
+        "channel:" without id means all channels and so on
+    """
+    sources = set()
+    for event_type in events_used:
+        if event_type in ARI_EVENT_SOURCES:
+            sources.update(ARI_EVENT_SOURCES[event_type])
+        elif event_type.startswith("Channel"):
+            sources.add("channel:")
+        elif event_type.startswith("Bridge"):
+            sources.add("bridge:")
+        else:
+            # unknown event, do not lose it
+            sources.update(ARI_EVENT_SOURCES_ALL)
+    return sources
 
 
 class WebsocketEvents:
@@ -36,56 +98,152 @@ class WebsocketEvents:
 
     def __init__(
         self,
-        api_key_base64: str,
+        webhook: WebhookSender,
         api_key: str,
         ari_config: AriConfig,
         webhook_url: str,
-        timeout: int,
+        dedup: EventDeduplicator | None = None,
+        recovery: GapRecovery | None = None,
+        cdr_cache: CdrCache | None = None,
+        pbx: str = "default",
+        capture: EventCapture | None = None,
+        channels: ChannelStore | None = None,
+        contacts: Contacts | None = None,
     ) -> None:
         super().__init__()
-        websocket_url = f"{ari_config.wss}".rstrip("/")
-        self.api_key_base64 = api_key_base64
+        self.dedup = dedup
+        self.capture = capture
+        self.channels = channels
+        self.contacts = contacts
+        self.metrics = metrics.pbx_metrics(pbx)
+        self.recovery = recovery
+        self.cdr_cache = cdr_cache
+        self.websocket_base_url = f"{ari_config.wss}".rstrip("/")
+        self.ari_url = f"{ari_config.url}"
+        self.api_key = api_key
+        self.webhook = webhook
 
-        self.websocket_url = (
-            f"{websocket_url}?api_key={api_key}&app=AsteriskAgentPython&subscribeAll=true"
-        )
         self.webhook_url = webhook_url
-        self.timeout = timeout
+        self.reconnect_min = ari_config.reconnect_min
+        self.reconnect_max = ari_config.reconnect_max
+        self.ping_interval = ari_config.ping_interval
+        self.ping_timeout = ari_config.ping_timeout
+        self.gap_recovery = bool(ari_config.gap_recovery)
+        self.gap_recovery_max = ari_config.gap_recovery_max
+        # when connection was lost, start of events gap
+        self.disconnected_at: datetime.datetime | None = None
+        self.connected_monotonic = 0.0
 
         self.webhook_events_ignore = ari_config.events_ignore
         self.webhook_events_used = ari_config.events_used
+        # without events_used filter all events needed, so subscribe to all
+        self.subscribe_all_forced = bool(ari_config.subscribe_all)
+        self.subscribe_all = self.subscribe_all_forced or not ari_config.events_used
+        # subscribe by sources failed, next connection only is subscribeAll
+        self.subscribe_fallback = False
+        self.subscribed_sources: set[str] = set()
+        self.lanes = EventLanes(
+            ari_config.lanes, ari_config.lane_events, ari_config.lane_size, self.deliver_event
+        )
+
+    @property
+    def websocket_url(self) -> str:
+        subscribe_all = "true" if self.subscribe_all or self.subscribe_fallback else "false"
+        return (
+            f"{self.websocket_base_url}?api_key={self.api_key}"
+            f"&app={ARI_APPLICATION}&subscribeAll={subscribe_all}"
+        )
+
+    def set_events(self, events_used: list[str], events_ignore: list[str]) -> bool:
+        """Change events filter (for example after config reload)
+
+        Arguments:
+            events_used -- ARI events send to webhook
+            events_ignore -- ARI events never send to webhook
+
+        Returns:
+            True if websocket must be reconnected (subscribeAll changed)
+        """
+        self.webhook_events_used = events_used
+        self.webhook_events_ignore = events_ignore
+        subscribe_all = self.subscribe_all_forced or not events_used
+        if subscribe_all != self.subscribe_all:
+            self.subscribe_all = subscribe_all
+            return True
+        return False
 
-    async def send_webhook_event(self, payload: dict):
+    async def send_webhook_event(self, payload: dict, priority: int = 0) -> bool:
         """send asterisk ari event to customer webhook url
 
         Arguments:
             payload -- asterisk event
+            priority -- priority of delivery lane, 0 is the highest
+
+        Returns:
+            True if delivered
         """
-        try:
-            async with httpx.AsyncClient() as client:
+        return await self.webhook.send("ari", self.webhook_url, payload, priority)
+
+    def subscribed_events(self) -> list[str]:
+        """Event types of webhook (events_used) and of in process consumers: channels
+        state and CDR prewarm need their events whatever is sent to webhook"""
+        events = list(self.webhook_events_used)
+        if self.channels:
+            events.extend(CHANNELS_EVENTS)
+        if self.cdr_cache and self.cdr_cache.state.config.cdr_cache_enable:
+            events.extend(CDR_CACHE_EVENTS)
+        return list(dict.fromkeys(events))
+
+    async def subscribe(self):
+        """Subscribe ARI application only to event sources needed for events_used
+        and in process consumers (process_event filters webhook events).
+        Sources that are no longer needed are unsubscribed, so this method can be
+        called again after events_used changed.
+        Then set application event filter (Asterisk 13.26+, 16.3+) so Asterisk
+        does not send event types we ignore at all. With subscribeAll the filter
+        of earlier subscription is removed.
+        """
+        path = posixpath.join(self.ari_url, f"applications/{ARI_APPLICATION}")
+        async with httpx.AsyncClient() as client:
+            if self.subscribe_all or self.subscribe_fallback:
+                await self.set_event_filter(client, path, [])
+                return
+
+            events = self.subscribed_events()
+            sources = ari_event_sources(events)
+            subscribe = sources - self.subscribed_sources
+            if subscribe:
                 res = await client.post(
-                    self.webhook_url,
-                    json=payload,
-                    headers={
-                        "Authorization": f"Basic {self.api_key_base64}",
+                    f"{path}/subscription",
+                    params={"api_key": self.api_key, "eventSource": ",".join(sorted(subscribe))},
+                )
+                res.raise_for_status()
+            unsubscribe = self.subscribed_sources - sources
+            if unsubscribe:
+                res = await client.delete(
+                    f"{path}/subscription",
+                    params={
+                        "api_key": self.api_key,
+                        "eventSource": ",".join(sorted(unsubscribe)),
                     },
                 )
                 res.raise_for_status()
-        except Exception as exc:
-            log.exception("Unknown send_webhook_event error: %s", exc)
-
-    # async def subscribe(self):
-    #     try:
-    #         async with httpx.AsyncClient() as client:
-    #             path = f"applications/AsteriskAgentPython/subscription?api_key={self.api_key}"
-    #             r = await client.post(
-    #                 f"{posixpath.join(self.ari_url, path)}",
-    #                 data={"eventSource": "channel:ChannelCreated,ChannelDestroyed"},
-    #             )
-    #             r.raise_for_status()
-    #             return r.text
-    #     except Exception as e:
-    #         log.exception("Unknown send_webhook_event error: %s", e)
+            self.subscribed_sources = sources
+            log.info("ARI subscribed to event sources: %s", sorted(sources))
+
+            await self.set_event_filter(client, path, events)
+
+    async def set_event_filter(self, client: httpx.AsyncClient, path: str, events: list[str]):
+        """Allow only events of application, empty events remove filter"""
+        res = await client.put(
+            f"{path}/eventFilter",
+            params={"api_key": self.api_key},
+            json={"allowed": [{"type": event} for event in events], "disallowed": []},
+        )
+        if res.status_code == 404:
+            log.info("ARI eventFilter not supported by this Asterisk version")
+        else:
+            res.raise_for_status()
 
     async def start_consumer(self):
         """
@@ -191,39 +349,175 @@ class WebsocketEvents:
         """
         try:
             self.last_try_connected_time = str(datetime.datetime.now())
-            async with websockets.connect(self.websocket_url) as websocket:
+            async with websockets.connect(
+                self.websocket_url,
+                ping_interval=self.ping_interval,
+                ping_timeout=self.ping_timeout,
+            ) as websocket:
                 self.connected = True
+                self.connected_monotonic = time.monotonic()
                 self.last_connected_time = str(datetime.datetime.now())
                 log.info("Connected to ARI websocket server succesfully")
-                # subscribe = await self.send_subscribe()
-                # log.info(subscribe)
-
-                while True:
-                    message = await websocket.recv()
-                    message_json = json.loads(message)
-                    if message_json["type"] in self.webhook_events_ignore:
-                        continue
-
-                    log.info("Received: %s", message)
-
-                    if self.webhook_events_used:
-                        if message_json["type"] not in self.webhook_events_used:
-                            continue
+                # new websocket session, subscribe again
+                self.subscribed_sources = set()
+                try:
+                    await self.subscribe()
+                except Exception as exc:
+                    if not (self.subscribe_all or self.subscribe_fallback):
+                        # without subscription no events will come, next connection
+                        # uses old behaviour
+                        log.exception("ARI subscribe error, fallback to subscribeAll: %s", exc)
+                        self.subscribe_fallback = True
+                        raise exc
+                    log.warning("ARI event filter is not removed: %r", exc)
+                # fallback is for this connection, the next one subscribes by sources again
+                self.subscribe_fallback = False
 
-                    self.answer_last_message_time = str(datetime.datetime.now())
-                    self.answer_last_message = message_json
-
-                    await self.send_webhook_event(payload=message_json)
+                # in parallel with live events, so websocket buffer does not overflow
+                # and ping is answered while outage events are sent
+                recovery_task = asyncio.create_task(self.recover_gap())
+                try:
+                    while True:
+                        message = await websocket.recv()
+                        if self.capture:
+                            self.capture.write("ari", message)
+                        await self.process_event(json.loads(message), message)
+                finally:
+                    recovery_task.cancel()
 
         except asyncio.CancelledError:
+            # websocket is closed by context manager
             log.info("graceful stop webscoket client start_consumer")
-            await websocket.close()
+            self.connected = False
+            raise
         except Exception as exc:
             log.exception("Unknown start_consumer error: %s", exc)
+            if self.connected and self.disconnected_at is None:
+                self.disconnected_at = datetime.datetime.now()
             self.connected = False
             self.disconnect_count += 1
             self.disconnected_reason = str(exc)
             self.disconnected_time = str(datetime.datetime.now())
             raise exc
-            # await asyncio.sleep(self.timeout)
-            # await self.start_consumer()
+
+    async def process_event(self, message_json: dict, message: str | dict):
+        """Filter event and send it to webhook
+
+        Arguments:
+            message_json -- ARI event
+            message -- received text, for log
+        """
+        event_type = message_json["type"]
+        self.metrics.ari_events_received[event_type].inc()
+        # before webhook filters: ChannelDestroyed releases the channel even when it is ignored
+        if self.cdr_cache:
+            self.cdr_cache.on_event(message_json)
+        if self.channels:
+            self.channels.on_ari_event(message_json)
+        if event_type in self.webhook_events_ignore:
+            self.metrics.ari_events_filtered[event_type].inc()
+            return
+
+        log_events.info("Received: %s", message)
+
+        if self.webhook_events_used:
+            if event_type not in self.webhook_events_used:
+                self.metrics.ari_events_filtered[event_type].inc()
+                return
+
+        if self.dedup and self.dedup.is_duplicate("ari", message_json):
+            self.metrics.ari_events_filtered[event_type].inc()
+            return
+
+        if self.contacts:
+            self.contacts.enrich_ari(message_json)
+
+        self.answer_last_message_time = str(datetime.datetime.now())
+        self.answer_last_message = message_json
+
+        channel = message_json.get("channel") or message_json.get("bridge") or {}
+        await self.lanes.put(event_type, channel.get("id", ""), message_json)
+
+    async def deliver_event(self, lane: str, message_json: dict):
+        """Send event to webhook, worker of delivery lane
+
+        Arguments:
+            lane -- lane name, for latency metric
+            message_json -- ARI event
+        """
+        priority = self.lanes.priority(lane)
+        if not await self.send_webhook_event(payload=message_json, priority=priority):
+            return
+        self.metrics.ari_events_delivered[message_json["type"]].inc()
+        try:
+            created = datetime.datetime.fromisoformat(message_json["timestamp"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return
+        self.metrics.ari_event_delivery[lane].observe(max(0.0, time.time() - created))
+
+    async def recover_gap(self):
+        """Send synthesized events of the outage after reconnect, errors are only logged"""
+        if self.disconnected_at is None:
+            return
+        if not (self.gap_recovery and self.recovery):
+            self.disconnected_at = None
+            return
+        now = datetime.datetime.now()
+        start = max(self.disconnected_at, now - datetime.timedelta(seconds=self.gap_recovery_max))
+        # when cancelled (connection lost again) recovery is repeated from the same start
+        try:
+            for event in await self.recovery.events(start, now):
+                await self.process_event(event, event)
+        except Exception as exc:
+            log.exception("Unknown gap recovery error: %s", exc)
+        self.disconnected_at = None
+
+    async def run(self):
+        """Consume events until cancelled.
+        Reconnect with jittered exponential backoff from reconnect_min to reconnect_max
+        seconds, delay is reset after connection was alive longer than ping_interval.
+        """
+        delay = self.reconnect_min
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    await self.start_consumer()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    log.exception("Unknown producer_webhook error: %s", exc)
+                if (
+                    self.connected_monotonic > started
+                    and time.monotonic() - self.connected_monotonic > self.ping_interval
+                ):
+                    delay = self.reconnect_min
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, self.reconnect_max)
+        finally:
+            self.lanes.close()
+
+    async def set_config(
+        self,
+        ari_config: AriConfig,
+        webhook_url: str,
+        dedup: EventDeduplicator | None,
+    ) -> bool:
+        """Apply changed events filter and webhook without reconnect
+
+        Returns:
+            True if websocket must be reconnected
+        """
+        self.webhook_url = webhook_url
+        self.dedup = dedup
+        self.reconnect_min = ari_config.reconnect_min
+        self.reconnect_max = ari_config.reconnect_max
+        self.gap_recovery = bool(ari_config.gap_recovery)
+        self.gap_recovery_max = ari_config.gap_recovery_max
+        self.subscribe_all_forced = bool(ari_config.subscribe_all)
+        self.lanes.lane_events = ari_config.lane_events
+        if self.set_events(ari_config.events_used, ari_config.events_ignore):
+            return True
+        if self.connected:
+            await self.subscribe()
+        return False
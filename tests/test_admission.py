@@ -0,0 +1,159 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Admission control of database queries: lanes, FIFO slots, 503 with Retry-After"""
+
+import asyncio
+import datetime
+
+import httpx
+from fastapi import FastAPI
+
+from exceptions.exceptions import OverloadError
+from main import catch_exception_overload
+from schemas.config_schema import Config
+from services.admission import Admission, QueryLane
+
+
+def create_admission(**settings) -> Admission:
+    values = {
+        "pbx_name": "test",
+        "db_concurrency_lookup": 2,
+        "db_concurrency_range": 1,
+        "db_concurrency_bulk": 1,
+        "db_bulk_range": 3600,
+        "db_queue_timeout": 1,
+    }
+    values.update(settings)
+    return Admission(Config.model_construct(**values))
+
+
+def test_classify_by_range_length():
+    admission = create_admission()
+    start = datetime.datetime(2024, 5, 1)
+    assert admission.classify({"uniqueid": "1.1"}) == "lookup"
+    assert admission.classify({"start_date": start}) == "lookup"
+    hour = {"start_date": start, "end_date": start + datetime.timedelta(hours=1)}
+    assert admission.classify(hour) == "range"
+    day = {"start_date": start, "end_date": start + datetime.timedelta(days=1)}
+    assert admission.classify(day) == "bulk"
+
+
+def test_waiting_queries_get_slots_in_fifo_order():
+    order: list[int] = []
+
+    async def query(lane: QueryLane, index: int):
+        await lane.acquire(5)
+        order.append(index)
+        await asyncio.sleep(0.01)
+        lane.release(0.01)
+
+    async def main():
+        lane = QueryLane("range", 1)
+        tasks = []
+        for index in range(5):
+            tasks.append(asyncio.create_task(query(lane, index)))
+            # waiters are queued in the order of arrival
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert lane.in_flight == 0
+        assert lane.admitted == 5
+        assert lane.waiting == 0
+
+    asyncio.run(main())
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_new_query_does_not_overtake_waiting():
+    async def main():
+        lane = QueryLane("range", 1)
+        await lane.acquire(1)
+        waiter = asyncio.create_task(lane.acquire(1))
+        await asyncio.sleep(0)
+        # the slot is passed to the waiter, not to a query that comes later
+        lane.release(0)
+        late = asyncio.create_task(lane.acquire(0.05))
+        await waiter
+        assert lane.in_flight == 1
+        try:
+            await late
+        except OverloadError:
+            pass
+        else:
+            raise AssertionError("late query got the slot of waiting query")
+
+    asyncio.run(main())
+
+
+def test_timeout_raises_overload_with_retry_after():
+    async def main():
+        lane = QueryLane("bulk", 1)
+        lane.hold = 4.0
+        await lane.acquire(1)
+        waiters = [asyncio.create_task(lane.acquire(0.05)) for _ in range(2)]
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        return lane, results
+
+    lane, results = asyncio.run(main())
+    assert all(isinstance(result, OverloadError) for result in results)
+    # the first waiter timed out while two queries were waiting: 4 * (2 + 1) / 1
+    assert results[0].retry_after == 12
+    assert "bulk" in results[0].detail
+    assert lane.rejected == 2
+    assert lane.waiting == 0
+    assert lane.in_flight == 1
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def main():
+        lane = QueryLane("range", 1)
+        await lane.acquire(1)
+        waiter = asyncio.create_task(lane.acquire(1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        lane.release(0)
+        assert lane.in_flight == 0
+        assert lane.waiting == 0
+
+    asyncio.run(main())
+
+
+def test_limit_increase_wakes_waiting():
+    async def main():
+        admission = create_admission()
+        async with admission.slot("range"):
+            waiter = asyncio.create_task(admission.lanes["range"].acquire(1))
+            await asyncio.sleep(0)
+            admission.set_config(admission.config.model_copy(update={"db_concurrency_range": 2}))
+            await asyncio.wait_for(waiter, 0.5)
+            assert admission.lanes["range"].in_flight == 2
+            admission.lanes["range"].release(0)
+        assert admission.stats()["range"]["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def test_overload_is_http_503_with_retry_after():
+    app = FastAPI()
+    app.add_exception_handler(OverloadError, catch_exception_overload)
+    admission = create_admission(db_queue_timeout=0.05)
+
+    @app.get("/history")
+    async def history():
+        async with admission.slot("bulk"):
+            return {"rows": []}
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://agent") as client:
+            await admission.lanes["bulk"].acquire(1)
+            response = await client.get("/history")
+            admission.lanes["bulk"].release(0)
+            return response, await client.get("/history")
+
+    busy, free = asyncio.run(main())
+    assert busy.status_code == 503
+    assert busy.headers["Retry-After"] == "1"
+    assert "Database is busy" in busy.json()["detail"]
+    assert free.status_code == 200
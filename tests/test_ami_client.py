@@ -0,0 +1,172 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""AmiClient against benchmarks.fake_ami.FakeAmiServer"""
+
+import asyncio
+
+import pytest
+
+from benchmarks.fake_ami import FakeAmiServer
+from exceptions.exceptions import AmiError
+from services.ami_client import AmiClient, build_action, parse_message
+
+
+async def with_client(test, server: FakeAmiServer | None = None, **client_options):
+    """Run test(client, server) with client connected to fake AMI server"""
+    server = server or FakeAmiServer()
+    await server.start()
+    client = AmiClient("127.0.0.1", server.port, "admin", "secret", **client_options)
+    try:
+        await client.connect()
+        await test(client, server)
+    finally:
+        await client.close()
+        await server.close()
+
+
+def test_parse_message():
+    data = (
+        b"Event: VarSet\r\n"
+        b"ChanVariable: A=1\r\n"
+        b"ChanVariable: B=2\r\n"
+        b"ChanVariable: C=3\r\n"
+        b"Value: a: b\r\n"
+        b"Empty:\r\n"
+        b"command output line\r\n"
+        b"\r\n"
+    )
+    assert parse_message(data) == {
+        "Event": "VarSet",
+        "ChanVariable": ["A=1", "B=2", "C=3"],
+        "Value": "a: b",
+        "Empty": "",
+        "Output": "command output line",
+    }
+
+
+def test_build_action_roundtrip():
+    action = {"Action": "Originate", "Variable": ["A=1", "B=2"], "Timeout": 30000}
+    data = build_action(action)
+    assert data.endswith(b"\r\n\r\n")
+    assert parse_message(data) == {
+        "Action": "Originate",
+        "Variable": ["A=1", "B=2"],
+        "Timeout": "30000",
+    }
+
+
+@pytest.mark.parametrize("value", ["101\r\nAction: Command", "101\nCommand: core stop now", "\r"])
+def test_build_action_rejects_line_break(value):
+    with pytest.raises(AmiError):
+        build_action({"Action": "Hangup", "Channel": value})
+    with pytest.raises(AmiError):
+        build_action({"Action": "Originate", "Variable": ["A=1", value]})
+
+
+def test_login_failed():
+    async def main():
+        server = FakeAmiServer(secret="other")
+        await server.start()
+        client = AmiClient("127.0.0.1", server.port, "admin", "secret")
+        try:
+            with pytest.raises(AmiError):
+                await client.connect()
+            assert not client.connected
+        finally:
+            await client.close()
+            await server.close()
+
+    asyncio.run(main())
+
+
+def test_actions_pipelined():
+    async def test(client: AmiClient, server: FakeAmiServer):
+        actions_received = server.actions_received
+        responses = await asyncio.gather(
+            *(client.send_action({"Action": "Ping"}) for _ in range(50))
+        )
+        action_ids = [response["ActionID"] for response in responses]
+        assert len(set(action_ids)) == 50
+        assert all(response["Ping"] == "Pong" for response in responses)
+        assert server.actions_received - actions_received == 50
+        assert not client._pending
+
+        with pytest.raises(AmiError):
+            await client.send_action({"Action": "Unknown"})
+
+    asyncio.run(with_client(test))
+
+
+def test_event_list_collected():
+    async def test(client: AmiClient, server: FakeAmiServer):
+        channels, queues = await asyncio.gather(
+            client.send_action({"Action": "CoreShowChannels"}),
+            client.send_action({"Action": "QueueStatus"}),
+        )
+        assert channels["EventList"] == "start"
+        assert [event["Event"] for event in channels["Events"]] == ["CoreShowChannel"] * 7
+        assert [event["Event"] for event in queues["Events"]] == ["QueueParams", "QueueMember"]
+        # list items are not events of stream
+        assert client._events.empty()
+        assert not client._lists
+
+    asyncio.run(with_client(test, FakeAmiServer(channels=7)))
+
+
+def test_events_filtered():
+    async def test(client: AmiClient, server: FakeAmiServer):
+        events = client.events()
+        received = [await asyncio.wait_for(anext(events), 5) for _ in range(3)]
+        assert [event["Event"] for event in received] == ["Hangup"] * 3
+        assert [event["Uniqueid"] for event in received] == [
+            "1715432693.1",
+            "1715432693.2",
+            "1715432693.3",
+        ]
+
+    server = FakeAmiServer(rate=-1, count=12)
+    asyncio.run(with_client(test, server, events_used=["Hangup"]))
+
+
+def test_reconnect():
+    async def main():
+        server = FakeAmiServer()
+        await server.start()
+        connected = asyncio.Event()
+        disconnects = []
+
+        def on_connect():
+            connected.set()
+
+        client = AmiClient(
+            "127.0.0.1",
+            server.port,
+            "admin",
+            "secret",
+            ping_interval=0.1,
+            on_connect=on_connect,
+            on_disconnect=disconnects.append,
+        )
+        task = asyncio.create_task(client.run())
+        try:
+            await asyncio.wait_for(connected.wait(), 5)
+            connected.clear()
+            # connection is lost, pending action fails and run() connects again
+            pending = asyncio.create_task(client.send_action({"Action": "Ping"}))
+            client.writer.transport.abort()
+            with pytest.raises(ConnectionError):
+                await pending
+            await asyncio.wait_for(connected.wait(), 5)
+            assert len(disconnects) == 1
+            assert client.connected
+            response = await client.send_action({"Action": "Ping"})
+            assert response["Response"] == "Success"
+        finally:
+            await client.close()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.close()
+        assert not client.connected
+
+    asyncio.run(main())
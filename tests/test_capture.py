@@ -0,0 +1,82 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""EventCapture writer thread and capture files"""
+
+import glob
+import os
+import time
+
+from services.capture import EventCapture, read_capture
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition is not met"
+        time.sleep(0.01)
+
+
+def test_write_and_read(tmp_path):
+    capture = EventCapture(str(tmp_path), "pbx")
+    capture.write("ari", '{"type": "StasisStart"}')
+    capture.write("ami", {"Event": "Hangup"})
+    capture.close()
+    records = list(read_capture(sorted(glob.glob(str(tmp_path / "pbx-*.jsonl.gz")))))
+    assert [(record["source"], record["frame"]) for record in records] == [
+        ("ari", '{"type": "StasisStart"}'),
+        ("ami", {"Event": "Hangup"}),
+    ]
+    assert capture.frames == 2
+    assert capture.error == ""
+
+
+def test_files_roll_and_old_removed(tmp_path):
+    # every frame is bigger than file_size, so every frame opens the next file
+    capture = EventCapture(str(tmp_path), "pbx", file_size=1, files=3)
+    for index in range(6):
+        capture.write("ami", {"Event": "Newchannel", "Index": index})
+        # file names have microseconds, but keep them distinct on coarse clocks
+        time.sleep(0.002)
+    capture.close()
+    paths = sorted(glob.glob(str(tmp_path / "pbx-*.jsonl.gz")))
+    assert len(paths) == 3
+    assert [record["frame"]["Index"] for record in read_capture(paths)] == [3, 4, 5]
+
+
+def test_disk_full_keeps_writer_running(tmp_path):
+    capture = EventCapture(str(tmp_path), "pbx", file_size=1)
+    open_file = capture._open
+    opened = []
+
+    def failing_open():
+        if opened:
+            raise OSError(28, "No space left on device")
+        opened.append(True)
+        return open_file()
+
+    capture._open = failing_open
+    capture.write("ami", {"Event": "Newchannel"})
+    capture.write("ami", {"Event": "Hangup"})
+    wait_for(lambda: capture.error)
+    assert "No space left on device" in capture.error
+    # idle flush runs after a second without frames, the thread must survive it
+    time.sleep(1.5)
+    assert capture._thread.is_alive()
+
+    # disk has space again: frames are written and the queue is read
+    capture._open = open_file
+    capture.write("ami", {"Event": "DialBegin"})
+    wait_for(lambda: capture.frames == 2)
+    assert capture.error == ""
+    assert capture._queue.empty()
+    started = time.monotonic()
+    capture.close()
+    assert time.monotonic() - started < 1
+    assert not capture._thread.is_alive()
+    frames = [
+        record["frame"]["Event"]
+        for record in read_capture(sorted(glob.glob(str(tmp_path / "pbx-*.jsonl.gz"))))
+    ]
+    assert frames == ["Newchannel", "DialBegin"]
+    assert all(os.path.getsize(path) for path in glob.glob(str(tmp_path / "pbx-*.jsonl.gz")))
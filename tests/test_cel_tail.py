@@ -0,0 +1,118 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""CelTail high-water mark: state file and rows of the mark eventtime after restart"""
+
+import asyncio
+import datetime
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from schemas.config_schema import Config
+from services.cel_tail import CelTail
+
+
+class FakeDatabase:
+    """cel rows, get_cel_since compares eventtime of the same type as database"""
+
+    def __init__(self, rows: list[dict]) -> None:
+        self.rows = rows
+
+    async def get_cel_since(self, eventtime, cel_id, limit: int = 1000) -> list[dict]:
+        rows = [
+            row
+            for row in self.rows
+            if row["eventtime"] >= eventtime
+            and (row["eventtime"] > eventtime or row["id"] > cel_id)
+        ]
+        return sorted(rows, key=lambda row: (row["eventtime"], row["id"]))[:limit]
+
+    async def get_cel_last(self) -> list[dict]:
+        return []
+
+
+class FakeWebhook:
+    def __init__(self) -> None:
+        self.sent: list[int] = []
+
+    async def send(self, source: str, url: str, payload: dict, priority: int = 0) -> bool:
+        self.sent.append(payload["id"])
+        return True
+
+
+def create_tail(rows: list[dict], state_file: str, dialect: str) -> CelTail:
+    config = Config.model_construct(
+        pbx_name="test",
+        db_dialect=dialect,
+        webhook_url="http://crm.example.com/events",
+        cel_tail_state_file=state_file,
+        cel_tail_batch=2,
+        cel_events_used=[],
+    )
+    database = FakeDatabase(rows)
+    return CelTail(
+        SimpleNamespace(config=config, connector_database=database, webhook=FakeWebhook())
+    )
+
+
+def poll(tail: CelTail, times: int = 1) -> list[int]:
+    """Sent ids of CEL rows"""
+
+    async def main():
+        await tail.init_mark()
+        for _ in range(times):
+            await tail.poll()
+
+    asyncio.run(main())
+    return tail.state.webhook.sent
+
+
+@pytest.mark.parametrize(
+    "dialect, eventtime",
+    [
+        # mysql/postgresql return datetime
+        ("mysql", datetime.datetime(2024, 5, 1, 10, 0, 0, 500000)),
+        ("postgresql", datetime.datetime(2024, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+        # sqlite returns text as stored, not str() of datetime
+        ("sqlite", "2024-05-01 10:00:00.5"),
+    ],
+)
+def test_rows_of_mark_eventtime_after_restart(tmp_path, dialect, eventtime):
+    state_file = str(tmp_path / "cel_tail.json")
+    rows = [{"eventtime": eventtime, "id": cel_id, "eventtype": "HANGUP"} for cel_id in (1, 2, 3)]
+    with open(state_file, "w", encoding="utf-8") as file:
+        json.dump({"eventtime": f"{eventtime}", "id": 0, "datetime": dialect != "sqlite"}, file)
+
+    tail = create_tail(rows, state_file, dialect)
+    # batch of 2 rows ends inside rows of one eventtime
+    assert poll(tail) == [1, 2]
+
+    restarted = create_tail(rows, state_file, dialect)
+    assert poll(restarted, 2) == [3]
+    assert restarted.eventtime == eventtime
+    assert type(restarted.eventtime) is type(eventtime)
+
+
+def test_state_file_without_eventtime_type(tmp_path):
+    state_file = str(tmp_path / "cel_tail.json")
+    with open(state_file, "w", encoding="utf-8") as file:
+        json.dump({"eventtime": "2024-05-01 10:00:00.5", "id": 7}, file)
+    tail = create_tail([], state_file, "mysql")
+    assert tail.load_mark(state_file, "mysql")
+    assert tail.eventtime == datetime.datetime(2024, 5, 1, 10, 0, 0, 500000)
+    tail = create_tail([], state_file, "sqlite")
+    assert tail.load_mark(state_file, "sqlite")
+    assert (tail.eventtime, tail.cel_id) == ("2024-05-01 10:00:00.5", 7)
+
+
+def test_broken_state_file_starts_from_last_event(tmp_path):
+    state_file = str(tmp_path / "cel_tail.json")
+    with open(state_file, "w", encoding="utf-8") as file:
+        file.write('{"eventtime": ')
+    tail = create_tail([], state_file, "mysql")
+    assert poll(tail) == []
+    assert tail.eventtime == datetime.datetime(1970, 1, 1)
+    with open(state_file, encoding="utf-8") as file:
+        assert json.load(file) == {"eventtime": "1970-01-01 00:00:00", "id": 0, "datetime": True}
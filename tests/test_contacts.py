@@ -0,0 +1,122 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Phone numbers normalization and CRM contacts index"""
+
+import pytest
+
+from schemas.config_schema import Config
+from services.contacts import Contacts, PhoneRules, build_index, parse_contacts
+
+RULES = PhoneRules("7", "8", 10, ["00", "810"])
+
+
+@pytest.mark.parametrize(
+    "number, normalized",
+    [
+        # country code
+        ("+7 (911) 111-11-11", "+79111111111"),
+        ("79111111111", "+79111111111"),
+        # trunk prefix
+        ("89111111111", "+79111111111"),
+        ("8 (800) 555-35-35", "+78005553535"),
+        # national number
+        ("911 111 11 11", "+79111111111"),
+        # international prefixes, 810 is checked before trunk prefix 8
+        ("810 44 20 7946 0958", "+442079460958"),
+        ("00442079460958", "+442079460958"),
+        ("+44 20 7946 0958", "+442079460958"),
+        # extensions are digits only, short numbers after 810 and 8 too
+        ("101", "101"),
+        ("8101", "8101"),
+        ("810", "810"),
+        ("*97", "97"),
+        ("", ""),
+    ],
+)
+def test_normalize(number, normalized):
+    assert RULES.normalize(number) == normalized
+
+
+@pytest.mark.parametrize(
+    "number, normalized",
+    [
+        ("+7 495 123", "+7495123"),
+        ("8 495 123", "+7495123"),
+        ("810 44 20", "+4420"),
+        ("0044", "+44"),
+    ],
+)
+def test_normalize_prefix(number, normalized):
+    # length of prefix is not checked
+    assert RULES.normalize(number, prefix=True) == normalized
+
+
+def test_rules_without_trunk_prefix():
+    rules = PhoneRules("1", "", 10, ["011"])
+    assert rules.normalize("(212) 555-0100") == "+12125550100"
+    assert rules.normalize("1 212 555 0100") == "+12125550100"
+    assert rules.normalize("011 44 20 7946 0958") == "+442079460958"
+    assert rules.normalize("8 212 555 0100") == "82125550100"
+
+
+def test_parse_contacts_formats():
+    expected = [("+79111111111", "15"), ("8495123*", "company")]
+    csv_text = "number,id\n+79111111111,15\n8495123*,company\n,16\n"
+    assert parse_contacts(csv_text) == expected
+    assert parse_contacts("number,contact_id\n+79111111111,15\n8495123*,company\n") == expected
+    json_list = '[{"number": "+79111111111", "id": 15}, {"number": "8495123*", "id": "company"}]'
+    assert parse_contacts(json_list) == expected
+    assert parse_contacts('{"+79111111111": 15, "8495123*": "company"}') == expected
+
+
+def test_index_exact_number_then_longest_prefix():
+    index = build_index(
+        [
+            ("8 (911) 111-11-11", "exact"),
+            ("+7911*", "operator"),
+            ("8911111*", "company"),
+            ("101", "extension"),
+        ],
+        RULES,
+    )
+    assert len(index) == 4
+    assert index.lookup("+79111111111") == "exact"
+    assert index.lookup("+79111112222") == "company"
+    assert index.lookup("+79112222222") == "operator"
+    assert index.lookup("+79122222222") is None
+    assert index.lookup("101") == "extension"
+
+
+def test_events_and_rows_get_contact_id():
+    contacts = Contacts(Config.model_construct(contacts_source=""))
+    contacts.index = build_index([("+79111111111", "15")], contacts.rules)
+    event = {
+        "type": "ChannelCreated",
+        "channel": {"caller": {"number": "89111111111"}, "connected": {"number": "101"}},
+    }
+    contacts.enrich_ari(event)
+    assert event["channel"]["caller"] == {
+        "number": "89111111111",
+        "normalized": "+79111111111",
+        "contact_id": "15",
+    }
+    assert event["channel"]["connected"] == {"number": "101", "normalized": "101"}
+
+    received = {"Event": "Newchannel", "CallerIDNum": "9111111111", "ConnectedLineNum": "<unknown>"}
+    assert contacts.enrich_ami(received) == {
+        **received,
+        "CallerIDNumNormalized": "+79111111111",
+        "CallerIDNumContactId": "15",
+    }
+    assert "CallerIDNumNormalized" not in received
+
+    row = contacts.enrich_row({"src": 79111111111, "dst": ""})
+    assert row == {
+        "src": 79111111111,
+        "dst": "",
+        "src_normalized": "+79111111111",
+        "src_contact_id": "15",
+    }
+    assert contacts.stats()["lookups"] == 4
+    assert contacts.stats()["found"] == 3
@@ -0,0 +1,137 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""History export: windows halving, rows of the same time after HISTORY_LIMIT"""
+
+import asyncio
+import csv
+import datetime
+import gzip
+import logging
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from exceptions.exceptions import OverloadError
+from schemas.config_schema import Config
+from services import export
+from services.export import ExportJob, ExportJobs
+
+START = datetime.datetime(2024, 5, 1)
+LIMIT = 10
+
+
+def minutes(value: float) -> datetime.datetime:
+    return START + datetime.timedelta(minutes=value)
+
+
+class FakeDatabase:
+    """CDR table in memory, a query returns no more than HISTORY_LIMIT rows in time order"""
+
+    cdr_start_field = "calldate"
+
+    def __init__(self, rows: list[dict], busy: int = 0) -> None:
+        self.rows = sorted(rows, key=lambda row: row["calldate"])
+        self.queries: list[tuple[datetime.datetime, datetime.datetime]] = []
+        # queries answered with OverloadError
+        self.busy = busy
+
+    async def iter_cdr(self, start, end, ordered: bool = False, lane: str = "range"):
+        assert ordered and lane == "bulk"
+        if self.busy:
+            self.busy -= 1
+            raise OverloadError("Database is busy (bulk queries)", 0)
+        self.queries.append((start, end))
+        rows = [row for row in self.rows if start <= row["calldate"] <= end]
+        for row in rows[: export.HISTORY_LIMIT]:
+            yield dict(row)
+
+
+@pytest.fixture(autouse=True)
+def small_limit(monkeypatch):
+    monkeypatch.setattr(export, "HISTORY_LIMIT", LIMIT)
+    monkeypatch.setattr(export, "CHUNK_ROWS", 4)
+
+
+def create_jobs(database: FakeDatabase, tmp_path, export_window: int = 3600) -> ExportJobs:
+    config = Config.model_construct(
+        pbx_name="test", export_dir=str(tmp_path), export_window=export_window
+    )
+    return ExportJobs(SimpleNamespace(config=config, connector_database=database))
+
+
+def read_all(jobs: ExportJobs, job: ExportJob) -> list[dict]:
+    async def main():
+        return [row for chunk in [chunk async for chunk in jobs.chunks(job)] for row in chunk]
+
+    return asyncio.run(main())
+
+
+def test_window_halves_after_limit_and_grows_back(tmp_path):
+    rows = [{"calldate": minutes(index), "uniqueid": f"a{index}"} for index in range(12)]
+    rows += [{"calldate": minutes(60 * hour + 30), "uniqueid": f"h{hour}"} for hour in (1, 2, 3)]
+    database = FakeDatabase(rows)
+    jobs = create_jobs(database, tmp_path)
+    job = ExportJob("1", "cdr", "csv", START, minutes(240), "")
+    assert [row["uniqueid"] for row in read_all(jobs, job)] == [row["uniqueid"] for row in rows]
+    last = datetime.timedelta(microseconds=1)
+    assert database.queries == [
+        # 12 rows: the second query starts at time of the last row of the first
+        (minutes(0), minutes(60) - last),
+        (minutes(9), minutes(60) - last),
+        # window is halved, then grows back after a window without rows
+        (minutes(60), minutes(90) - last),
+        (minutes(90), minutes(150) - last),
+        (minutes(150), minutes(210) - last),
+        (minutes(210), minutes(240)),
+    ]
+    assert job.exported_to == minutes(240)
+    assert job.progress == 1.0
+
+
+def test_rows_of_boundary_time_are_not_lost_or_repeated(tmp_path):
+    rows = [{"calldate": minutes(index), "uniqueid": f"a{index}"} for index in range(8)]
+    # six rows of one time on the boundary of queries, two of them are equal
+    rows += [{"calldate": minutes(8), "uniqueid": f"b{index}"} for index in range(4)]
+    rows += [{"calldate": minutes(8), "uniqueid": "same"}] * 2
+    rows.append({"calldate": minutes(9), "uniqueid": "c"})
+    database = FakeDatabase(rows)
+    jobs = create_jobs(database, tmp_path)
+    job = ExportJob("1", "cdr", "csv", START, minutes(30), "")
+    exported = read_all(jobs, job)
+    assert sorted(row["uniqueid"] for row in exported) == sorted(row["uniqueid"] for row in rows)
+    assert len(database.queries) == 2
+    assert database.queries[1][0] == minutes(8)
+
+
+def test_more_than_limit_rows_of_one_time_stop_window(tmp_path, caplog):
+    rows = [{"calldate": minutes(1), "uniqueid": f"a{index}"} for index in range(LIMIT + 2)]
+    rows.append({"calldate": minutes(2), "uniqueid": "next"})
+    jobs = create_jobs(FakeDatabase(rows), tmp_path)
+    job = ExportJob("1", "cdr", "csv", START, minutes(30), "")
+    with caplog.at_level(logging.WARNING, logger="asterisk_agent"):
+        exported = read_all(jobs, job)
+    assert len(exported) == LIMIT
+    assert f"more than {LIMIT} rows" in caplog.text
+
+
+def test_export_job_to_csv_waits_for_busy_database(tmp_path):
+    rows = [{"calldate": minutes(index), "uniqueid": f"a{index}"} for index in range(25)]
+    jobs = create_jobs(FakeDatabase(rows, busy=2), tmp_path, export_window=600)
+
+    async def main():
+        job = jobs.submit("cdr", "csv", START, minutes(60))
+        assert job.status == "queued"
+        await job.task
+        return job
+
+    job = asyncio.run(main())
+    assert job.status == "done", job.error
+    assert job.rows == 25
+    assert not os.path.exists(f"{job.path}.part")
+    assert job.size == os.path.getsize(job.path)
+    with gzip.open(job.path, "rt", encoding="utf-8", newline="") as file:
+        exported = list(csv.DictReader(file))
+    assert [row["uniqueid"] for row in exported] == [row["uniqueid"] for row in rows]
+    assert jobs.stats() == {"running": 0, "done": 1}
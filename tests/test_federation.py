@@ -0,0 +1,127 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Federated history merge of PBX and peer agents"""
+
+import asyncio
+import datetime
+import zoneinfo
+
+from services.federation import aware_rows, cdr_time, cel_time, merge_sources
+
+MOSCOW = zoneinfo.ZoneInfo("Europe/Moscow")
+UTC = datetime.timezone.utc
+
+
+async def rows_of(rows: list[dict]):
+    for row in rows:
+        yield row
+
+
+async def failing_rows(rows: list[dict]):
+    for row in rows:
+        yield row
+    raise ConnectionError("peer is down")
+
+
+def merge(sources: dict, key=cdr_time, timeout: float = 5) -> list[dict]:
+    async def main():
+        return [row async for row in merge_sources(sources, key, timeout)]
+
+    return asyncio.run(main())
+
+
+def test_merge_sources_of_different_time_zones():
+    # naive database times: 10:00 Moscow is 07:00 UTC
+    moscow = [
+        {"calldate": datetime.datetime(2024, 5, 1, 10, 0), "uniqueid": "m1"},
+        {"calldate": datetime.datetime(2024, 5, 1, 11, 0), "uniqueid": "m2"},
+    ]
+    london = [
+        {"calldate": datetime.datetime(2024, 5, 1, 7, 30), "uniqueid": "u1"},
+        {"calldate": datetime.datetime(2024, 5, 1, 8, 30), "uniqueid": "u2"},
+    ]
+    rows = merge(
+        {
+            "moscow": aware_rows(rows_of(moscow), "cdr", MOSCOW),
+            "london": aware_rows(rows_of(london), "cdr", UTC),
+        }
+    )
+    assert [row["uniqueid"] for row in rows] == ["m1", "u1", "m2", "u2"]
+    assert [row["pbx"] for row in rows] == ["moscow", "london", "moscow", "london"]
+    assert rows[0]["calldate"] == datetime.datetime(2024, 5, 1, 7, 0, tzinfo=UTC)
+    assert rows[0]["calldate"].utcoffset() == datetime.timedelta(hours=3)
+
+
+def test_merge_peer_iso_strings():
+    # peer agent rows: ISO with "T" and offset, history cache rows: ISO with space
+    peer = [
+        {"calldate": "2024-05-01T10:15:00+03:00", "uniqueid": "p1", "pbx": "spb:default"},
+        {"calldate": "2024-05-01T09:00:00+00:00", "uniqueid": "p2", "pbx": "spb:default"},
+    ]
+    local = [
+        {"calldate": "2024-05-01 07:30:00", "uniqueid": "l1"},
+        {"calldate": "2024-05-01 08:00:00", "uniqueid": "l2"},
+    ]
+    rows = merge(
+        {
+            "spb": aware_rows(rows_of(peer), "cdr", UTC),
+            "default": aware_rows(rows_of(local), "cdr", UTC),
+        }
+    )
+    assert [row["uniqueid"] for row in rows] == ["p1", "l1", "l2", "p2"]
+    assert rows[0]["pbx"] == "spb:default"
+
+
+def test_cel_ties_by_id():
+    first = [{"eventtime": datetime.datetime(2024, 5, 1, 10, 0), "id": 2}]
+    second = [
+        {"eventtime": datetime.datetime(2024, 5, 1, 10, 0), "id": 1},
+        {"eventtime": datetime.datetime(2024, 5, 1, 10, 0), "id": 3},
+    ]
+    rows = merge(
+        {
+            "a": aware_rows(rows_of(first), "cel", UTC),
+            "b": aware_rows(rows_of(second), "cel", UTC),
+        },
+        key=cel_time,
+    )
+    assert [row["id"] for row in rows] == [1, 2, 3]
+
+
+def test_failed_source_is_reported_and_others_go_on():
+    rows = merge(
+        {
+            "down": failing_rows([{"calldate": "2024-05-01T10:00:00+00:00", "uniqueid": "d1"}]),
+            "up": rows_of(
+                [
+                    {"calldate": "2024-05-01T09:00:00+00:00", "uniqueid": "u1"},
+                    {"calldate": "2024-05-01T11:00:00+00:00", "uniqueid": "u2"},
+                ]
+            ),
+        }
+    )
+    assert [row.get("uniqueid") or row["error"] for row in rows][:2] == ["u1", "d1"]
+    errors = [row for row in rows if "error" in row]
+    assert len(errors) == 1
+    assert errors[0]["pbx"] == "down"
+    assert "peer is down" in errors[0]["error"]
+    assert rows[-1]["uniqueid"] == "u2"
+
+
+def test_source_without_rows_in_timeout_is_dropped():
+    async def slow_rows():
+        yield {"calldate": "2024-05-01T09:00:00+00:00", "uniqueid": "s1"}
+        await asyncio.sleep(10)
+        yield {"calldate": "2024-05-01T10:00:00+00:00", "uniqueid": "s2"}
+
+    rows = merge(
+        {
+            "slow": slow_rows(),
+            "fast": rows_of([{"calldate": "2024-05-01T09:30:00+00:00", "uniqueid": "f1"}]),
+        },
+        timeout=0.2,
+    )
+    # slow source is dropped when the merge waits for its next row
+    assert [row.get("uniqueid") for row in rows] == ["s1", None, "f1"]
+    assert rows[1]["pbx"] == "slow"
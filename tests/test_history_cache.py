@@ -0,0 +1,183 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""HistoryCache: days of request time zone, memory and disk LRU, stitched rows"""
+
+import asyncio
+import datetime
+import os
+from types import SimpleNamespace
+
+from schemas.config_schema import Config
+from services import history_cache
+from services.history_cache import DAY_END, HistoryCache
+
+MOSCOW = datetime.timezone(datetime.timedelta(hours=3))
+UTC = datetime.timezone.utc
+US = datetime.timedelta(microseconds=1)
+
+
+def moment(day: int, hour: int = 0, tzinfo=MOSCOW) -> datetime.datetime:
+    return datetime.datetime(2024, 5, day, hour, tzinfo=tzinfo)
+
+
+class FakeDatabase:
+    """CDR rows, every hour of May 2024 one call, queries are recorded"""
+
+    def __init__(self) -> None:
+        start = datetime.datetime(2024, 5, 1, tzinfo=UTC)
+        self.rows = [
+            {"calldate": start + datetime.timedelta(hours=hour), "uniqueid": f"{hour}"}
+            for hour in range(31 * 24)
+        ]
+        self.queries: list[tuple[datetime.datetime, datetime.datetime]] = []
+
+    async def iter_cdr(self, start, end, ordered: bool = False):
+        self.queries.append((start, end))
+        for row in self.rows:
+            if start <= row["calldate"] <= end:
+                yield row
+
+
+def create_cache(database: FakeDatabase, **settings) -> HistoryCache:
+    values = {
+        "pbx_name": "test",
+        "db_dialect": "sqlite",
+        "db_host": "",
+        "db_port": 5000,
+        "db_database": "asterisk.db",
+        "db_table_cdr_name": "cdr",
+    }
+    values.update(settings)
+    config = Config.model_construct(**values)
+    return HistoryCache(SimpleNamespace(config=config, connector_database=database))
+
+
+def history(cache: HistoryCache, start_date, end_date) -> list[str]:
+    async def main():
+        return [row["uniqueid"] async for row in cache.iter_cdr(start_date, end_date)]
+
+    return asyncio.run(main())
+
+
+def expected(database: FakeDatabase, start_date, end_date) -> list[str]:
+    return [row["uniqueid"] for row in database.rows if start_date <= row["calldate"] <= end_date]
+
+
+def test_split_by_days_of_request_time_zone():
+    cache = create_cache(FakeDatabase())
+    start_date, end_date = moment(1, 12), moment(4, 6)
+    assert cache.split(start_date, end_date) == [
+        ("query", moment(1, 12), moment(2) - US),
+        ("day", moment(2), moment(2) + DAY_END),
+        ("day", moment(3), moment(3) + DAY_END),
+        ("query", moment(4), moment(4, 6)),
+    ]
+    # end of range in another time zone is converted to zone of start
+    pieces = cache.split(start_date, end_date.astimezone(UTC))
+    assert pieces[-1] == ("query", moment(4), moment(4, 6))
+    assert pieces[-1][2].utcoffset() == datetime.timedelta(hours=3)
+    # a whole UTC day is two partial days of Moscow
+    utc_day = moment(2, 0, UTC)
+    assert cache.split(utc_day, utc_day + DAY_END) == [("day", utc_day, utc_day + DAY_END)]
+    moscow_day = utc_day.astimezone(MOSCOW)
+    assert cache.split(moscow_day, moscow_day + DAY_END) == [
+        ("query", moscow_day, moscow_day + DAY_END)
+    ]
+    assert cache.key("cdr", moment(2)) != cache.key("cdr", moment(2, 3, UTC))
+
+
+def test_split_without_closed_days_is_one_query():
+    cache = create_cache(FakeDatabase())
+    now = datetime.datetime.now(MOSCOW)
+    assert cache.split(now - datetime.timedelta(hours=30), now) == [
+        ("query", now - datetime.timedelta(hours=30), now)
+    ]
+    assert cache.split(moment(2, 1), moment(2, 23)) == [("query", moment(2, 1), moment(2, 23))]
+
+
+def test_days_are_read_once_and_rows_are_the_same():
+    database = FakeDatabase()
+    cache = create_cache(database)
+    start_date, end_date = moment(1, 12), moment(5, 6)
+    assert history(cache, start_date, end_date) == expected(database, start_date, end_date)
+    assert cache.stats()["misses"] == 3
+    queries = len(database.queries)
+    assert history(cache, start_date, end_date) == expected(database, start_date, end_date)
+    assert cache.stats()["hits"] == 3
+    # edges only
+    assert len(database.queries) == queries + 2
+    # days of another UTC offset are other rows
+    utc_start, utc_end = moment(1, 12, UTC), moment(5, 6, UTC)
+    assert history(cache, utc_start, utc_end) == expected(database, utc_start, utc_end)
+    assert cache.stats()["misses"] == 6
+
+
+def test_memory_lru_drops_least_recently_used_day():
+    database = FakeDatabase()
+    cache = create_cache(database)
+    history(cache, moment(2), moment(3) + DAY_END)
+    # room for two days and a half
+    cache.config.history_cache_size = cache.size + cache.size // 4
+    # day 2 is used, day 3 is the least recently used now
+    history(cache, moment(2), moment(2) + DAY_END)
+    history(cache, moment(4), moment(4) + DAY_END)
+    assert [key[1].day for key in cache.days] == [2, 4]
+    assert cache.size <= cache.config.history_cache_size
+    assert cache.size == sum(len(data) for data in cache.days.values())
+
+
+def test_disk_cache_survives_restart_and_is_trimmed(tmp_path):
+    database = FakeDatabase()
+    cache = create_cache(database, history_cache_dir=str(tmp_path))
+    history(cache, moment(2), moment(4) + DAY_END)
+    assert len(os.listdir(tmp_path)) == 3
+    assert cache.disk_size == sum(os.path.getsize(path) for path in cache.disk)
+
+    # new process: days are read from files, not from database
+    restarted = create_cache(database, history_cache_dir=str(tmp_path))
+    queries = len(database.queries)
+    expected_rows = expected(database, moment(2), moment(4) + DAY_END)
+    assert history(restarted, moment(2), moment(4) + DAY_END) == expected_rows
+    assert len(database.queries) == queries
+    assert restarted.stats()["disk_hits"] == 3
+
+    # the least recently used files are removed above history_cache_disk_size
+    restarted.config.history_cache_disk_size = restarted.disk_size + restarted.disk_size // 6
+    history(restarted, moment(5), moment(5) + DAY_END)
+    assert len(os.listdir(tmp_path)) == 3
+    assert restarted.disk_size <= restarted.config.history_cache_disk_size
+    assert not os.path.exists(restarted.path("cdr", moment(2)))
+    assert os.path.exists(restarted.path("cdr", moment(5)))
+
+
+def test_files_of_other_database_are_not_read(tmp_path):
+    database = FakeDatabase()
+    cache = create_cache(database, history_cache_dir=str(tmp_path))
+    history(cache, moment(2), moment(2) + DAY_END)
+    other = create_cache(database, history_cache_dir=str(tmp_path), db_database="other.db")
+    assert other.path("cdr", moment(2)) != cache.path("cdr", moment(2))
+    history(other, moment(2), moment(2) + DAY_END)
+    assert other.stats()["misses"] == 1
+
+
+def test_stitched_rows_are_limited(monkeypatch):
+    monkeypatch.setattr(history_cache, "HISTORY_LIMIT", 30)
+    database = FakeDatabase()
+    cache = create_cache(database)
+    start_date, end_date = moment(1, 12), moment(5, 6)
+    assert history(cache, start_date, end_date) == expected(database, start_date, end_date)[:30]
+    # day with HISTORY_LIMIT rows or more may be truncated, it is not cached
+    monkeypatch.setattr(history_cache, "HISTORY_LIMIT", 24)
+    cache.clear()
+    history(cache, moment(2), moment(2) + DAY_END)
+    assert cache.stats()["uncached"] == 1
+    assert not cache.days
+
+
+def test_disabled_cache_queries_range():
+    database = FakeDatabase()
+    cache = create_cache(database, history_cache_enable=0)
+    start_date, end_date = moment(1, 12), moment(5, 6)
+    assert history(cache, start_date, end_date) == expected(database, start_date, end_date)
+    assert database.queries == [(start_date, end_date)]
@@ -0,0 +1,112 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""EventLanes: lane of event type, priorities, order of one channel"""
+
+import asyncio
+
+from services.lanes import EventLanes
+
+
+def create_lanes(deliver, size: int = 100) -> EventLanes:
+    return EventLanes(
+        {"high": 2, "bulk": 1},
+        {"ChannelCreated": "high", "Dial": "high", "Recording": "missing"},
+        size,
+        deliver,
+    )
+
+
+async def nothing(lane: str, event: dict):
+    pass
+
+
+def test_lane_of_event_type_and_priority():
+    lanes = create_lanes(nothing)
+    assert lanes.lane("ChannelCreated") == "high"
+    assert lanes.lane("ChannelVarset") == "bulk"
+    # lane of unknown name goes to the last lane
+    assert lanes.lane("Recording") == "bulk"
+    assert lanes.priority("high") == 0
+    assert lanes.priority("bulk") == 1
+    assert lanes.stats() == {
+        "high": {"workers": 2, "queued": 0},
+        "bulk": {"workers": 1, "queued": 0},
+    }
+
+
+def test_events_of_one_channel_in_order():
+    delivered: list[tuple[str, str, int]] = []
+
+    async def deliver(lane: str, event: dict):
+        # a random delay must not reorder events of one channel
+        await asyncio.sleep(0.001 * (event["index"] % 3))
+        delivered.append((lane, event["channel"], event["index"]))
+
+    async def main():
+        lanes = create_lanes(deliver)
+        for index in range(30):
+            channel = f"c{index % 5}"
+            event_type = "Dial" if index % 2 else "ChannelVarset"
+            await lanes.put(event_type, channel, {"channel": channel, "index": index})
+        await lanes.join()
+        lanes.close()
+
+    asyncio.run(main())
+    assert len(delivered) == 30
+    for lane in ("high", "bulk"):
+        for channel in {channel for _, channel, _ in delivered}:
+            indexes = [i for name, c, i in delivered if name == lane and c == channel]
+            assert indexes == sorted(indexes)
+    assert {index for lane, _, index in delivered if lane == "high"} == set(range(1, 30, 2))
+
+
+def test_high_lane_not_waiting_behind_bulk():
+    delivered: list[str] = []
+
+    async def main():
+        blocked = asyncio.Event()
+
+        async def deliver(lane: str, event: dict):
+            if lane == "bulk":
+                await blocked.wait()
+            delivered.append(event["name"])
+
+        lanes = create_lanes(deliver)
+        for index in range(5):
+            await lanes.put("ChannelVarset", "bulk", {"name": f"bulk{index}"})
+        await lanes.put("ChannelCreated", "call", {"name": "ring"})
+        # bulk worker is blocked, high lane is delivered anyway
+        await asyncio.wait_for(lanes_idle(lanes, "high"), 1)
+        assert delivered == ["ring"]
+        blocked.set()
+        await lanes.join()
+        lanes.close()
+
+    asyncio.run(main())
+    assert delivered == ["ring", "bulk0", "bulk1", "bulk2", "bulk3", "bulk4"]
+
+
+async def lanes_idle(lanes: EventLanes, lane: str):
+    for queue in lanes.queues[lane]:
+        await queue.join()
+
+
+def test_full_lane_waits_and_error_does_not_stop_worker():
+    delivered: list[int] = []
+
+    async def deliver(lane: str, event: dict):
+        if event["index"] == 0:
+            raise ValueError("webhook bug")
+        delivered.append(event["index"])
+
+    async def main():
+        lanes = EventLanes({"bulk": 1}, {}, 1, deliver)
+        for index in range(5):
+            await asyncio.wait_for(lanes.put("Dial", "c", {"index": index}), 1)
+        await lanes.join()
+        lanes.close()
+        assert lanes.tasks == []
+
+    asyncio.run(main())
+    assert delivered == [1, 2, 3, 4]
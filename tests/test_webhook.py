@@ -0,0 +1,219 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""Webhook delivery: token bucket, AIMD concurrency, circuit breaker and outbox"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from schemas.config_schema import Config
+from services import webhook
+from services.webhook import AdaptiveLimit, CircuitBreaker, TokenBucket, WebhookSender
+
+
+class FakeClock:
+    """time module of services.webhook with monotonic moved by test"""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(webhook, "time", fake)
+    return fake
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    # tokens are reserved in call order: the 4th waits 0.1s, the 5th 0.2s
+    assert bucket.reserve() == pytest.approx(0.1)
+    assert bucket.reserve() == pytest.approx(0.2)
+    clock.now += 1
+    # refilled up to burst, debt of the reserved tokens is paid first
+    assert bucket.tokens == pytest.approx(-2)
+    assert bucket.reserve() == 0
+    assert bucket.tokens == pytest.approx(2)
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(rate=0, burst=1)
+    assert all(bucket.reserve() == 0 for _ in range(1000))
+
+
+def test_aimd_grows_on_fast_success_and_halves_on_error(clock):
+    limit = AdaptiveLimit(minimum=1, maximum=4, latency_target=0.5)
+    limit.record(0.1, True)
+    assert limit.limit == 2
+    # additive increase: 1/limit per success
+    limit.record(0.1, True)
+    limit.record(0.1, True)
+    assert limit.limit == pytest.approx(2.9)
+    for _ in range(10):
+        limit.record(0.1, True)
+    assert limit.limit == 4
+    limit.record(0.1, False)
+    assert limit.limit == 2
+    # the same slow period halves once per latency target
+    limit.record(2.0, True)
+    assert limit.limit == 2
+    clock.now += 0.5
+    limit.record(2.0, True)
+    assert limit.limit == 1
+    clock.now += 0.5
+    limit.record(0.1, False)
+    assert limit.limit == 1
+
+
+def test_aimd_slots_by_priority_then_fifo():
+    order: list[str] = []
+
+    async def request(limit: AdaptiveLimit, name: str, priority: int):
+        async with limit.slot(priority):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def main():
+        limit = AdaptiveLimit(minimum=1, maximum=1, latency_target=0.5)
+        await limit.acquire()
+        tasks = []
+        for name, priority in (("bulk1", 1), ("bulk2", 1), ("high1", 0), ("high2", 0)):
+            tasks.append(asyncio.create_task(request(limit, name, priority)))
+            await asyncio.sleep(0)
+        limit.release()
+        await asyncio.gather(*tasks)
+        assert limit.in_flight == 0
+
+    asyncio.run(main())
+    assert order == ["high1", "high2", "bulk1", "bulk2"]
+
+
+def test_breaker_opens_half_opens_and_closes(clock):
+    breaker = CircuitBreaker(error_rate=0.5, min_requests=4, window=30, open_seconds=10)
+    for ok in (True, False, True):
+        breaker.record(ok)
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.opened_count == 1
+    assert not breaker.allow()
+    assert breaker.retry_in() == 10
+
+    clock.now += 10
+    # one probe only
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.opened_count == 2
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.errors() == 0
+
+
+def test_breaker_forgets_errors_out_of_window(clock):
+    breaker = CircuitBreaker(error_rate=0.5, min_requests=2, window=30, open_seconds=10)
+    breaker.record(False)
+    clock.now += 31
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.errors() == 0
+
+
+class FakeWebhook:
+    """Webhook server by MockTransport, fails while down"""
+
+    def __init__(self) -> None:
+        self.down = False
+        self.received: list[int] = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.down:
+            return httpx.Response(503)
+        self.received.append(json.loads(request.content)["index"])
+        return httpx.Response(200)
+
+
+def create_sender(server: FakeWebhook, **settings) -> WebhookSender:
+    values = {
+        "pbx_name": "test",
+        "ari_login": "agent",
+        "ari_password": "secret",
+        "webhook_breaker_min_requests": 2,
+        "webhook_breaker_open": 0.05,
+        "webhook_outbox_size": 3,
+    }
+    values.update(settings)
+    sender = WebhookSender(Config.model_construct(**values))
+    sender.client = httpx.AsyncClient(transport=httpx.MockTransport(server.handler))
+    return sender
+
+
+def test_outbox_is_sent_in_order_after_circuit_closes():
+    server = FakeWebhook()
+    url = "http://crm.example.com/events"
+
+    async def main():
+        sender = create_sender(server, webhook_outbox_size=10)
+        assert await sender.send("ari", url, {"index": 0})
+        server.down = True
+        # the error opens circuit (2 requests, 50% errors), its event is kept in outbox
+        assert not await sender.send("ari", url, {"index": 1})
+        target = sender.target(url)
+        assert target.breaker.state == "open"
+        # short-circuited, no request
+        assert not await sender.send("ari", url, {"index": 2})
+        assert [payload["index"] for _, _, payload in target.outbox] == [1, 2]
+        server.down = False
+        # events are not sent before outbox, to keep order
+        assert not await sender.send("ari", url, {"index": 3})
+        await asyncio.wait_for(target.drain_task, 1)
+        assert not target.outbox
+        assert target.breaker.state == "closed"
+        assert await sender.send("ari", url, {"index": 4})
+        stats = sender.stats()["http://crm.example.com"]
+        await sender.close()
+        return stats
+
+    stats = asyncio.run(main())
+    assert server.received == [0, 1, 2, 3, 4]
+    assert stats["circuit"] == "closed"
+    assert stats["outbox"] == 0
+    assert stats["failed"] == 1
+
+
+def test_outbox_drops_oldest_when_full():
+    server = FakeWebhook()
+    server.down = True
+    url = "http://crm.example.com/events"
+
+    async def main():
+        sender = create_sender(server, webhook_breaker_open=60)
+        for index in range(7):
+            await sender.send("ami", url, {"index": index})
+        target = sender.target(url)
+        indexes = [payload["index"] for _, _, payload in target.outbox]
+        await sender.close()
+        return indexes, target.stats()
+
+    indexes, stats = asyncio.run(main())
+    assert indexes == [4, 5, 6]
+    assert stats["circuit"] == "open"
+    # 0 and 1 were sent and failed, the second error opened circuit
+    assert stats["failed"] == 2
+    assert stats["dropped"] == 3
@@ -0,0 +1,125 @@
+# Copyright 2024 Artem Shurshilov
+# Apache License Version 2.0
+
+"""ARI subscription of WebsocketEvents: event sources, event filter, fallback"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from schemas.config_schema import AriConfig
+from services import websocket
+from services.websocket import WebsocketEvents
+
+
+class FakeAriHttp:
+    """ARI REST answers by MockTransport, requests are recorded"""
+
+    def __init__(self) -> None:
+        self.requests: list[tuple[str, str, dict | None]] = []
+        self.subscription_status = 204
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content) if request.content else None
+        self.requests.append((request.method, request.url.path.rsplit("/", 1)[-1], body))
+        if request.url.path.endswith("/subscription"):
+            return httpx.Response(self.subscription_status)
+        return httpx.Response(200, json={})
+
+
+class FakeWebsocket:
+    """Connection which is closed on the first recv"""
+
+    urls: list[str] = []
+
+    def __init__(self, url: str, **kwargs) -> None:
+        self.urls.append(url)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def recv(self):
+        raise ConnectionError("closed")
+
+
+@pytest.fixture
+def ari(monkeypatch) -> FakeAriHttp:
+    fake = FakeAriHttp()
+    client = httpx.AsyncClient
+
+    def client_factory(**kwargs):
+        return client(transport=httpx.MockTransport(fake.handler), **kwargs)
+
+    monkeypatch.setattr(websocket.httpx, "AsyncClient", client_factory)
+    monkeypatch.setattr(websocket.websockets, "connect", FakeWebsocket)
+    FakeWebsocket.urls = []
+    return fake
+
+
+def create_client(events_used: list[str]) -> WebsocketEvents:
+    ari_config = AriConfig(
+        url="http://127.0.0.1:8088/ari/",
+        wss="ws://127.0.0.1:8088/ari/events",
+        login="agent",
+        password="secret",
+        events_ignore=[],
+        events_used=events_used,
+    )
+    return WebsocketEvents(None, "agent:secret", ari_config, "http://127.0.0.1/webhook")
+
+
+def test_subscribe_sources_and_filter(ari):
+    client = create_client(["ChannelDestroyed"])
+    asyncio.run(client.subscribe())
+    assert [(method, name) for method, name, _ in ari.requests] == [
+        ("POST", "subscription"),
+        ("PUT", "eventFilter"),
+    ]
+    assert ari.requests[1][2] == {"allowed": [{"type": "ChannelDestroyed"}], "disallowed": []}
+    assert client.subscribed_sources == {"channel:"}
+
+
+def test_subscribe_all_removes_filter(ari):
+    client = create_client(["ChannelDestroyed"])
+    asyncio.run(client.subscribe())
+    ari.requests.clear()
+    # reload without events_used: subscribeAll, filter of the previous config is removed
+    assert client.set_events([], [])
+    asyncio.run(client.subscribe())
+    assert ari.requests == [("PUT", "eventFilter", {"allowed": [], "disallowed": []})]
+
+
+def test_subscribe_error_falls_back_for_one_connection(ari):
+    client = create_client(["ChannelDestroyed"])
+    client.recover_gap = lambda: asyncio.sleep(0)
+
+    async def connect():
+        with pytest.raises(Exception):
+            await client.start_consumer()
+
+    ari.subscription_status = 500
+    asyncio.run(connect())
+    assert client.subscribe_fallback
+    assert not client.subscribe_all
+
+    # ARI is back: fallback connection gets all events, filter is removed
+    ari.subscription_status = 204
+    ari.requests.clear()
+    asyncio.run(connect())
+    assert "subscribeAll=true" in FakeWebsocket.urls[1]
+    assert ari.requests == [("PUT", "eventFilter", {"allowed": [], "disallowed": []})]
+    assert not client.subscribe_fallback
+
+    # the next connection subscribes by sources again
+    ari.requests.clear()
+    asyncio.run(connect())
+    assert "subscribeAll=false" in FakeWebsocket.urls[2]
+    assert [(method, name) for method, name, _ in ari.requests] == [
+        ("POST", "subscription"),
+        ("PUT", "eventFilter"),
+    ]